@@ -0,0 +1,149 @@
+import itertools
+import os
+import threading
+import time
+from typing import List, Optional
+
+from cancellation import CancellationToken
+
+ADMISSION_POLICIES = ["sjf", "edf", "fifo"]
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, cost: float, deadline: Optional[float], seq: int):
+        self.cost = cost
+        # absolute time.time() by which the request should be done
+        self.deadline = deadline
+        self.seq = seq
+        self.enqueued = time.time()
+        self.started = None
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        policy: str = os.environ.get("ADMISSION_POLICY", "sjf"),
+        max_concurrent: int = 1,
+        max_queue_seconds: Optional[float] = None,
+        aging: float = 0.5,
+    ):
+        """
+        AdmissionController orders predictions waiting for the GPU.
+
+        Requests enter with the cost estimated by the LatencyCostModel and are
+        started according to `policy`:
+        - sjf: shortest estimated job first, so short interactive requests are
+          not stuck behind large batches. Waiting time is subtracted from the cost
+          (times `aging`) so that long jobs are not starved.
+        - edf: earliest deadline first, requests without a deadline go last.
+        - fifo: arrival order.
+
+        A request is rejected up front when the work queued ahead of it makes it
+        miss its deadline, or would keep it waiting for more than
+        `max_queue_seconds`. Requests that cannot meet their deadline on an idle
+        worker are still admitted, they are served best-effort.
+
+        It only has requests to order when several predictions are in the
+        process at once, i.e. with the async predict() and cog's
+        concurrency.max above 1 (see cog.yaml). With one prediction at a time
+        every request finds an empty queue and is admitted right away.
+
+        :param policy: One of ADMISSION_POLICIES.
+        :param max_concurrent: Number of predictions allowed to run at once.
+        :param max_queue_seconds: Reject requests that would wait longer than this.
+        :param aging: Seconds of cost forgiven per second waited, for sjf.
+        """
+        if policy not in ADMISSION_POLICIES:
+            raise ValueError(
+                f"Unknown admission policy {policy}, expected one of {ADMISSION_POLICIES}"
+            )
+        self.policy = policy
+        self.max_concurrent = max_concurrent
+        self.max_queue_seconds = max_queue_seconds
+        self.aging = aging
+        self.queued: List[Ticket] = []
+        self.running: List[Ticket] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _key(self, ticket: Ticket, now: float):
+        if self.policy == "sjf":
+            return (ticket.cost - self.aging * (now - ticket.enqueued), ticket.seq)
+        if self.policy == "edf":
+            deadline = ticket.deadline if ticket.deadline is not None else float("inf")
+            return (deadline, ticket.seq)
+        return (ticket.seq,)
+
+    def _next(self) -> Ticket:
+        now = time.time()
+        return min(self.queued, key=lambda ticket: self._key(ticket, now))
+
+    def expected_wait(self) -> float:
+        """
+        Estimated seconds until a newly queued request could start.
+        """
+        with self._cond:
+            now = time.time()
+            remaining = sum(
+                max(0.0, ticket.cost - (now - ticket.started)) for ticket in self.running
+            )
+            queued = sum(ticket.cost for ticket in self.queued)
+        return (remaining + queued) / self.max_concurrent
+
+    def acquire(
+        self,
+        cost: float,
+        deadline: Optional[float] = None,
+        token: Optional[CancellationToken] = None,
+    ) -> Ticket:
+        """
+        Queue a request and block until it may run.
+
+        :param cost: Estimated seconds the request will take.
+        :param deadline: Seconds from now the request should be done in, if any.
+        :param token: Stop waiting when this token is cancelled.
+        :return: Ticket to pass to release() once the request is done.
+        """
+        wait = self.expected_wait()
+        if deadline is not None and wait > 0 and wait + cost > deadline:
+            raise AdmissionRejected(
+                f"Estimated {wait:.1f}s queue + {cost:.1f}s work exceeds the {deadline:.1f}s deadline"
+            )
+        if self.max_queue_seconds is not None and wait > self.max_queue_seconds:
+            raise AdmissionRejected(
+                f"Estimated queue of {wait:.1f}s exceeds {self.max_queue_seconds:.1f}s"
+            )
+
+        ticket = Ticket(
+            cost, time.time() + deadline if deadline is not None else None, next(self._seq)
+        )
+        with self._cond:
+            self.queued.append(ticket)
+            try:
+                while not (
+                    len(self.running) < self.max_concurrent and self._next() is ticket
+                ):
+                    if token is not None:
+                        token.raise_if_cancelled()
+                    self._cond.wait(timeout=0.1)
+            except BaseException:
+                self.queued.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self.queued.remove(ticket)
+            ticket.started = time.time()
+            self.running.append(ticket)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        Mark a request as done and wake up the next one.
+        """
+        with self._cond:
+            if ticket in self.running:
+                self.running.remove(ticket)
+            self._cond.notify_all()
@@ -0,0 +1,116 @@
+"""
+Compare two benchmark result files written by benchmarks/run.py.
+
+Usage:
+    python -m benchmarks.compare OLD.json NEW.json [--threshold 0.1]
+"""
+
+import argparse
+import json
+import math
+import statistics
+from typing import Dict, List, Sequence, Tuple
+
+# significance level below which a slowdown is not attributed to noise
+ALPHA = 0.05
+
+
+def mann_whitney_p(old: Sequence[float], new: Sequence[float]) -> float:
+    """
+    One-sided p-value of the Mann-Whitney U test that samples of `new` tend to
+    be larger than samples of `old`. Uses the normal approximation with tie and
+    continuity corrections, which is adequate from about 5 samples per side.
+    """
+    n1, n2 = len(old), len(new)
+    values = sorted([(v, 0) for v in old] + [(v, 1) for v in new])
+    n = n1 + n2
+
+    # average ranks of tied values
+    rank_sum_new = 0.0
+    tie_term = 0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        rank_sum_new += rank * sum(1 for _, group in values[i : j + 1] if group == 1)
+        tie_term += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+
+    u = rank_sum_new - n2 * (n2 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        # all samples equal
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def is_regression(
+    old: List[float], new: List[float], tolerance: float, alpha: float = ALPHA
+) -> bool:
+    """
+    Whether `new` timings regressed against `old`: the median grew by more than
+    `tolerance` (relative) and the slowdown is significant at level `alpha`.
+    """
+    slower = statistics.median(new) > statistics.median(old) * (1 + tolerance)
+    return slower and mann_whitney_p(old, new) < alpha
+
+
+def result_key(result: dict) -> Tuple[str, str]:
+    return result["benchmark"], json.dumps(result["params"], sort_keys=True)
+
+
+def load_results(path: str) -> Dict[Tuple[str, str], dict]:
+    with open(path) as f:
+        return {result_key(r): r for r in json.load(f)["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change of the median flagged as a regression or improvement",
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=ALPHA,
+        help="Significance level of the Mann-Whitney U test on the samples",
+    )
+    args = parser.parse_args()
+
+    old = load_results(args.old)
+    new = load_results(args.new)
+    for key in sorted(old.keys() & new.keys()):
+        old_median = old[key]["seconds"]["median"]
+        new_median = new[key]["seconds"]["median"]
+        change = new_median / old_median - 1
+        old_samples = old[key]["seconds"].get("samples")
+        new_samples = new[key]["seconds"].get("samples")
+        flag = ""
+        if old_samples and new_samples:
+            # only flag changes that stand out from the run to run noise
+            if is_regression(old_samples, new_samples, args.threshold, args.alpha):
+                flag = "slower"
+            elif is_regression(new_samples, old_samples, args.threshold, args.alpha):
+                flag = "faster"
+        elif change > args.threshold:
+            flag = "slower"
+        elif change < -args.threshold:
+            flag = "faster"
+        params = " ".join(f"{k}={v}" for k, v in json.loads(key[1]).items())
+        print(
+            f"{key[0]:<14} {params:<48} {old_median * 1000:9.2f}ms -> {new_median * 1000:9.2f}ms {change:+7.1%} {flag}"
+        )
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key[0]:<14} {key[1]} only in {'old' if key in old else 'new'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+A local stand-in for the cog HTTP server, for testing benchmarks/loadgen.py offline.
+
+It accepts the same POST /predictions and GET /health-check requests. Instead
+of running the model, it sleeps for the latency the LatencyCostModel estimates
+for the request. Predictions run one at a time like on a single GPU worker,
+so queueing shows up in the client side latencies.
+
+Usage:
+    python -m benchmarks.fake_server --port 5000 --time-scale 0.1
+"""
+
+import argparse
+import base64
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from cost_model import LatencyCostModel
+
+
+def _tiny_png_data_uri() -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), "gray").save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+class FakePredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 5000), time_scale: float = 1.0):
+        """
+        :param address: (host, port) to listen on, port 0 picks a free port.
+        :param time_scale: Multiplier on the estimated latencies, < 1 to run faster than a GPU.
+        """
+        super().__init__(address, FakePredictionHandler)
+        self.time_scale = time_scale
+        self.cost_model = LatencyCostModel()
+        self.gpu = threading.Lock()
+        self.loaded_weights = None
+        self.output = _tiny_png_data_uri()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def predict(self, inputs: dict) -> dict:
+        weights = inputs.get("lora_weights") or inputs.get("replicate_weights")
+        num_outputs = inputs.get("num_outputs", 1)
+        with self.gpu:
+            start = time.time()
+            seconds = self.cost_model.estimate(
+                inputs.get("width", 1024),
+                inputs.get("height", 1024),
+                num_outputs,
+                inputs.get("num_inference_steps", 6),
+                inputs.get("prompt_strength", 0.8),
+                controlnet=bool(inputs.get("controlnet_image")),
+                lora_load=bool(weights) and weights != self.loaded_weights,
+            )
+            if weights:
+                self.loaded_weights = weights
+            time.sleep(seconds * self.time_scale)
+        return {
+            "status": "succeeded",
+            "input": inputs,
+            "output": [self.output] * num_outputs,
+            "metrics": {"predict_time": time.time() - start},
+        }
+
+
+class FakePredictionHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health-check":
+            self._send_json(200, {"status": "READY"})
+        else:
+            self._send_json(404, {"detail": "Not Found"})
+
+    def do_POST(self):
+        if self.path != "/predictions":
+            self._send_json(404, {"detail": "Not Found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            inputs = json.loads(self.rfile.read(length))["input"]
+        except (ValueError, KeyError):
+            self._send_json(
+                422, {"detail": "Expected a JSON body with an input object"}
+            )
+            return
+        self._send_json(200, self.server.predict(inputs))
+
+    def log_message(self, format, *args):
+        # one line per request would drown the load generator output
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = FakePredictionServer((args.host, args.port), args.time_scale)
+    print(f"Fake prediction server listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
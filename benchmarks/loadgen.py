@@ -0,0 +1,357 @@
+"""
+Load generator for a cog prediction server.
+
+Replays a recorded request mix, or a synthetic one built from the repo's sample
+images, against POST /predictions and reports throughput and latency
+percentiles per request class (mode, LoRA or base weights, resolution).
+
+Two arrival models:
+- closed: `concurrency` clients, each sending its next request as soon as the
+  previous one returns. Measures the throughput the server sustains.
+- open: requests arrive as a Poisson process at `rate` per second, whether or
+  not earlier ones have returned. Latency is measured from the scheduled
+  arrival, so a server falling behind shows up as queueing delay.
+
+Usage:
+    cog run -p 5000 python -m cog.server.http   # or: python -m benchmarks.fake_server
+    python -m benchmarks.loadgen --mode closed --concurrency 2 --requests 20
+    python -m benchmarks.loadgen --mode open --rate 0.5 --duration 120 --mix requests.jsonl
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import mimetypes
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+import requests
+
+from metrics import QUANTILES, quantile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Result(NamedTuple):
+    request_class: str
+    start: float
+    latency: float
+    ok: bool
+    error: Optional[str]
+
+
+def data_uri(path: str) -> str:
+    mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        return f"data:{mime};base64," + base64.b64encode(f.read()).decode()
+
+
+# image inputs of each mode of the synthetic mix, the modes of predict.input_mode
+MIX_MODES = {
+    "txt2img": (),
+    "img2img": ("image",),
+    "inpaint": ("image", "mask"),
+    "controlnet": ("controlnet_image",),
+    "controlnet_inpaint": ("image", "mask", "controlnet_image"),
+}
+
+
+def synthetic_mix(
+    image: str = os.path.join(REPO_DIR, "image.jpg"),
+    mask: str = os.path.join(REPO_DIR, "mask.jpg"),
+    lora_weights: Optional[str] = None,
+    sizes=(768, 1024),
+    modes=tuple(MIX_MODES),
+) -> List[dict]:
+    """
+    A request mix over the `modes` of MIX_MODES, resolutions, output counts
+    and, when `lora_weights` is given, fine-tuned weights. The result cache is
+    bypassed, so repeats measure the model rather than disk reads.
+    """
+    image_uri = data_uri(image)
+    images = {"image": image_uri, "mask": data_uri(mask), "controlnet_image": image_uri}
+    base = {
+        "prompt": "A studio portrait photo of TOK",
+        "negative_prompt": "ugly, soft, blurry, out of focus, low quality",
+        "seed": 1000,
+        "bypass_result_cache": True,
+    }
+    mix = []
+    for mode, size, num_outputs in itertools.product(modes, sizes, (1, 2)):
+        inputs = dict(base, width=size, height=size, num_outputs=num_outputs)
+        inputs.update((name, images[name]) for name in MIX_MODES[mode])
+        mix.append(inputs)
+        if lora_weights:
+            mix.append(dict(inputs, lora_weights=lora_weights))
+    return mix
+
+
+def load_mix(path: str) -> List[dict]:
+    """
+    Read a recorded mix: one JSON object per line, either a prediction request
+    body with an "input" object or the inputs themselves.
+    """
+    mix = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                body = json.loads(line)
+                mix.append(body.get("input", body))
+    return mix
+
+
+def request_class(inputs: dict) -> str:
+    """
+    Class of a request for the report, e.g. "controlnet_inpaint/lora/1024x1024".
+    """
+    # the same modes as predict.input_mode, without importing the predictor
+    if inputs.get("mask"):
+        mode = "inpaint"
+    elif inputs.get("image"):
+        mode = "img2img"
+    else:
+        mode = "txt2img"
+    if inputs.get("controlnet_image"):
+        mode = "controlnet" if mode == "txt2img" else f"controlnet_{mode}"
+    weights = (
+        "lora"
+        if inputs.get("lora_weights") or inputs.get("replicate_weights")
+        else "base"
+    )
+    size = f"{inputs.get('width', 1024)}x{inputs.get('height', 1024)}"
+    return f"{mode}/{weights}/{size}"
+
+
+class LoadGenerator:
+    def __init__(self, url: str, mix: List[dict], timeout: float = 600, seed: int = 0):
+        """
+        :param url: Base url of the cog server.
+        :param mix: Request inputs, drawn uniformly at random.
+        :param timeout: Seconds before a request counts as failed.
+        :param seed: Seed for the request order and the open loop arrivals.
+        """
+        self.url = url.rstrip("/")
+        self.mix = mix
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _next_inputs(self) -> dict:
+        with self._lock:
+            return self.random.choice(self.mix)
+
+    def send(self, inputs: dict, start: Optional[float] = None) -> Result:
+        """
+        Send one prediction and time it, from `start` when given.
+        """
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        start = start if start is not None else time.time()
+        error = None
+        try:
+            response = self._local.session.post(
+                f"{self.url}/predictions", json={"input": inputs}, timeout=self.timeout
+            )
+            body = response.json()
+            if response.status_code != 200 or body.get("status") != "succeeded":
+                error = f"HTTP {response.status_code}: {body.get('error') or body.get('detail') or body.get('status')}"
+        except (requests.RequestException, ValueError) as e:
+            error = str(e)
+        return Result(
+            request_class(inputs), start, time.time() - start, error is None, error
+        )
+
+    def run_closed(
+        self, concurrency: int, num_requests: Optional[int], duration: Optional[float]
+    ) -> List[Result]:
+        """
+        Closed loop: `concurrency` clients back to back until `num_requests`
+        were sent or `duration` seconds passed.
+        """
+        results = []
+        counter = itertools.count()
+        end = time.time() + duration if duration is not None else None
+
+        def client():
+            while True:
+                if num_requests is not None and next(counter) >= num_requests:
+                    return
+                if end is not None and time.time() >= end:
+                    return
+                result = self.send(self._next_inputs())
+                with self._lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def arrivals(self, rate: float) -> Iterator[float]:
+        """
+        Poisson arrival times at `rate` per second, as offsets from now.
+        """
+        offset = 0.0
+        while True:
+            offset += self.random.expovariate(rate)
+            yield offset
+
+    def run_open(
+        self,
+        rate: float,
+        num_requests: Optional[int],
+        duration: Optional[float],
+        max_inflight: int = 256,
+    ) -> List[Result]:
+        """
+        Open loop: Poisson arrivals at `rate` per second until `num_requests`
+        were sent or `duration` seconds passed.
+        """
+        futures = []
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+            for i, offset in enumerate(self.arrivals(rate)):
+                if num_requests is not None and i >= num_requests:
+                    break
+                if duration is not None and offset >= duration:
+                    break
+                scheduled = begin + offset
+                time.sleep(max(0.0, scheduled - time.time()))
+                futures.append(
+                    executor.submit(self.send, self._next_inputs(), scheduled)
+                )
+        return [future.result() for future in futures]
+
+
+def wait_until_ready(url: str, timeout: float = 300) -> None:
+    """
+    Poll the health check of the server at `url` until it reports READY.
+    """
+    end = time.time() + timeout
+    while True:
+        try:
+            if requests.get(f"{url}/health-check").json()["status"] == "READY":
+                return
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        if time.time() > end:
+            raise TimeoutError(f"{url} did not become ready in {timeout}s")
+        time.sleep(1)
+
+
+def report(results: List[Result]) -> Dict[str, dict]:
+    """
+    Throughput and latency percentiles per request class and over all requests.
+    """
+    if not results:
+        return {}
+    begin = min(r.start for r in results)
+    wall = max(r.start + r.latency for r in results) - begin
+    classes = {"all": results}
+    for result in results:
+        classes.setdefault(result.request_class, []).append(result)
+
+    summary = {}
+    for name, class_results in sorted(classes.items()):
+        latencies = [r.latency for r in class_results if r.ok]
+        entry = {
+            "requests": len(class_results),
+            "errors": sum(not r.ok for r in class_results),
+            "throughput": len(latencies) / wall if wall > 0 else 0.0,
+        }
+        if latencies:
+            entry["mean"] = statistics.mean(latencies)
+            for q in QUANTILES:
+                entry[f"p{int(q * 100)}"] = quantile(latencies, q)
+        summary[name] = entry
+    return summary
+
+
+def print_report(summary: Dict[str, dict]) -> None:
+    print(
+        f"{'class':<40} {'requests':>8} {'errors':>6} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}"
+    )
+    for name, entry in summary.items():
+        percentiles = " ".join(
+            (
+                f"{entry[f'p{int(q * 100)}']:7.2f}s"
+                if f"p{int(q * 100)}" in entry
+                else f"{'-':>8}"
+            )
+            for q in QUANTILES
+        )
+        print(
+            f"{name:<40} {entry['requests']:>8} {entry['errors']:>6} {entry['throughput']:>7.3f} {percentiles}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Clients, closed loop"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="Requests per second, open loop"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=None, help="Stop after this many requests"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=None, help="Stop after this many seconds"
+    )
+    parser.add_argument(
+        "--mix", default=None, help="Recorded mix (JSON lines), synthetic when omitted"
+    )
+    parser.add_argument(
+        "--lora-weights",
+        default=None,
+        help="Weights url for the LoRA classes of the synthetic mix",
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MIX_MODES),
+        help="Comma separated modes of the synthetic mix, of " + ", ".join(MIX_MODES),
+    )
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        parser.error("Set --requests and/or --duration")
+
+    mix = (
+        load_mix(args.mix)
+        if args.mix
+        else synthetic_mix(lora_weights=args.lora_weights, modes=args.modes.split(","))
+    )
+    wait_until_ready(args.url.rstrip("/"))
+
+    generator = LoadGenerator(args.url, mix, args.timeout, args.seed)
+    if args.mode == "closed":
+        results = generator.run_closed(args.concurrency, args.requests, args.duration)
+    else:
+        results = generator.run_open(args.rate, args.requests, args.duration)
+
+    summary = report(results)
+    print_report(summary)
+    for error in sorted({r.error for r in results if not r.ok})[:10]:
+        print(f"Error: {error}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "report": summary}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
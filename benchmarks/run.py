@@ -0,0 +1,551 @@
+"""
+CPU benchmark of the predictor hot paths, built on the tiny random SDXL
+components from tiny_sdxl.py. No GPU, model download or network is needed.
+
+Measures, over a small parameter grid:
+- predict: end to end latency, time to first image and throughput of Predictor.generate,
+  the body of predict()
+- lora_swap: Predictor.load_trained_weights switching between two fine-tunes
+- weights_cache: WeightsDownloadCache.ensure hits, misses and misses that evict
+- preprocess: input decoding and image / mask preparation
+- quality_mode: latency of quality_mode="draft" against "full", and the PSNR
+  of the draft images against the full resolution ones
+- token_merging: latency, peak memory and PSNR of token_merging_ratio against
+  unmerged self-attention
+
+Downloads go through a local `pget` stand-in that extracts a tar from disk, so
+the weights cache and LoRA paths run unmodified.
+
+Usage, from the repository root:
+    python -m benchmarks.run --repeats 5
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+
+import argparse
+import contextlib
+import inspect
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tarfile
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.tiny_sdxl import build_pipeline, write_lora_weights
+from dataset_and_utils import prepare_image, prepare_mask
+from metrics import MemoryTracker, quantile
+from outputs import OutputEncoder
+from predict import QUALITY_MODES, Predictor
+from weights import WeightsDownloadCache
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BENCHMARKS = [
+    "predict",
+    "lora_swap",
+    "weights_cache",
+    "preprocess",
+    "quality_mode",
+    "token_merging",
+]
+
+# parameter grids, small enough for a laptop run of a few minutes
+PREDICT_GRID = {
+    "size": [64, 128],
+    "num_outputs": [1, 2],
+    "num_inference_steps": [2, 4],
+}
+PREPROCESS_SIZES = [512, 1024]
+QUALITY_SIZES = [128, 256]
+# inputs left out of the controlnet inpaint request of predict_args, by mode
+QUALITY_REQUESTS = {
+    "txt2img": {"image": None, "mask": None, "controlnet_image": None},
+    "controlnet_inpaint": {},
+}
+TOKEN_MERGING_SIZES = [128, 256]
+TOKEN_MERGING_RATIOS = [0.0, 0.25, 0.5, 0.75]
+
+# extracts the tar a "url" points to, ignoring any ?query used to make urls unique
+PGET_SCRIPT = """#!/bin/sh
+# usage: pget -x URL DEST
+src="${2%%\\?*}"
+mkdir -p "$3" && tar -xf "$src" -C "$3"
+"""
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """
+    :return: Summary statistics of repeated timings, in seconds.
+    """
+    return {
+        "n": len(seconds),
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "mean": statistics.mean(seconds),
+        "p95": quantile(seconds, 0.95),
+        "stdev": statistics.stdev(seconds) if len(seconds) > 1 else 0.0,
+        "samples": seconds,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    # the predictor logs every stage, keep it out of the benchmark output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(fn: Callable[[], None], repeats: int, warmup: int = 1) -> List[float]:
+    """
+    Time `fn` `repeats` times after `warmup` untimed calls.
+    """
+    with quiet():
+        for _ in range(warmup):
+            fn()
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def predict_defaults() -> dict:
+    """
+    The default value of every predict() input, as cog would fill them in.
+    """
+    defaults = {}
+    for name, param in inspect.signature(Predictor.predict).parameters.items():
+        if name != "self":
+            defaults[name] = getattr(param.default, "default", param.default)
+    return defaults
+
+
+class BenchmarkEnv:
+    def __init__(self, work_dir: str):
+        """
+        BenchmarkEnv holds a Predictor running the tiny pipeline on CPU, with its
+        weights cache, metrics and inputs under `work_dir`. The local pget is
+        put first on PATH until close(), use it as a context manager.
+        """
+        self.work_dir = work_dir
+        self.bin_dir = os.path.join(work_dir, "bin")
+        os.makedirs(self.bin_dir)
+        pget = os.path.join(self.bin_dir, "pget")
+        with open(pget, "w") as f:
+            f.write(PGET_SCRIPT)
+        os.chmod(pget, 0o755)
+
+        self.predictor = Predictor()
+        self.predictor.setup_runtime(
+            device="cpu",
+            weights_cache_dir=os.path.join(work_dir, "weights-cache"),
+            metrics_dir=os.path.join(work_dir, "metrics"),
+            result_cache_dir=os.path.join(work_dir, "result-cache"),
+        )
+        self.predictor.output_encoder = OutputEncoder(
+            base_dir=os.path.join(work_dir, "outputs"), spans=self.predictor.spans
+        )
+        self.predictor.controlnet_pipe = build_pipeline(work_dir)
+        self.predictor.controlnet_pipe.set_progress_bar_config(disable=True)
+        # the openpose annotator needs its real weights, the pose image is used as is
+        self.predictor.resources.register("openpose", lambda: lambda image: image)
+
+        self.lora_urls = [self.lora_tar(f"lora-{i}", seed=i) for i in range(2)]
+        self._lora_cycle = itertools.cycle(self.lora_urls)
+        self._original_procs = self.predictor.controlnet_pipe.unet.attn_processors
+
+        self._old_path = os.environ.get("PATH")
+        os.environ["PATH"] = self.bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+    def close(self) -> None:
+        """
+        Restore PATH as it was before the local pget was put first on it.
+        """
+        if self._old_path is None:
+            os.environ.pop("PATH", None)
+        else:
+            os.environ["PATH"] = self._old_path
+
+    def __enter__(self) -> "BenchmarkEnv":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def predict_args(
+        self, size: int, num_outputs: int = 1, num_inference_steps: int = 2
+    ) -> dict:
+        """
+        predict() inputs for a controlnet inpaint request on noise images.
+        """
+        args = predict_defaults()
+        args.update(
+            image=self.image("image", size),
+            mask=self.image("mask", size, "L"),
+            controlnet_image=self.image("image", size),
+            width=size,
+            height=size,
+            num_outputs=num_outputs,
+            num_inference_steps=num_inference_steps,
+            seed=1,
+            # a fixed seed would otherwise be answered from the result cache
+            bypass_result_cache=True,
+        )
+        return args
+
+    def swap_lora(self) -> None:
+        """
+        Load the next of the fine-tunes in `lora_urls`.
+        """
+        self.predictor.load_trained_weights(
+            next(self._lora_cycle), self.predictor.controlnet_pipe
+        )
+
+    def unload_lora(self) -> None:
+        """
+        Go back to the base weights. The added tokens stay, they are unused.
+        """
+        # set_attn_processor consumes the dict it is given
+        self.predictor.controlnet_pipe.unet.set_attn_processor(
+            dict(self._original_procs)
+        )
+        self.predictor.tuned_model = False
+        self.predictor.tuned_weights = None
+        self.predictor.is_lora = False
+
+    def lora_tar(self, name: str, seed: int) -> str:
+        """
+        Write a tar of tiny LoRA weights, usable as a weights url with the local pget.
+        """
+        src = write_lora_weights(
+            self.predictor.controlnet_pipe.unet,
+            os.path.join(self.work_dir, name),
+            seed=seed,
+        )
+        path = src + ".tar"
+        with tarfile.open(path, "w") as tar:
+            for file in sorted(os.listdir(src)):
+                tar.add(os.path.join(src, file), arcname=file)
+        return path
+
+    def image(self, name: str, size: int, mode: str = "RGB") -> str:
+        """
+        Write a noise image of the given size and return its path.
+        """
+        path = os.path.join(self.work_dir, f"{name}-{size}.png")
+        if not os.path.exists(path):
+            rng = np.random.default_rng(size)
+            channels = 3 if mode == "RGB" else 1
+            pixels = rng.integers(0, 256, (size, size, channels), dtype=np.uint8)
+            Image.fromarray(pixels.squeeze()).convert(mode).save(path)
+        return path
+
+
+def bench_predict(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    results = []
+    grid = PREDICT_GRID
+    for size, num_outputs, steps in itertools.product(
+        grid["size"], grid["num_outputs"], grid["num_inference_steps"]
+    ):
+        args = env.predict_args(size, num_outputs, steps)
+        first_image = []
+
+        def run():
+            start = time.perf_counter()
+            outputs = env.predictor.generate(**args)
+            next(outputs)
+            first_image.append(time.perf_counter() - start)
+            for _ in outputs:
+                pass
+
+        seconds = measure(run, repeats)
+        latency = summarize(seconds)
+        results.append(
+            {
+                "benchmark": "predict",
+                "params": {
+                    "size": size,
+                    "num_outputs": num_outputs,
+                    "num_inference_steps": steps,
+                },
+                "seconds": latency,
+                "first_image_seconds": summarize(first_image[-repeats:]),
+                "images_per_second": num_outputs / latency["median"],
+            }
+        )
+    return results
+
+
+def bench_lora_swap(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    with quiet():
+        # download both fine-tunes into the weights cache first
+        for _ in env.lora_urls:
+            env.swap_lora()
+    seconds = measure(env.swap_lora, repeats)
+    env.unload_lora()
+    return [{"benchmark": "lora_swap", "params": {}, "seconds": summarize(seconds)}]
+
+
+def bench_weights_cache(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    url = env.lora_urls[0]
+    unique = (f"{url}?v={i}" for i in itertools.count())
+    results = []
+
+    cache = WeightsDownloadCache(
+        min_disk_free=0, base_dir=os.path.join(env.work_dir, "cache-hit-miss")
+    )
+    with quiet():
+        cache.ensure(url)
+    seconds = measure(lambda: cache.ensure(url), repeats)
+    results.append(
+        {
+            "benchmark": "weights_cache",
+            "params": {"op": "hit"},
+            "seconds": summarize(seconds),
+        }
+    )
+
+    seconds = measure(lambda: cache.ensure(next(unique)), repeats)
+    results.append(
+        {
+            "benchmark": "weights_cache",
+            "params": {"op": "miss"},
+            "seconds": summarize(seconds),
+        }
+    )
+
+    # never enough space: each miss first evicts everything cached before
+    cache = WeightsDownloadCache(
+        min_disk_free=2**62, base_dir=os.path.join(env.work_dir, "cache-evict")
+    )
+    seconds = measure(lambda: cache.ensure(next(unique)), repeats)
+    results.append(
+        {
+            "benchmark": "weights_cache",
+            "params": {"op": "miss_evict"},
+            "seconds": summarize(seconds),
+        }
+    )
+    return results
+
+
+def bench_preprocess(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    try:
+        from preprocess import _center_of_mass, _crop_to_square
+    except ImportError as e:
+        # training-only dependencies such as mediapipe may be missing
+        print(f"Skipping training preprocessing stages: {e}")
+        _center_of_mass = _crop_to_square = None
+
+    pipe = env.predictor.controlnet_pipe
+    results = []
+    for size in PREPROCESS_SIZES:
+        image_path = env.image("image", size)
+        mask_path = env.image("mask", size, "L")
+        image = Image.open(image_path).convert("RGB")
+        mask = Image.open(mask_path).convert("L")
+        stages = {
+            "load_image": lambda: env.predictor.load_image(image_path),
+            "image_processor": lambda: pipe.image_processor.preprocess(
+                image, height=1024, width=1024
+            ),
+            "mask_processor": lambda: pipe.mask_processor.preprocess(
+                mask, height=1024, width=1024
+            ),
+            "prepare_image": lambda: prepare_image(image, 1024, 1024),
+            "prepare_mask": lambda: prepare_mask(mask, 1024, 1024),
+        }
+        if _center_of_mass is not None:
+            stages["center_of_mass"] = lambda: _center_of_mass(mask)
+            stages["crop_to_square"] = lambda: _crop_to_square(
+                image, (size / 2, size / 2), resize_to=1024
+            )
+        for stage, fn in stages.items():
+            results.append(
+                {
+                    "benchmark": "preprocess",
+                    "params": {"stage": stage, "size": size},
+                    "seconds": summarize(measure(fn, repeats)),
+                }
+            )
+    return results
+
+
+def psnr(image: Image.Image, reference: Image.Image) -> float:
+    error = np.mean(
+        (np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64))
+        ** 2
+    )
+    return float("inf") if error == 0 else float(10 * np.log10(255**2 / error))
+
+
+def bench_quality_mode(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    results = []
+    for mode, size in itertools.product(QUALITY_REQUESTS, QUALITY_SIZES):
+        medians = {}
+        images = {}
+        for quality_mode in QUALITY_MODES:
+            args = env.predict_args(size, num_inference_steps=4)
+            args.update(QUALITY_REQUESTS[mode], quality_mode=quality_mode)
+            outputs = []
+
+            def run():
+                outputs[:] = list(env.predictor.generate(**args))
+
+            latency = summarize(measure(run, repeats))
+            medians[quality_mode] = latency["median"]
+            images[quality_mode] = Image.open(outputs[0]).convert("RGB")
+            results.append(
+                {
+                    "benchmark": "quality_mode",
+                    "params": {"mode": mode, "size": size, "quality_mode": quality_mode},
+                    "seconds": latency,
+                    "speedup_vs_full": medians["full"] / latency["median"],
+                    # the same seed at full quality is the reference
+                    "psnr_vs_full": psnr(images[quality_mode], images["full"]),
+                }
+            )
+    return results
+
+
+def bench_token_merging(env: BenchmarkEnv, repeats: int) -> List[dict]:
+    results = []
+    # the predictor's own tracker, whose span frames nest with ours
+    tracker = env.predictor.spans.memory or MemoryTracker()
+    for size in TOKEN_MERGING_SIZES:
+        medians = {}
+        images = {}
+        for ratio in TOKEN_MERGING_RATIOS:
+            args = env.predict_args(size, num_inference_steps=4)
+            args["token_merging_ratio"] = ratio
+            outputs = []
+
+            def run():
+                outputs[:] = list(env.predictor.generate(**args))
+
+            latency = summarize(measure(run, repeats))
+            medians[ratio] = latency["median"]
+            images[ratio] = Image.open(outputs[0]).convert("RGB")
+            # one more run for the peaks, the allocator is warm by now
+            frame = tracker.begin()
+            with quiet():
+                run()
+            memory = tracker.end(frame)
+            results.append(
+                {
+                    "benchmark": "token_merging",
+                    "params": {"size": size, "token_merging_ratio": ratio},
+                    "seconds": latency,
+                    "speedup_vs_unmerged": medians[0.0] / latency["median"],
+                    "psnr_vs_unmerged": psnr(images[ratio], images[0.0]),
+                    "rss_peak_growth": memory["rss_peak"] - frame.rss_begin
+                    if memory["rss_peak"] is not None
+                    else None,
+                    "cuda_peak_allocated": memory.get("cuda_peak_allocated"),
+                }
+            )
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(benchmarks: List[str], repeats: int, work_dir: str) -> dict:
+    """
+    Run the given benchmarks and return the results document.
+    """
+    runners = {
+        "predict": bench_predict,
+        "lora_swap": bench_lora_swap,
+        "weights_cache": bench_weights_cache,
+        "preprocess": bench_preprocess,
+        "quality_mode": bench_quality_mode,
+        "token_merging": bench_token_merging,
+    }
+    results = []
+    with BenchmarkEnv(work_dir) as env:
+        for name in benchmarks:
+            start = time.time()
+            results += runners[name](env, repeats)
+            print(f"{name} took {time.time() - start:.1f}s")
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.time(),
+            "repeats": repeats,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--benchmarks",
+        default=",".join(BENCHMARKS),
+        help="Comma separated subset of " + ", ".join(BENCHMARKS),
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    parser.add_argument(
+        "--output", default=None, help="Results file, defaults to results/<commit>.json"
+    )
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(",")
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}, expected one of {BENCHMARKS}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        report = run(benchmarks, args.repeats, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{report['meta']['commit']}.json"
+    )
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in report["results"]:
+        params = " ".join(f"{k}={v}" for k, v in result["params"].items())
+        print(
+            f"{result['benchmark']:<14} {params:<48} median {result['seconds']['median'] * 1000:9.2f}ms"
+        )
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Tiny, randomly initialized stand-ins for the SDXL ControlNet inpaint pipeline
+and for the fine-tuned weights predict.py loads.
+
+The components keep the SDXL architecture (two CLIP text encoders, text_time
+added conditioning, 9 channel inpaint UNet, ControlNet, 4 channel VAE) at a
+size that runs a denoising step in milliseconds on CPU, so the code paths
+around them can be timed on any machine.
+"""
+
+import json
+import os
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    ControlNetModel,
+    LCMScheduler,
+    StableDiffusionXLControlNetInpaintPipeline,
+    UNet2DConditionModel,
+)
+from diffusers.models.attention_processor import LoRAAttnProcessor2_0
+from safetensors.torch import save_file
+from transformers import (
+    CLIPTextConfig,
+    CLIPTextModel,
+    CLIPTextModelWithProjection,
+    CLIPTokenizer,
+)
+
+from dataset_and_utils import unet_attn_processors_state_dict
+
+HIDDEN_SIZE = 32
+CROSS_ATTENTION_DIM = 2 * HIDDEN_SIZE
+
+UNET_CONFIG = {
+    "block_out_channels": (32, 64),
+    "layers_per_block": 2,
+    "down_block_types": ("DownBlock2D", "CrossAttnDownBlock2D"),
+    "attention_head_dim": (2, 4),
+    "use_linear_projection": True,
+    "addition_embed_type": "text_time",
+    "addition_time_embed_dim": 8,
+    "transformer_layers_per_block": (1, 2),
+    # 6 time ids * addition_time_embed_dim + pooled text_encoder_2 output
+    "projection_class_embeddings_input_dim": 6 * 8 + HIDDEN_SIZE,
+    "cross_attention_dim": CROSS_ATTENTION_DIM,
+}
+
+
+def build_tokenizer(dest_dir: str) -> CLIPTokenizer:
+    """
+    A character level CLIP tokenizer over a-z, written to `dest_dir`.
+    """
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for c in map(chr, range(ord("a"), ord("z") + 1)):
+        vocab[c] = len(vocab)
+        vocab[c + "</w>"] = len(vocab)
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    vocab_file = os.path.join(dest_dir, "vocab.json")
+    merges_file = os.path.join(dest_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_file, merges_file, pad_token="!", model_max_length=77)
+
+
+def build_pipeline(
+    work_dir: str, seed: int = 0, in_channels: int = 9
+) -> StableDiffusionXLControlNetInpaintPipeline:
+    """
+    Build the tiny pipeline, in float32 on CPU.
+
+    :param work_dir: Directory for the tokenizer files.
+    :param seed: Seed for the random weights.
+    :param in_channels: 9 for an inpainting UNet, 4 for a regular one.
+    """
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=in_channels,
+        out_channels=4,
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        **UNET_CONFIG,
+    )
+    controlnet = ControlNetModel(
+        in_channels=4, conditioning_embedding_out_channels=(16, 32), **UNET_CONFIG
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 2,
+        up_block_types=["UpDecoderBlock2D"] * 2,
+        latent_channels=4,
+        sample_size=128,
+    )
+
+    tokenizer = build_tokenizer(os.path.join(work_dir, "tokenizer"))
+    tokenizer_2 = build_tokenizer(os.path.join(work_dir, "tokenizer_2"))
+    text_config = CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=2,
+        hidden_size=HIDDEN_SIZE,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=len(tokenizer),
+        hidden_act="gelu",
+        projection_dim=HIDDEN_SIZE,
+    )
+    return StableDiffusionXLControlNetInpaintPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer_2,
+        unet=unet,
+        controlnet=controlnet,
+        scheduler=LCMScheduler(),
+        add_watermarker=False,
+    )
+
+
+def write_lora_weights(
+    unet: UNet2DConditionModel,
+    dest_dir: str,
+    rank: int = 4,
+    num_tokens: int = 2,
+    seed: int = 0,
+) -> str:
+    """
+    Write fine-tuned LoRA weights for `unet` in the layout load_trained_weights expects:
+    lora.safetensors, embeddings.pti and special_params.json.
+
+    :param unet: The UNet the LoRA targets, its attention processors are left untouched.
+    :param dest_dir: Directory to write to.
+    :param rank: LoRA rank.
+    :param num_tokens: Number of new <s{i}> tokens.
+    :param seed: Seed for the random weights.
+    :return: dest_dir.
+    """
+    torch.manual_seed(seed)
+    original_procs = unet.attn_processors
+    lora_procs = {}
+    for name in original_procs:
+        cross_attention_dim = (
+            None
+            if name.endswith("attn1.processor")
+            else unet.config.cross_attention_dim
+        )
+        if name.startswith("mid_block"):
+            hidden_size = unet.config.block_out_channels[-1]
+        elif name.startswith("up_blocks"):
+            block_id = int(name[len("up_blocks.")])
+            hidden_size = list(reversed(unet.config.block_out_channels))[block_id]
+        else:
+            block_id = int(name[len("down_blocks.")])
+            hidden_size = unet.config.block_out_channels[block_id]
+        lora_procs[name] = LoRAAttnProcessor2_0(
+            hidden_size=hidden_size, cross_attention_dim=cross_attention_dim, rank=rank
+        )
+        # the up projections start at zero, make the LoRA actually change the output
+        for param in lora_procs[name].parameters():
+            torch.nn.init.normal_(param, std=0.01)
+
+    unet.set_attn_processor(lora_procs)
+    tensors = unet_attn_processors_state_dict(unet)
+    unet.set_attn_processor(original_procs)
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    save_file(
+        {k: v.contiguous() for k, v in tensors.items()},
+        os.path.join(dest_dir, "lora.safetensors"),
+    )
+    save_file(
+        {
+            f"text_encoders_{i}": torch.randn(num_tokens, HIDDEN_SIZE) * 0.01
+            for i in range(2)
+        },
+        os.path.join(dest_dir, "embeddings.pti"),
+    )
+    with open(os.path.join(dest_dir, "special_params.json"), "w") as f:
+        json.dump({"TOK": "".join(f"<s{i}>" for i in range(num_tokens))}, f)
+    return dest_dir
@@ -0,0 +1,27 @@
+from typing import Callable, List, Optional
+
+# callback_on_step_end(pipe, step, timestep, callback_kwargs) -> callback_kwargs
+StepCallback = Callable[..., dict]
+
+
+class StepCallbacks:
+    def __init__(self, callbacks: Optional[List[StepCallback]] = None):
+        """
+        StepCallbacks chains several `callback_on_step_end` hooks into one, since
+        diffusers pipelines only accept a single callback. Each hook receives
+        the callback_kwargs returned by the previous one.
+
+        :param callbacks: Initial list of hooks, called in order.
+        """
+        self.callbacks = list(callbacks or [])
+
+    def append(self, callback: StepCallback) -> None:
+        self.callbacks.append(callback)
+
+    def __bool__(self) -> bool:
+        return len(self.callbacks) > 0
+
+    def __call__(self, pipe, step: int, timestep: int, callback_kwargs: dict) -> dict:
+        for callback in self.callbacks:
+            callback_kwargs = callback(pipe, step, timestep, callback_kwargs)
+        return callback_kwargs
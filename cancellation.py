@@ -0,0 +1,44 @@
+import threading
+from typing import Optional
+
+
+class PredictionCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self):
+        """
+        CancellationToken is a thread-safe flag that a running prediction checks
+        at each denoising step and between post-processing stages.
+
+        It doubles as a `callback_on_step_end` hook so that the pipeline aborts
+        at the next step boundary once cancel() has been called.
+        """
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """
+        Request cancellation. Safe to call from any thread, more than once.
+
+        :param reason: Why the prediction is cancelled, reported in the exception.
+        """
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        """
+        Raise PredictionCancelled if cancel() has been called.
+        """
+        if self._event.is_set():
+            raise PredictionCancelled(self.reason)
+
+    def __call__(self, pipe, step: int, timestep: int, callback_kwargs: dict) -> dict:
+        self.raise_if_cancelled()
+        return callback_kwargs
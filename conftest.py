@@ -0,0 +1,46 @@
+# Options of the performance regression gate in tests/test_performance.py.
+# Living at the repository root also puts the root on sys.path for the tests.
+
+import os
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("perf", "performance regression gate")
+    group.addoption(
+        "--perf-baseline",
+        default=os.environ.get(
+            "PERF_BASELINE",
+            os.path.join(os.path.dirname(__file__), "benchmarks", "baseline.json"),
+        ),
+        help="Baseline timings and allocations to compare against, tracked in git",
+    )
+    group.addoption(
+        "--perf-skip",
+        action="store_true",
+        default=os.environ.get("PERF_SKIP", "") not in ("", "0"),
+        help="Skip the whole gate, stages without a matching baseline are skipped anyway",
+    )
+    group.addoption(
+        "--perf-update-baseline",
+        action="store_true",
+        default=False,
+        help="Record the measurements as the new baseline instead of comparing",
+    )
+    group.addoption(
+        "--perf-tolerance",
+        type=float,
+        default=float(os.environ.get("PERF_TOLERANCE", 0.25)),
+        help="Allowed relative slowdown of a stage's median time",
+    )
+    group.addoption(
+        "--perf-alloc-tolerance",
+        type=float,
+        default=float(os.environ.get("PERF_ALLOC_TOLERANCE", 0.1)),
+        help="Allowed relative growth of a stage's Python allocations",
+    )
+    group.addoption(
+        "--perf-repeats",
+        type=int,
+        default=int(os.environ.get("PERF_REPEATS", 7)),
+        help="Timed runs per stage",
+    )
@@ -0,0 +1,261 @@
+from collections import deque
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Starting points for an fp16 SDXL worker, replaced by fitted values once observed.
+DEFAULT_OVERHEAD_SECONDS = 0.5
+DEFAULT_STEP_SECONDS_PER_MEGAPIXEL = 0.09
+DEFAULT_CONTROLNET_STEP_SECONDS_PER_MEGAPIXEL = 0.12
+DEFAULT_DECODE_SECONDS_PER_MEGAPIXEL = 0.15
+DEFAULT_LORA_LOAD_SECONDS = 3.0
+
+# Degradation limits when planning for a deadline
+MIN_DEADLINE_STEPS = 2
+DEADLINE_SCALES = (1.0, 0.875, 0.75, 0.625, 0.5)
+
+
+class Plan(NamedTuple):
+    num_inference_steps: int
+    width: int
+    height: int
+    estimate: float
+
+    def degraded(self, num_inference_steps: int, width: int, height: int) -> bool:
+        return (self.num_inference_steps, self.width, self.height) != (
+            num_inference_steps,
+            width,
+            height,
+        )
+
+
+class Observation(NamedTuple):
+    width: int
+    height: int
+    num_outputs: int
+    steps: int
+    controlnet: bool
+    denoise_seconds: float
+    decode_seconds: float
+    lora_seconds: Optional[float]
+    overhead_seconds: Optional[float]
+
+
+def denoising_steps(num_inference_steps: int, strength: float = 1.0) -> int:
+    """
+    Number of steps the img2img / inpaint pipelines actually run for a given strength.
+    """
+    return max(1, min(int(num_inference_steps * strength), num_inference_steps))
+
+
+def _fit_through_origin(xs, ys) -> Optional[float]:
+    # least squares for y = c * x
+    xx = sum(x * x for x in xs)
+    if xx == 0:
+        return None
+    return sum(x * y for x, y in zip(xs, ys)) / xx
+
+
+class LatencyCostModel:
+    def __init__(
+        self,
+        overhead_seconds: float = DEFAULT_OVERHEAD_SECONDS,
+        step_seconds_per_megapixel: float = DEFAULT_STEP_SECONDS_PER_MEGAPIXEL,
+        controlnet_step_seconds_per_megapixel: float = DEFAULT_CONTROLNET_STEP_SECONDS_PER_MEGAPIXEL,
+        decode_seconds_per_megapixel: float = DEFAULT_DECODE_SECONDS_PER_MEGAPIXEL,
+        lora_load_seconds: float = DEFAULT_LORA_LOAD_SECONDS,
+        smoothing: float = 0.2,
+        history: int = 256,
+    ):
+        """
+        LatencyCostModel estimates how long a prediction takes from its inputs.
+
+        The cost of a prediction is split in stages: a fixed overhead, one
+        denoising step per image (with or without ControlNet), one VAE decode
+        per image and, when the requested weights are not loaded yet, a LoRA load.
+
+        Step and decode costs are kept per shape with an exponential moving
+        average once a shape has been observed. Unseen shapes are extrapolated
+        with per-megapixel coefficients, which are fitted by least squares on
+        the most recent `history` observations. Overhead and LoRA load times are
+        moving averages as well.
+
+        :param overhead_seconds: Fixed cost per prediction (text encode, input decode, ...).
+        :param step_seconds_per_megapixel: Cost of one denoising step of one image per megapixel.
+        :param controlnet_step_seconds_per_megapixel: Same, with the ControlNet forward.
+        :param decode_seconds_per_megapixel: Cost of decoding one image per megapixel.
+        :param lora_load_seconds: Cost of loading fine-tuned weights.
+        :param smoothing: Weight of a new observation in the moving averages.
+        :param history: Number of observations kept for fitting.
+        """
+        self.overhead_seconds = overhead_seconds
+        self.step_seconds_per_megapixel = {
+            False: step_seconds_per_megapixel,
+            True: controlnet_step_seconds_per_megapixel,
+        }
+        self.decode_seconds_per_megapixel = decode_seconds_per_megapixel
+        self.lora_load_seconds = lora_load_seconds
+        self.smoothing = smoothing
+        self.step_seconds: Dict[Tuple[int, int, bool], float] = {}
+        self.decode_seconds: Dict[Tuple[int, int], float] = {}
+        self.observations = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        if old is None:
+            return new
+        return (1 - self.smoothing) * old + self.smoothing * new
+
+    def shape_costs(
+        self, width: int, height: int, controlnet: bool = True
+    ) -> Tuple[float, float]:
+        """
+        :return: (seconds per image step, seconds per image decode) for a shape.
+        """
+        megapixels = width * height / 1e6
+        step = self.step_seconds.get(
+            (width, height, controlnet),
+            self.step_seconds_per_megapixel[controlnet] * megapixels,
+        )
+        decode = self.decode_seconds.get(
+            (width, height), self.decode_seconds_per_megapixel * megapixels
+        )
+        return step, decode
+
+    def estimate(
+        self,
+        width: int,
+        height: int,
+        num_outputs: int = 1,
+        num_inference_steps: int = 6,
+        strength: float = 1.0,
+        controlnet: bool = True,
+        lora_load: bool = False,
+    ) -> float:
+        """
+        Estimate the latency of a prediction in seconds.
+
+        :param controlnet: Whether the ControlNet runs at every step.
+        :param lora_load: Whether fine-tuned weights have to be loaded first.
+        """
+        step, decode = self.shape_costs(width, height, controlnet)
+        steps = denoising_steps(num_inference_steps, strength)
+        estimate = self.overhead_seconds + num_outputs * (steps * step + decode)
+        if lora_load:
+            estimate += self.lora_load_seconds
+        return estimate
+
+    def observe(
+        self,
+        width: int,
+        height: int,
+        num_outputs: int,
+        steps: int,
+        denoise_seconds: float,
+        decode_seconds: float,
+        total_seconds: Optional[float] = None,
+        controlnet: bool = True,
+        lora_seconds: Optional[float] = None,
+    ) -> None:
+        """
+        Update the model with the stage timings of a finished prediction.
+
+        :param steps: Denoising steps actually run, see denoising_steps().
+        :param denoise_seconds: Time spent in the denoising loops.
+        :param decode_seconds: Time spent decoding latents.
+        :param total_seconds: Wall time of the whole prediction, updates the overhead.
+        :param controlnet: Whether the ControlNet ran.
+        :param lora_seconds: Time spent loading fine-tuned weights, if they were loaded.
+        """
+        overhead = None
+        if total_seconds is not None:
+            overhead = max(
+                0.0,
+                total_seconds - denoise_seconds - decode_seconds - (lora_seconds or 0.0),
+            )
+
+        with self._lock:
+            self.step_seconds[(width, height, controlnet)] = self._ewma(
+                self.step_seconds.get((width, height, controlnet)),
+                denoise_seconds / (num_outputs * steps),
+            )
+            self.decode_seconds[(width, height)] = self._ewma(
+                self.decode_seconds.get((width, height)), decode_seconds / num_outputs
+            )
+            if overhead is not None:
+                self.overhead_seconds = self._ewma(self.overhead_seconds, overhead)
+            if lora_seconds is not None:
+                self.lora_load_seconds = self._ewma(self.lora_load_seconds, lora_seconds)
+
+            self.observations.append(
+                Observation(
+                    width,
+                    height,
+                    num_outputs,
+                    steps,
+                    controlnet,
+                    denoise_seconds,
+                    decode_seconds,
+                    lora_seconds,
+                    overhead,
+                )
+            )
+            self._fit()
+
+    def _fit(self) -> None:
+        for controlnet in (False, True):
+            samples = [o for o in self.observations if o.controlnet == controlnet]
+            coefficient = _fit_through_origin(
+                [o.num_outputs * o.steps * o.width * o.height / 1e6 for o in samples],
+                [o.denoise_seconds for o in samples],
+            )
+            if coefficient is not None:
+                self.step_seconds_per_megapixel[controlnet] = coefficient
+
+        coefficient = _fit_through_origin(
+            [o.num_outputs * o.width * o.height / 1e6 for o in self.observations],
+            [o.decode_seconds for o in self.observations],
+        )
+        if coefficient is not None:
+            self.decode_seconds_per_megapixel = coefficient
+
+    def plan_for_deadline(
+        self,
+        deadline: float,
+        width: int,
+        height: int,
+        num_outputs: int = 1,
+        num_inference_steps: int = 6,
+        strength: float = 1.0,
+        controlnet: bool = True,
+    ) -> Plan:
+        """
+        Pick the number of steps and the internal resolution that fit a deadline.
+
+        Steps are lowered first, down to MIN_DEADLINE_STEPS. If that is not enough
+        the resolution is scaled down along DEADLINE_SCALES, in multiples of 64
+        pixels, keeping as many steps as fit at each scale. When nothing fits the
+        cheapest plan is returned.
+
+        :param deadline: Seconds available for the prediction.
+        :return: The chosen Plan.
+        """
+        min_steps = min(MIN_DEADLINE_STEPS, num_inference_steps)
+        plan = None
+        seen = set()
+        for scale in DEADLINE_SCALES:
+            scaled = (
+                max(64, int(width * scale) // 64 * 64) if scale < 1 else width,
+                max(64, int(height * scale) // 64 * 64) if scale < 1 else height,
+            )
+            if scaled in seen:
+                continue
+            seen.add(scaled)
+
+            for steps in range(num_inference_steps, min_steps - 1, -1):
+                estimate = self.estimate(
+                    *scaled, num_outputs, steps, strength, controlnet
+                )
+                plan = Plan(steps, scaled[0], scaled[1], estimate)
+                if estimate <= deadline:
+                    return plan
+        return plan
@@ -13,6 +13,8 @@ from safetensors.torch import save_file
 from torch.utils.data import Dataset
 from transformers import AutoTokenizer, PretrainedConfig
 
+from safetensors_loader import load_model
+
 
 def prepare_image(
     pil_image: PIL.Image.Image, w: int = 512, h: int = 512
@@ -233,29 +235,46 @@ def load_models(pretrained_model_name_or_path, revision, device, weight_dtype):
     text_encoder_cls_two = import_model_class_from_model_name_or_path(
         pretrained_model_name_or_path, revision, subfolder="text_encoder_2"
     )
-    text_encoder_one = text_encoder_cls_one.from_pretrained(
-        pretrained_model_name_or_path, subfolder="text_encoder", revision=revision
+    # built on the meta device and read by a pool of threads, in their final
+    # dtype, straight to the device
+    text_encoder_one = load_model(
+        text_encoder_cls_one,
+        pretrained_model_name_or_path,
+        subfolder="text_encoder",
+        device=device,
+        dtype=weight_dtype,
+        revision=revision,
     )
-    text_encoder_two = text_encoder_cls_two.from_pretrained(
-        pretrained_model_name_or_path, subfolder="text_encoder_2", revision=revision
+    text_encoder_two = load_model(
+        text_encoder_cls_two,
+        pretrained_model_name_or_path,
+        subfolder="text_encoder_2",
+        device=device,
+        dtype=weight_dtype,
+        revision=revision,
     )
 
-    vae = AutoencoderKL.from_pretrained(
-        pretrained_model_name_or_path, subfolder="vae", revision=revision
+    vae = load_model(
+        AutoencoderKL,
+        pretrained_model_name_or_path,
+        subfolder="vae",
+        device=device,
+        dtype=torch.float32,
+        revision=revision,
     )
-    unet = UNet2DConditionModel.from_pretrained(
-        pretrained_model_name_or_path, subfolder="unet", revision=revision
+    unet = load_model(
+        UNet2DConditionModel,
+        pretrained_model_name_or_path,
+        subfolder="unet",
+        device=device,
+        dtype=weight_dtype,
+        revision=revision,
     )
 
     vae.requires_grad_(False)
     text_encoder_one.requires_grad_(False)
     text_encoder_two.requires_grad_(False)
 
-    unet.to(device, dtype=weight_dtype)
-    vae.to(device, dtype=torch.float32)
-    text_encoder_one.to(device, dtype=weight_dtype)
-    text_encoder_two.to(device, dtype=weight_dtype)
-
     return (
         tokenizer_one,
         tokenizer_two,
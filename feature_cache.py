@@ -0,0 +1,108 @@
+import contextlib
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+from tiled_diffusion import patch_forward
+
+# down and up blocks at the edges of the UNet that run at every step
+FEATURE_CACHE_DEPTH = 1
+
+
+class FeatureCache:
+    def __init__(self, interval: int, depth: int = FEATURE_CACHE_DEPTH):
+        """
+        FeatureCache reuses the deep features of the UNet across denoising
+        steps, as in DeepCache. Every `interval` steps the UNet runs in full
+        and the outputs of its deep blocks are kept: the down blocks after the
+        first `depth`, the mid block and the up blocks but the last `depth`. In
+        between, those blocks return the kept outputs, so only the shallow
+        blocks at full resolution run, on top of the features of the last full
+        step.
+
+        The ControlNet's deep blocks are reused the same way. The residuals
+        it adds to the shallow blocks are computed fresh at every step, the
+        ones for the deep blocks would only feed the reused features. LoRA
+        processors live inside the blocks and take part in every full step.
+
+        Steps are told apart by their timestep, several calls in one step,
+        e.g. for the tiles of TiledDiffusion, each get their own features.
+
+        :param interval: Run the full UNet every this many steps, 1 always does.
+        :param depth: Number of shallow down and up blocks that always run.
+        """
+        self.interval = interval
+        self.depth = depth
+        self.steps = 0
+        self.full_steps = 0
+        self._features: Dict[Tuple, Any] = {}
+        self._timestep: Optional[float] = None
+        self._calls: Dict[str, int] = {}
+        self._slot: Tuple[str, int] = ("", 0)
+        self._full = True
+
+    @contextlib.contextmanager
+    def apply(self, pipe):
+        """
+        Reuse features in the UNet and ControlNet of `pipe` while in the context,
+        for one pipeline call. Enter it before TiledDiffusion.apply, so that
+        every tile is a call of its own.
+        """
+        if self.interval <= 1:
+            yield
+            return
+        self._features = {}
+        self._timestep = None
+        self.steps = self.full_steps = 0
+        models = {"unet": pipe.unet}
+        if getattr(pipe, "controlnet", None) is not None:
+            models["controlnet"] = pipe.controlnet
+        with contextlib.ExitStack() as stack:
+            for name, model in models.items():
+                stack.enter_context(
+                    patch_forward(model, lambda forward, name=name: self._track(name, forward))
+                )
+                blocks = [f"down_blocks.{i}" for i in range(self.depth, len(model.down_blocks))]
+                blocks.append("mid_block")
+                if name == "unet":
+                    blocks += [
+                        f"up_blocks.{i}" for i in range(len(model.up_blocks) - self.depth)
+                    ]
+                for block in blocks:
+                    stack.enter_context(
+                        patch_forward(
+                            model.get_submodule(block),
+                            lambda forward, key=(name, block): self._cached(key, forward),
+                        )
+                    )
+            try:
+                yield
+            finally:
+                self._features = {}
+                print(f"Reused deep features on {self.steps - self.full_steps} of {self.steps} steps")
+
+    def _track(self, name, forward):
+        def tracked(sample, timestep, *args, **kwargs):
+            value = timestep.flatten()[0] if isinstance(timestep, torch.Tensor) else timestep
+            if float(value) != self._timestep:
+                # a new step
+                self._timestep = float(value)
+                self._full = self.steps % self.interval == 0
+                self._calls = {}
+                self.steps += 1
+                self.full_steps += self._full
+            index = self._calls.get(name, 0)
+            self._calls[name] = index + 1
+            self._slot = (name, index)
+            return forward(sample, timestep, *args, **kwargs)
+
+        return tracked
+
+    def _cached(self, block, forward):
+        def cached(*args, **kwargs):
+            key = (self._slot, block)
+            if self._full or key not in self._features:
+                self._features[key] = forward(*args, **kwargs)
+            return self._features[key]
+
+        return cached
@@ -0,0 +1,357 @@
+from collections import deque
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+import torch
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "/tmp/metrics")
+QUANTILES = (0.5, 0.95, 0.99)
+
+# spans.jsonl is rotated to spans.jsonl.1 beyond this size, so at most twice it is kept
+SPANS_MAX_BYTES = int(os.environ.get("SPANS_MAX_BYTES", 64 * 2**20))
+
+# whether predictions record a denoise_step span per step, the bulk of spans.jsonl
+STEP_SPANS = os.environ.get("STEP_SPANS", "1") != "0"
+
+
+class Span:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.seconds: Optional[float] = None
+        self.memory: Dict[str, Optional[float]] = {}
+        self.frame: Optional["MemoryFrame"] = None
+        self.perf_start = time.perf_counter()
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "seconds": self.seconds,
+            **self.memory,
+            **self.attrs,
+        }
+
+
+def _read_proc_status() -> Tuple[Optional[int], Optional[int]]:
+    # (VmRSS, VmHWM) in bytes, None where /proc is not available
+    rss = hwm = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    hwm = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss, hwm
+
+
+def _reset_rss_peak() -> bool:
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryFrame:
+    def __init__(self, rss: Optional[int], hwm: Optional[int]):
+        self.rss_begin = rss
+        self.hwm_begin = hwm
+        self.rss_peak = rss
+        self.cuda_peak: Optional[int] = None
+
+
+class MemoryTracker:
+    def __init__(self):
+        """
+        MemoryTracker measures peak host RSS and, when a GPU is present, peak
+        CUDA allocator memory between begin() and end().
+
+        Both peaks are process-wide counters that begin() resets, so nested or
+        overlapping frames first absorb the peak reached so far before a reset.
+        Each frame therefore reports the peak over its own lifetime. Where VmHWM
+        cannot be reset, a frame only sees RSS peaks above the process high-water mark.
+        """
+        self.cuda = torch.cuda.is_available()
+        self.can_reset_rss = _reset_rss_peak()
+        self.active = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _absorb(self) -> Tuple[Optional[int], Optional[int]]:
+        rss, hwm = _read_proc_status()
+        cuda_peak = torch.cuda.max_memory_allocated() if self.cuda else None
+        for frame in self.active:
+            if hwm is not None and (self.can_reset_rss or hwm > frame.hwm_begin):
+                frame.rss_peak = max(frame.rss_peak, hwm)
+            if rss is not None:
+                frame.rss_peak = max(frame.rss_peak, rss)
+            if cuda_peak is not None:
+                frame.cuda_peak = max(frame.cuda_peak or 0, cuda_peak)
+        return rss, hwm
+
+    def begin(self) -> MemoryFrame:
+        with self._lock:
+            self._absorb()
+            if self.cuda:
+                torch.cuda.reset_peak_memory_stats()
+            if self.can_reset_rss:
+                _reset_rss_peak()
+            frame = MemoryFrame(*_read_proc_status())
+            if self.cuda:
+                frame.cuda_peak = torch.cuda.memory_allocated()
+            self.active.add(frame)
+        return frame
+
+    def end(self, frame: MemoryFrame) -> Dict[str, Optional[float]]:
+        """
+        :return: Peak and current memory of the frame, in bytes.
+        """
+        with self._lock:
+            rss, _ = self._absorb()
+            self.active.discard(frame)
+
+        stats = {"rss": rss, "rss_peak": frame.rss_peak}
+        if self.cuda:
+            allocated = torch.cuda.memory_allocated()
+            reserved = torch.cuda.memory_reserved()
+            stats.update(
+                {
+                    "cuda_peak_allocated": frame.cuda_peak,
+                    "cuda_allocated": allocated,
+                    "cuda_reserved": reserved,
+                    # share of reserved memory the caching allocator holds but cannot hand out
+                    "cuda_fragmentation": (reserved - allocated) / reserved
+                    if reserved
+                    else 0.0,
+                }
+            )
+        return stats
+
+
+def quantile(values, q: float) -> float:
+    """
+    Nearest-rank quantile of a non-empty sequence.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class SpanRecorder:
+    def __init__(
+        self,
+        metrics_dir: str = METRICS_DIR,
+        window: int = 1024,
+        track_memory: bool = True,
+        max_bytes: int = SPANS_MAX_BYTES,
+    ):
+        """
+        SpanRecorder times the stages of setup, predict and training.
+
+        Every finished span is appended as a JSON line to `spans.jsonl`, together
+        with its peak host RSS and, on GPU hosts, its peak allocated, allocated
+        and reserved CUDA memory and allocator fragmentation. Once the file grows
+        beyond `max_bytes` it replaces `spans.jsonl.1` and a new one is started,
+        so a long running worker keeps a bounded history. flush() rewrites
+        `metrics.prom`, a Prometheus text file with a summary per stage: p50/p95/p99
+        over the last `window` spans plus running sum and count, and the
+        largest memory peaks over that window.
+
+        :param metrics_dir: Directory for spans.jsonl and metrics.prom.
+        :param window: Number of recent spans per stage used for the aggregates.
+        :param track_memory: Whether to record memory peaks of spans.
+        :param max_bytes: Size of spans.jsonl that triggers a rotation.
+        """
+        self.metrics_dir = metrics_dir
+        self.window = window
+        self.max_bytes = max_bytes
+        self.memory = MemoryTracker() if track_memory else None
+        self.recent: Dict[str, deque] = {}
+        self.recent_memory: Dict[str, deque] = {}
+        self.sums: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        self._spans_path = os.path.join(metrics_dir, "spans.jsonl")
+        self._spans_file = open(self._spans_path, "a", buffering=1)
+        self._spans_bytes = self._spans_file.tell()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Time the body of a with-statement as a span.
+
+        The span is only recorded when the body finishes without an exception.
+        Its duration is available as `span.seconds` after the block.
+
+        :param name: Stage name.
+        :param attrs: Extra fields for the JSON line, e.g. request or step.
+        """
+        span = self.start(name, **attrs)
+        try:
+            # labels the stage in torch.profiler traces, close to free otherwise
+            with torch.profiler.record_function(name):
+                yield span
+        except BaseException:
+            self.discard(span)
+            raise
+        self.finish(span)
+
+    def start(self, name: str, **attrs) -> Span:
+        """
+        Start a span that is ended with finish() or discard(), for stages that
+        do not fit a with-statement.
+        """
+        span = Span(name, attrs)
+        span.frame = self.memory.begin() if self.memory is not None else None
+        span.perf_start = time.perf_counter()
+        return span
+
+    def finish(self, span: Span) -> Span:
+        """
+        End a span from start() and record it.
+        """
+        self.discard(span)
+        self._record(span)
+        return span
+
+    def discard(self, span: Span) -> None:
+        """
+        End a span from start() without recording it.
+        """
+        span.seconds = time.perf_counter() - span.perf_start
+        if span.frame is not None:
+            span.memory = self.memory.end(span.frame)
+            span.frame = None
+
+    def record(self, name: str, seconds: float, **attrs) -> Span:
+        """
+        Record a span that was timed elsewhere and ended now.
+        """
+        span = Span(name, attrs)
+        span.start -= seconds
+        span.seconds = seconds
+        self._record(span)
+        return span
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            if span.name not in self.recent:
+                self.recent[span.name] = deque(maxlen=self.window)
+                self.recent_memory[span.name] = deque(maxlen=self.window)
+                self.sums[span.name] = 0.0
+                self.counts[span.name] = 0
+            self.recent[span.name].append(span.seconds)
+            if span.memory:
+                self.recent_memory[span.name].append(span.memory)
+            self.sums[span.name] += span.seconds
+            self.counts[span.name] += 1
+            line = json.dumps(span.as_dict()) + "\n"
+            if self._spans_bytes and self._spans_bytes + len(line) > self.max_bytes:
+                self._spans_file.close()
+                os.replace(self._spans_path, self._spans_path + ".1")
+                self._spans_file = open(self._spans_path, "a", buffering=1)
+                self._spans_bytes = 0
+            self._spans_file.write(line)
+            self._spans_bytes += len(line)
+
+    def quantiles(self, name: str) -> Dict[float, float]:
+        """
+        :return: QUANTILES of the recent durations of a stage, in seconds.
+        """
+        with self._lock:
+            values = list(self.recent.get(name, ()))
+        if not values:
+            return {}
+        return {q: quantile(values, q) for q in QUANTILES}
+
+    def memory_peaks(self, name: str) -> Dict[str, float]:
+        """
+        :return: Largest rss_peak / cuda_peak_allocated over the recent spans of a stage.
+        """
+        with self._lock:
+            recent = list(self.recent_memory.get(name, ()))
+        peaks = {}
+        for key in ("rss_peak", "cuda_peak_allocated"):
+            values = [m[key] for m in recent if m.get(key) is not None]
+            if values:
+                peaks[key] = max(values)
+        return peaks
+
+    def prometheus(self) -> str:
+        """
+        Render all stages in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP predictor_stage_seconds Duration of setup and predict stages.",
+            "# TYPE predictor_stage_seconds summary",
+        ]
+        for name in sorted(self.recent):
+            for q, value in self.quantiles(name).items():
+                lines.append(
+                    f'predictor_stage_seconds{{stage="{name}",quantile="{q}"}} {value:.6f}'
+                )
+            lines.append(
+                f'predictor_stage_seconds_sum{{stage="{name}"}} {self.sums[name]:.6f}'
+            )
+            lines.append(
+                f'predictor_stage_seconds_count{{stage="{name}"}} {self.counts[name]}'
+            )
+        lines += [
+            "# HELP predictor_stage_peak_bytes Largest memory peak of a stage over the recent window.",
+            "# TYPE predictor_stage_peak_bytes gauge",
+        ]
+        for name in sorted(self.recent):
+            for key, value in self.memory_peaks(name).items():
+                lines.append(
+                    f'predictor_stage_peak_bytes{{stage="{name}",memory="{key}"}} {value}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def flush(self) -> None:
+        """
+        Atomically rewrite metrics.prom.
+        """
+        path = os.path.join(self.metrics_dir, "metrics.prom")
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+
+class StepTimer:
+    def __init__(self, spans: SpanRecorder, **attrs):
+        """
+        StepTimer is a `callback_on_step_end` hook recording a `denoise_step` span
+        per step, with its memory peaks, measured from the previous step. The
+        first step is measured from the creation of the timer, so create it
+        right before calling the pipeline; it then also covers the latent preparation.
+        """
+        self.spans = spans
+        self.attrs = attrs
+        self.current = spans.start("denoise_step", **attrs)
+
+    def __call__(self, pipe, step: int, timestep: int, callback_kwargs: dict) -> dict:
+        self.current.attrs["step"] = step
+        self.spans.finish(self.current)
+        self.current = self.spans.start("denoise_step", **self.attrs)
+        return callback_kwargs
+
+    def restart(self) -> None:
+        """
+        Measure the next step from now, dropping the time since the last step.
+        Call it right before another pipeline call that reuses the timer.
+        """
+        self.spans.discard(self.current)
+        self.current = self.spans.start("denoise_step", **self.attrs)
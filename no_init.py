@@ -4,6 +4,7 @@ import threading
 from typing import (
     Callable,
     ContextManager,
+    Mapping,
     NamedTuple,
     Optional,
     TypeVar,
@@ -12,7 +13,7 @@ from typing import (
 
 import torch
 
-__all__ = ["no_init_or_tensor"]
+__all__ = ["no_init_or_tensor", "materialize"]
 
 
 
@@ -25,6 +26,10 @@ def no_init_or_tensor(
     """
     Suppress the initialization of weights while loading a model.
 
+    Modules constructed in this context have their parameters and buffers
+    on the meta device: no memory is allocated and nothing is initialized.
+    Use `materialize()` to give them their weights.
+
     Can either directly be passed a callable containing model-loading code,
     which will be evaluated with weight initialization suppressed,
     or used as a context manager around arbitrary model-loading code.
@@ -47,6 +52,7 @@ def no_init_or_tensor(
             config = AutoConfig("EleutherAI/gpt-j-6B")
             with no_init_or_tensor():
                 model = AutoModelForCausalLM.from_config(config)
+            materialize(model, load_file("model.safetensors"), device="cuda")
 
         Or, directly passing a callable::
 
@@ -96,7 +102,7 @@ class _NoInitOrTensorImpl:
                     mod.reset_parameters = cls._disable(mod.reset_parameters)
                 # When torch.empty is called, make it map to meta device by replacing
                 # the device in kwargs.
-                torch.empty = cls._ORIGINAL_EMPTY
+                torch.empty = cls._meta_empty
         reset_token = cls.is_active.set(True)
 
         try:
@@ -110,6 +116,13 @@ class _NoInitOrTensorImpl:
                     for mod, original in cls._MODULE_ORIGINALS:
                         mod.reset_parameters = original
 
+    @staticmethod
+    def _meta_empty(*args, **kwargs):
+        # Behaves as normal except in an active context, e.g. in other threads
+        if _NoInitOrTensorImpl.is_active.get():
+            kwargs["device"] = "meta"
+        return _NoInitOrTensorImpl._ORIGINAL_EMPTY(*args, **kwargs)
+
     @staticmethod
     def _disable(func):
         def wrapper(*args, **kwargs):
@@ -120,3 +133,64 @@ class _NoInitOrTensorImpl:
         return wrapper
 
     __init__ = None
+
+
+def materialize(
+    module: torch.nn.Module,
+    state_dict: Mapping[str, torch.Tensor],
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: Optional[torch.dtype] = None,
+    strict: bool = True,
+) -> torch.nn.Module:
+    """
+    Give a module built under no_init_or_tensor() its weights, without
+    allocating anything besides the weights themselves.
+
+    The tensors of `state_dict` take the place of the meta tensors, cast and
+    moved only when `dtype` or `device` differ. With safetensors, load the
+    state dict with `load_file(path, device=device)` so that the tensors are
+    read from the memory-mapped file straight to the device.
+
+    Args:
+        module: The module to materialize, modified in place.
+        state_dict: Tensors by parameter or buffer name, as in `load_state_dict`.
+        device: Device for the weights, or None to keep the state dict's.
+        dtype: Floating point dtype for the weights, or None to keep the state dict's.
+        strict: Whether to raise when the keys do not match the module's.
+            Without it, parameters missing from `state_dict` stay on the meta device.
+
+    Returns:
+        `module`, for chaining.
+    """
+    # persistent tensors only, like load_state_dict
+    tensors = module.state_dict(keep_vars=True)
+    missing = [name for name in tensors if name not in state_dict]
+    unexpected = [name for name in state_dict if name not in tensors]
+    if strict and (missing or unexpected):
+        raise RuntimeError(
+            f"Error materializing {type(module).__name__}:"
+            f" missing keys {missing}, unexpected keys {unexpected}"
+        )
+
+    for name, value in state_dict.items():
+        if name not in tensors:
+            continue
+        old = tensors[name]
+        if value.shape != old.shape:
+            raise RuntimeError(
+                f"Error materializing {type(module).__name__}: {name} has shape"
+                f" {tuple(value.shape)} in the state dict, {tuple(old.shape)} in the module"
+            )
+        value = value.to(
+            device=device,
+            dtype=dtype if dtype is not None and value.is_floating_point() else None,
+        )
+        module_name, _, leaf = name.rpartition(".")
+        owner = module.get_submodule(module_name)
+        if isinstance(old, torch.nn.Parameter):
+            owner._parameters[leaf] = torch.nn.Parameter(
+                value, requires_grad=old.requires_grad
+            )
+        else:
+            owner._buffers[leaf] = value
+    return module
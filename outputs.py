@@ -0,0 +1,141 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+
+from PIL import Image
+
+OUTPUT_FORMATS = ["webp", "jpg", "png"]
+
+# Pillow format names for each output_format
+PIL_FORMATS = {"webp": "WEBP", "jpg": "JPEG", "png": "PNG"}
+
+
+class OutputEncoder:
+    def __init__(
+        self,
+        max_workers: int = 4,
+        png_compress_level: int = int(os.environ.get("PNG_COMPRESS_LEVEL", 6)),
+        base_dir: str = "/tmp",
+        keep_last: int = 8,
+        spans=None,
+    ):
+        """
+        OutputEncoder saves generated images on a thread pool so that the
+        (mostly CPU bound) compression of several outputs overlaps instead of
+        running serially on the request thread.
+
+        Every request gets its own output directory. Once released, only the
+        most recent `keep_last` of them are kept on disk, directories of
+        requests still running or waiting for admission are never removed.
+
+        :param max_workers: Number of encoder threads.
+        :param png_compress_level: zlib compression level used for png outputs, 0-9.
+        :param base_dir: Directory under which per-request output directories are created.
+        :param keep_last: Number of released request directories to keep around.
+        :param spans: Optional SpanRecorder, records an `encode` span per image.
+        """
+        if not 0 <= png_compress_level <= 9:
+            raise ValueError(
+                f"png_compress_level must be between 0 and 9, got {png_compress_level}"
+            )
+        self.png_compress_level = png_compress_level
+        self.base_dir = base_dir
+        self.keep_last = keep_last
+        self.spans = spans
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="output-encoder"
+        )
+        # released directories, oldest first
+        self.request_dirs = deque()
+        self.active_dirs = set()
+        self._dirs_lock = threading.Lock()
+        if not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+
+    def request_dir(self) -> str:
+        """
+        Create a fresh output directory for a request, to be handed back with
+        release_dir() once the request is done.
+
+        :return: Path to the new directory.
+        """
+        path = tempfile.mkdtemp(prefix="out-", dir=self.base_dir)
+        with self._dirs_lock:
+            self.active_dirs.add(path)
+        return path
+
+    def release_dir(self, path: str):
+        """
+        Mark the directory of a finished request as removable, removing the
+        oldest released ones beyond `keep_last`.
+        """
+        with self._dirs_lock:
+            self.active_dirs.discard(path)
+            self.request_dirs.append(path)
+            evicted = []
+            while len(self.request_dirs) > self.keep_last:
+                evicted.append(self.request_dirs.popleft())
+        for old in evicted:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def encode(
+        self,
+        image: Image.Image,
+        dest_dir: str,
+        index: int,
+        output_format: str = "png",
+        output_quality: int = 90,
+    ) -> str:
+        """
+        Encode a single image to disk.
+
+        :param image: Image to save.
+        :param dest_dir: Directory to save into.
+        :param index: Index of the image within the request, used in the file name.
+        :param output_format: One of OUTPUT_FORMATS.
+        :param output_quality: Quality for lossy formats, 0-100. Ignored for png.
+        :return: Path to the saved file.
+        """
+        if output_format not in PIL_FORMATS:
+            raise ValueError(
+                f"Unknown output_format {output_format}, expected one of {OUTPUT_FORMATS}"
+            )
+
+        path = os.path.join(dest_dir, f"out-{index}.{output_format}")
+        span = contextlib.nullcontext()
+        if self.spans is not None:
+            span = self.spans.span(
+                "encode",
+                phase="predict",
+                request=os.path.basename(dest_dir),
+                format=output_format,
+            )
+        with span:
+            if output_format == "png":
+                image.save(path, PIL_FORMATS[output_format], compress_level=self.png_compress_level)
+            else:
+                if output_format == "jpg" and image.mode != "RGB":
+                    image = image.convert("RGB")
+                image.save(path, PIL_FORMATS[output_format], quality=output_quality)
+        return path
+
+    def submit(
+        self,
+        image: Image.Image,
+        dest_dir: str,
+        index: int,
+        output_format: str = "png",
+        output_quality: int = 90,
+    ) -> Future:
+        """
+        Schedule encode() on the thread pool.
+
+        :return: Future resolving to the path of the saved file.
+        """
+        return self.executor.submit(
+            self.encode, image, dest_dir, index, output_format, output_quality
+        )
@@ -1,14 +1,38 @@
 from cog import BasePredictor, Input, Path
+import asyncio
 import os
+import gc
 import json
+import contextlib
+import inspect
+import math
 import time
+import threading
 import torch
 import shutil
 import hashlib
 import subprocess
 import numpy as np
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
 from weights import WeightsDownloadCache
+from outputs import OUTPUT_FORMATS, OutputEncoder
+from previews import LatentPreviewer, track_denoised
+from callbacks import StepCallbacks
+from cancellation import CancellationToken, PredictionCancelled
+from cost_model import LatencyCostModel, denoising_steps
+from admission import AdmissionController
+from metrics import METRICS_DIR, STEP_SPANS, SpanRecorder, StepTimer
+from profiling import RequestProfiler
+from task_graph import TaskGraph
+from result_cache import RESULT_CACHE_DIR, ResultCache
+from resources import ResourceManager
+from snapshot import FusedSnapshot, snapshot_fingerprint
+from safetensors_loader import load_file, load_into, load_model
+from shared_weights import SHARED_WEIGHTS_DIR, SharedWeights
+from vae_tiling import VaeTiling
+from tiled_diffusion import TiledDiffusion
+from feature_cache import FeatureCache
+from token_merging import MAX_TOKEN_MERGING_RATIO, TokenMerging
 from controlnet_aux import OpenposeDetector
 from diffusers import (
     DDIMScheduler,
@@ -18,20 +42,24 @@ from diffusers import (
     EulerDiscreteScheduler,
     HeunDiscreteScheduler,
     PNDMScheduler,
+    StableDiffusionXLPipeline,
     StableDiffusionXLImg2ImgPipeline,
     StableDiffusionXLInpaintPipeline,
+    StableDiffusionXLControlNetPipeline,
     StableDiffusionXLControlNetInpaintPipeline,
     StableDiffusionXLControlNetImg2ImgPipeline,
     LCMScheduler,
-    ControlNetModel
+    AutoencoderKL,
+    ControlNetModel,
+    UNet2DConditionModel,
 )
 from diffusers.models.attention_processor import LoRAAttnProcessor2_0
 from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker,
 )
 from diffusers.utils import load_image
-from safetensors.torch import load_file
-from transformers import CLIPImageProcessor
+from huggingface_hub import hf_hub_download
+from transformers import CLIPImageProcessor, CLIPTextModel, CLIPTextModelWithProjection
 from dataset_and_utils import TokenEmbeddingsHandler
 import cv2
 from PIL import Image
@@ -39,13 +67,29 @@ from PIL import Image
 CONTROL_CACHE = "control-cache"
 SDXL_MODEL_CACHE = "./sdxl-cache"
 LCM_CACHE = "./lcm-cache"
+LCM_REPO = "latent-consistency/lcm-lora-sdxl"
+LCM_WEIGHT_NAME = "pytorch_lora_weights.safetensors"
 SAFETY_CACHE = "./safety-cache"
 FEATURE_EXTRACTOR = "./feature-extractor"
 SDXL_URL = "https://weights.replicate.delivery/default/sdxl/sdxl-vae-upcast-fix.tar"
 SAFETY_URL = "https://weights.replicate.delivery/default/sdxl/safety-1.0.tar"
 CONTROL_NAME="lllyasviel/ControlNet"
-
-USE_IP_ADAPTER=True
+# what the fused snapshot is computed from, see script/build_snapshot.py
+SNAPSHOT_INPUTS = {
+    "sdxl": SDXL_URL,
+    "lcm_lora": f"{LCM_REPO}/{LCM_WEIGHT_NAME}",
+    "dtype": "float16",
+}
+# what the weights shared between predictor processes are computed from
+SHARED_INPUTS = dict(SNAPSHOT_INPUTS, controlnet=CONTROL_CACHE, safety_checker=SAFETY_URL)
+# modules of the controlnet pipeline shared between them, once fused
+SHARED_MODULES = {
+    "unet": UNet2DConditionModel,
+    "text_encoder": CLIPTextModel,
+    "text_encoder_2": CLIPTextModelWithProjection,
+    "vae": AutoencoderKL,
+    "controlnet": ControlNetModel,
+}
 
 class KarrasDPM:
     def from_config(config):
@@ -64,6 +108,74 @@ SCHEDULERS = {
 }
 
 
+# pipeline of each mode, see input_mode()
+PIPELINE_CLASSES = {
+    "txt2img": StableDiffusionXLPipeline,
+    "img2img": StableDiffusionXLImg2ImgPipeline,
+    "inpaint": StableDiffusionXLInpaintPipeline,
+    "controlnet": StableDiffusionXLControlNetPipeline,
+    "controlnet_img2img": StableDiffusionXLControlNetImg2ImgPipeline,
+    "controlnet_inpaint": StableDiffusionXLControlNetInpaintPipeline,
+}
+
+
+# quality_mode="draft" denoises at this fraction of the requested width and height,
+# then repaints this much of the upscaled draft at full size
+QUALITY_MODES = ["full", "draft"]
+DRAFT_SCALE = 0.5
+DRAFT_REFINE_STRENGTH = 0.4
+
+# pipeline mode refining the drafts of a mode, starting from the upscaled draft
+REFINE_MODES = {"txt2img": "img2img", "controlnet": "controlnet_img2img"}
+
+
+def input_mode(image=None, mask=None, controlnet_image=None):
+    """The mode of a request, from the images it comes with."""
+    if mask and not image:
+        raise ValueError("A mask needs an image to inpaint")
+    mode = "inpaint" if mask else "img2img" if image else "txt2img"
+    if controlnet_image:
+        mode = "controlnet" if mode == "txt2img" else f"controlnet_{mode}"
+    return mode
+
+
+def shared_pipeline(base, pipeline_class, **modules):
+    """Wrap the modules of an SDXL pipeline, plus `modules`, in a pipeline of another class, without copying them."""
+    params = inspect.signature(pipeline_class.__init__).parameters
+    kwargs = {name: module for name, module in base.components.items() if name in params}
+    for name in ("requires_aesthetics_score", "force_zeros_for_empty_prompt"):
+        if name in params and name in base.config:
+            kwargs[name] = base.config[name]
+    # a new watermarker only when the base has one, which means the library is installed
+    kwargs["add_watermarker"] = getattr(base, "watermark", None) is not None
+    kwargs.update(modules)
+    return pipeline_class(**kwargs)
+
+
+def controlnet_pipeline(base, controlnet):
+    """Wrap the modules of an SDXL pipeline in a ControlNet inpaint pipeline, without copying them."""
+    return shared_pipeline(base, StableDiffusionXLControlNetInpaintPipeline, controlnet=controlnet)
+
+
+def draft_size(size):
+    """Size a draft of an image of `size` is denoised at, in multiples of 8 pixels."""
+    return tuple(max(8, int(side * DRAFT_SCALE) // 8 * 8) for side in size)
+
+
+def set_pipeline_size(pipe_mode, kwargs, size):
+    """Make the call kwargs of a pipeline generate images of `size`."""
+    if pipe_mode == "img2img":
+        # the img2img pipeline generates at the size of its image
+        images = kwargs["image"]
+        resized = [
+            image if image.size == size else image.resize(size, Image.LANCZOS)
+            for image in (images if isinstance(images, list) else [images])
+        ]
+        kwargs["image"] = resized if isinstance(images, list) else resized[0]
+    else:
+        kwargs["width"], kwargs["height"] = size
+
+
 def download_weights(url, dest):
     start = time.time()
     print("downloading url: ", url)
@@ -74,7 +186,7 @@ def download_weights(url, dest):
 
 class Predictor(BasePredictor):
     def load_trained_weights(self, weights, pipe):
-        from no_init import no_init_or_tensor
+        from no_init import materialize, no_init_or_tensor
 
         # weights can be a URLPath, which behaves in unexpected ways
         weights = str(weights)
@@ -84,7 +196,9 @@ class Predictor(BasePredictor):
 
         self.tuned_weights = weights
 
-        local_weights_cache = self.weights_cache.ensure(weights)
+        with self.spans.span("weights_ensure", phase="predict"):
+            local_weights_cache = self.weights_cache.ensure(weights)
+        load_start = time.time()
 
         # load UNET
         print("Loading fine-tuned model")
@@ -98,25 +212,32 @@ class Predictor(BasePredictor):
         if not self.is_lora:
             print("Loading Unet")
 
-            new_unet_params = load_file(
-                os.path.join(local_weights_cache, "unet.safetensors")
+            # read by a pool of threads and copied into the existing parameters
+            load_into(
+                pipe.unet,
+                os.path.join(local_weights_cache, "unet.safetensors"),
+                strict=False,
             )
-            # this should return _IncompatibleKeys(missing_keys=[...], unexpected_keys=[])
-            pipe.unet.load_state_dict(new_unet_params, strict=False)
 
         else:
             print("Loading Unet LoRA")
 
             unet = pipe.unet
 
-            tensors = load_file(os.path.join(local_weights_cache, "lora.safetensors"))
+            tensors = load_file(
+                os.path.join(local_weights_cache, "lora.safetensors"),
+                device=self.device,
+            )
 
             unet_lora_attn_procs = {}
             name_rank_map = {}
+            # {proc_name}.{to_q_lora}.{up}.{weight} -> processor state dicts
+            proc_tensors = {}
             for tk, tv in tensors.items():
+                proc_name = ".".join(tk.split(".")[:-3])
+                proc_tensors.setdefault(proc_name, {})[".".join(tk.split(".")[-3:])] = tv
                 # up is N, d
                 if tk.endswith("up.weight"):
-                    proc_name = ".".join(tk.split(".")[:-3])
                     r = tv.shape[1]
                     name_rank_map[proc_name] = r
 
@@ -136,16 +257,26 @@ class Predictor(BasePredictor):
                 elif name.startswith("down_blocks"):
                     block_id = int(name[len("down_blocks.")])
                     hidden_size = unet.config.block_out_channels[block_id]
+                # built on the meta device, then given the loaded tensors as they are
                 with no_init_or_tensor():
                     module = LoRAAttnProcessor2_0(
                         hidden_size=hidden_size,
                         cross_attention_dim=cross_attention_dim,
                         rank=name_rank_map[name],
                     )
-                unet_lora_attn_procs[name] = module.to("cuda", non_blocking=True)
+                unet_lora_attn_procs[name] = materialize(
+                    module, proc_tensors[name], dtype=torch.float32
+                )
 
             unet.set_attn_processor(unet_lora_attn_procs)
-            unet.load_state_dict(tensors, strict=False)
+            # anything besides the processors, e.g. tuned UNet weights
+            rest = {
+                tk: tv
+                for tk, tv in tensors.items()
+                if ".".join(tk.split(".")[:-3]) not in unet_lora_attn_procs
+            }
+            if rest:
+                unet.load_state_dict(rest, strict=False)
 
         # load text
         handler = TokenEmbeddingsHandler(
@@ -159,68 +290,255 @@ class Predictor(BasePredictor):
         self.token_map = params
 
         self.tuned_model = True
+        self.spans.record("adapter_load", time.time() - load_start, phase="predict")
 
     def setup(self, weights: Optional[Path] = None):
         """Load the model into memory to make running multiple predictions efficient"""
 
         start = time.time()
-        self.openpose = OpenposeDetector.from_pretrained(
-            CONTROL_NAME,
-            cache_dir=CONTROL_CACHE,
-        )
+        self.setup_runtime()
+        setup_span = self.spans.start("setup", phase="setup")
+        # optional components are loaded by the first prediction that uses them
+        self.resources.register("openpose", self.load_openpose, offload="cpu")
+        self.resources.register("safety_checker", self.load_safety_checker, offload="cpu")
         
-        
-        self.tuned_model = False
-        self.tuned_weights = None
         if str(weights) == "weights":
             weights = None
 
-        self.weights_cache = WeightsDownloadCache()
+        # independent steps overlap, e.g. the ControlNet loads while SDXL downloads
+        print("Loading SDXL Controlnet pipeline...")
+        graph = TaskGraph(self.spans, phase="setup")
+        graph.add(
+            "feature_extractor",
+            lambda: CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR),
+        )
+        # only fetched here, the safety checker itself is loaded lazily
+        graph.add("safety_download", lambda: self.ensure_downloaded(SAFETY_URL, SAFETY_CACHE))
+        graph.add("sdxl_download", lambda: self.ensure_downloaded(SDXL_URL, SDXL_MODEL_CACHE))
+        self.snapshot = FusedSnapshot()
+        self.shared_weights = (
+            SharedWeights(SHARED_WEIGHTS_DIR, snapshot_fingerprint(SHARED_INPUTS)[:16])
+            if SHARED_WEIGHTS_DIR
+            else None
+        )
+        # another predictor process on this host already loaded and fused everything
+        attach = self.shared_weights is not None and all(
+            self.shared_weights.has(name) for name in SHARED_MODULES
+        )
+        fused = attach or self.snapshot.matches(snapshot_fingerprint(SNAPSHOT_INPUTS))
+        if attach:
+            for name, model_class in SHARED_MODULES.items():
+                graph.add(
+                    name,
+                    lambda name=name, model_class=model_class: self.shared_weights.attach(
+                        name, model_class
+                    ),
+                )
+        else:
+            if fused:
+                # the LCM LoRA is already fused into the stored UNet
+                print("Loading fused snapshot from", self.snapshot.base_dir)
+                graph.add(
+                    "unet",
+                    lambda: self.snapshot.load("unet", UNet2DConditionModel, dtype=torch.float16),
+                )
+            else:
+                print("No matching fused snapshot, fusing the LCM LoRA")
+                graph.add(
+                    "lcm_download",
+                    lambda: hf_hub_download(LCM_REPO, LCM_WEIGHT_NAME, cache_dir=LCM_CACHE),
+                )
+                graph.add(
+                    "unet",
+                    lambda: load_model(
+                        UNet2DConditionModel,
+                        SDXL_MODEL_CACHE,
+                        subfolder="unet",
+                        dtype=torch.float16,
+                        variant="fp16",
+                    ),
+                    deps=["sdxl_download"],
+                )
+            # the large modules are read by the threaded loader, the rest by from_pretrained
+            for name, model_class in [
+                ("text_encoder", CLIPTextModel),
+                ("text_encoder_2", CLIPTextModelWithProjection),
+            ]:
+                graph.add(
+                    name,
+                    lambda name=name, model_class=model_class: load_model(
+                        model_class,
+                        SDXL_MODEL_CACHE,
+                        subfolder=name,
+                        dtype=torch.float16,
+                        variant="fp16",
+                    ),
+                    deps=["sdxl_download"],
+                )
+            graph.add(
+                "controlnet",
+                lambda: load_model(ControlNetModel, CONTROL_CACHE, dtype=torch.float16),
+            )
+        base_modules = ["unet", "text_encoder", "text_encoder_2"] + (["vae"] if attach else [])
+        graph.add(
+            "sdxl",
+            lambda: StableDiffusionXLInpaintPipeline.from_pretrained(
+                SDXL_MODEL_CACHE,
+                torch_dtype=torch.float16,
+                use_safetensors=True,
+                variant="fp16",
+                **{name: graph.results[name] for name in base_modules},
+            ),
+            deps=["sdxl_download", *base_modules],
+        )
+        graph.add(
+            "controlnet_pipe",
+            lambda: controlnet_pipeline(graph.results["sdxl"], graph.results["controlnet"]),
+            deps=["sdxl", "controlnet"],
+        )
+        last = "controlnet_pipe"
+        if not fused:
+            graph.add(
+                "lcm_fuse",
+                lambda: self.fuse_lcm_lora(graph.results["controlnet_pipe"]),
+                deps=["controlnet_pipe", "lcm_download"],
+            )
+            last = "lcm_fuse"
+        if self.shared_weights is not None and not attach:
+            graph.add(
+                "share",
+                lambda: self.share_modules(graph.results["controlnet_pipe"]),
+                deps=[last],
+            )
+            last = "share"
+        graph.add(
+            "to_device",
+            lambda: graph.results["controlnet_pipe"].to(self.device),
+            deps=[last],
+        )
+        graph.run()
 
-        print("Loading safety checker...")
-        if not os.path.exists(SAFETY_CACHE):
-            download_weights(SAFETY_URL, SAFETY_CACHE)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_CACHE, torch_dtype=torch.float16
-        ).to("cuda")
-        self.feature_extractor = CLIPImageProcessor.from_pretrained(FEATURE_EXTRACTOR)
+        self.feature_extractor = graph.results["feature_extractor"]
+        self.controlnet_pipe = graph.results["controlnet_pipe"]
+        critical_path = " -> ".join(f"{name} {seconds:.1f}s" for name, seconds in graph.critical_path())
+        print(f"Setup critical path: {critical_path}")
+        self.spans.finish(setup_span)
+        self.spans.flush()
+        print(f"Memory: {json.dumps(setup_span.memory)}")
+        print("setup took: ", time.time() - start)
 
-        if not os.path.exists(SDXL_MODEL_CACHE):
-            download_weights(SDXL_URL, SDXL_MODEL_CACHE)
+    def setup_runtime(
+        self,
+        device="cuda",
+        weights_cache_dir="/src/weights-cache",
+        metrics_dir=METRICS_DIR,
+        result_cache_dir=RESULT_CACHE_DIR,
+    ):
+        """Set up the state predictions need besides the models.
 
+        Kept apart from setup() so benchmarks can run predict() with small models on CPU.
+        """
+        self.device = device
+        self.spans = SpanRecorder(metrics_dir)
+        self.tuned_model = False
+        self.tuned_weights = None
         self.is_lora = False
-        
-        print("Loading SDXL Controlnet pipeline...")
-        controlnet = ControlNetModel.from_pretrained(
-            CONTROL_CACHE,
-            torch_dtype=torch.float16,
-        )
+        self.weights_cache = WeightsDownloadCache(base_dir=weights_cache_dir)
+        self.result_cache = ResultCache(base_dir=result_cache_dir)
+        self.resources = ResourceManager(device, spans=self.spans)
+        self.shared_weights = None
+        # pipelines of the other modes, built from the modules of controlnet_pipe
+        self.pipes = {}
+        self.output_encoder = OutputEncoder(spans=self.spans)
+        self.cost_model = LatencyCostModel()
+        self.vae_tiling = VaeTiling()
+        self.tiled_diffusion = TiledDiffusion()
+        self.admission = AdmissionController()
+        self.profiler = RequestProfiler()
+        # running predictions by supersede_key, and those sent without one
+        self.inflight = {}
+        self.unkeyed_inflight = set()
+        self.inflight_lock = threading.Lock()
+
+    def ensure_downloaded(self, url, dest):
+        if not os.path.exists(dest):
+            download_weights(url, dest)
+
+    def fuse_lcm_lora(self, pipe):
+        pipe.load_lora_weights(LCM_REPO, weight_name=LCM_WEIGHT_NAME, cache_dir=LCM_CACHE)
+        pipe.fuse_lora()
+
+    def load_openpose(self):
+        return OpenposeDetector.from_pretrained(CONTROL_NAME, cache_dir=CONTROL_CACHE)
 
-        self.controlnet_pipe = StableDiffusionXLControlNetInpaintPipeline.from_pretrained(
-            SDXL_MODEL_CACHE,
-            controlnet=controlnet,
-            torch_dtype=torch.float16,
-            use_safetensors=True,
-            variant="fp16",
+    def load_safety_checker(self):
+        def load():
+            self.ensure_downloaded(SAFETY_URL, SAFETY_CACHE)
+            return StableDiffusionSafetyChecker.from_pretrained(
+                SAFETY_CACHE, torch_dtype=torch.float16
+            )
+
+        if self.shared_weights is None:
+            return load()
+        return self.shared_weights.attach_or_publish(
+            "safety_checker", StableDiffusionSafetyChecker, load
         )
 
-        # self.controlnet_pipe = StableDiffusionXLControlNetImg2ImgPipeline.from_pretrained(
-        #     SDXL_MODEL_CACHE,
-        #     controlnet=controlnet,
-        #     torch_dtype=torch.float16,
-        #     use_safetensors=True,
-        #     variant="fp16",
-        # )
-        self.controlnet_pipe.load_lora_weights("latent-consistency/lcm-lora-sdxl", cache_dir=LCM_CACHE)
-        self.controlnet_pipe.fuse_lora()
+    def share_modules(self, pipe):
+        """Publish the frozen modules of the pipeline for the other processes on this host."""
+        for name in SHARED_MODULES:
+            self.shared_weights.publish(name, getattr(pipe, name))
 
-        # ip adapter
-        if USE_IP_ADAPTER:
-            self.controlnet_pipe.load_ip_adapter("h94/IP-Adapter", subfolder="models", weight_name="ip-adapter_sd15.bin")
+    def get_pipeline(self, mode):
+        """The pipeline of a mode, sharing the modules of controlnet_pipe."""
+        if mode == "controlnet_inpaint":
+            return self.controlnet_pipe
+        pipe = self.pipes.get(mode)
+        if pipe is None or pipe.unet is not self.controlnet_pipe.unet:
+            pipe = shared_pipeline(self.controlnet_pipe, PIPELINE_CLASSES[mode])
+            pipe.set_progress_bar_config(**getattr(self.controlnet_pipe, "_progress_bar_config", {}))
+            self.pipes[mode] = pipe
+        return pipe
 
-        
-        self.controlnet_pipe.to("cuda")
-        print("setup took: ", time.time() - start)
+    def pipeline_inputs(
+        self,
+        mode,
+        size,
+        image=None,
+        mask_image=None,
+        control_image=None,
+        strength=1.0,
+        condition_scale=1.0,
+    ):
+        """
+        The pipeline mode a request mode runs with, and the image inputs of its call.
+
+        :param size: Width and height of the images to generate.
+        :param image: Image to start from, or a list of them, one per prompt.
+        :return: The pipeline mode, see get_pipeline(), and its call kwargs.
+        """
+        controlnet = mode.startswith("controlnet")
+        pipe_mode = mode
+        if self.controlnet_pipe.unet.config.in_channels == 9 and not mode.endswith("inpaint"):
+            # an inpainting UNet always takes a mask: repaint the whole image
+            mask_image = Image.new("L", size, 255)
+            if image is None:
+                image = Image.new("RGB", size)
+                strength = 1.0
+            pipe_mode = "controlnet_inpaint" if controlnet else "inpaint"
+
+        kwargs = {}
+        if image is not None:
+            kwargs["image"] = image
+            kwargs["strength"] = strength
+        if mask_image is not None:
+            kwargs["mask_image"] = mask_image
+        if controlnet:
+            # without an image to start from, the pose is the pipeline's image
+            kwargs["control_image" if image is not None else "image"] = control_image
+            kwargs["controlnet_conditioning_scale"] = condition_scale
+        set_pipeline_size(pipe_mode, kwargs, size)
+        return pipe_mode, kwargs
 
     def load_image(self, path):
         shutil.copyfile(path, "/tmp/image.png")
@@ -228,19 +546,96 @@ class Predictor(BasePredictor):
 
     def run_safety_checker(self, image):
         safety_checker_input = self.feature_extractor(image, return_tensors="pt").to(
-            "cuda"
+            self.device
         )
         np_image = [np.array(val) for val in image]
-        image, has_nsfw_concept = self.safety_checker(
+        image, has_nsfw_concept = self.resources.get("safety_checker")(
             images=np_image,
             clip_input=safety_checker_input.pixel_values.to(torch.float16),
         )
         return image, has_nsfw_concept
 
+    def start_cancellation(self, supersede_key=None, token=None):
+        """Register the cancellation token of a prediction, cancelling the one it supersedes.
 
+        Predictions without a supersede_key never supersede one another.
+        :param token: Token of the prediction, a new one by default.
+        """
+        token = token or CancellationToken()
+        with self.inflight_lock:
+            if supersede_key is None:
+                self.unkeyed_inflight.add(token)
+                return token
+            previous = self.inflight.get(supersede_key)
+            if previous is not None:
+                previous.cancel("superseded by a newer request")
+            self.inflight[supersede_key] = token
+        return token
 
-    @torch.inference_mode()
-    def predict(
+    def finish_cancellation(self, supersede_key, token):
+        with self.inflight_lock:
+            if supersede_key is None:
+                self.unkeyed_inflight.discard(token)
+            elif self.inflight.get(supersede_key) is token:
+                del self.inflight[supersede_key]
+
+    def cancel(self, supersede_key=None, reason="cancelled"):
+        """Cancel running predictions. Safe to call from another thread.
+
+        Without a supersede_key every running prediction is cancelled.
+        """
+        with self.inflight_lock:
+            tokens = list(self.inflight.items())
+            tokens += [(None, token) for token in self.unkeyed_inflight]
+        for key, token in tokens:
+            if supersede_key is None or key == supersede_key:
+                token.cancel(reason)
+
+    def encode_prompts(self, pipe, prompts, negative_prompts, guidance_scale, lora_scale=None):
+        """Run the text encoders ahead of the pipeline call, returning its embedding kwargs."""
+        (
+            prompt_embeds,
+            negative_prompt_embeds,
+            pooled_prompt_embeds,
+            negative_pooled_prompt_embeds,
+        ) = pipe.encode_prompt(
+            prompt=prompts,
+            device=pipe._execution_device,
+            do_classifier_free_guidance=guidance_scale > 1,
+            negative_prompt=negative_prompts,
+            lora_scale=lora_scale,
+        )
+        return {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+        }
+
+    def decode_latents(self, pipe, latents, watermark=None):
+        """Decode latents returned with output_type="latent" into PIL images.
+
+        A float16 VAE with force_upcast decodes in float32, as the pipelines do,
+        since only some of them leave the VAE upcast after returning latents.
+        """
+        needs_upcasting = pipe.vae.dtype == torch.float16 and pipe.vae.config.force_upcast
+        if needs_upcasting:
+            pipe.upcast_vae()
+        try:
+            vae_dtype = next(iter(pipe.vae.post_quant_conv.parameters())).dtype
+            image = pipe.vae.decode(
+                latents.to(vae_dtype) / pipe.vae.config.scaling_factor, return_dict=False
+            )[0]
+        finally:
+            if needs_upcasting:
+                pipe.vae.to(dtype=torch.float16)
+        if watermark is not None:
+            image = watermark.apply_watermark(image)
+        return pipe.image_processor.postprocess(image, output_type="pil")
+
+
+
+    async def predict(
         self,
         prompt: str = Input(
             description="Input prompt",
@@ -327,96 +722,471 @@ class Predictor(BasePredictor):
         disable_safety_checker: bool = Input(
             description="Disable safety checker for generated images. This feature is only available through the API. See [https://replicate.com/docs/how-does-replicate-work#safety](https://replicate.com/docs/how-does-replicate-work#safety)",
             default=True
-        )
-    ) -> List[Path]:
-        """Run a single prediction on the model."""
+        ),
+        output_format: str = Input(
+            description="Format of the output images",
+            choices=OUTPUT_FORMATS,
+            default="png",
+        ),
+        output_quality: int = Input(
+            description="Quality when saving the output images, from 0 to 100. 100 is best quality, 0 is lowest quality. Not relevant for .png outputs",
+            ge=0,
+            le=100,
+            default=90,
+        ),
+        output_batch_size: int = Input(
+            description="Number of images denoised together. Smaller batches stream their first images out sooner. 0 denoises all outputs in a single batch",
+            ge=0,
+            le=4,
+            default=0,
+        ),
+        preview_steps: int = Input(
+            description="Write a low resolution preview of each image every N denoising steps, approximated from the latents. 0 disables previews",
+            ge=0,
+            le=20,
+            default=0,
+        ),
+        supersede_key: str = Input(
+            description="Requests sharing this key supersede each other: starting a new one cancels the one still running",
+            default=None,
+        ),
+        deadline: float = Input(
+            description="Optional latency target in seconds. When the request is estimated to take longer, fewer steps and, if needed, a lower internal resolution that is upscaled afterwards are used",
+            ge=0.0,
+            default=None,
+        ),
+        feature_cache_interval: int = Input(
+            description="Run the whole UNet every N denoising steps only, the steps in between reuse its deep features (DeepCache). Faster with some quality loss, 1 disables",
+            ge=1,
+            le=10,
+            default=1,
+        ),
+        token_merging_ratio: float = Input(
+            description="Share of tokens merged before self-attention at the highest resolution (ToMe). Faster and lighter at large sizes with some loss of detail, 0 disables",
+            ge=0.0,
+            le=MAX_TOKEN_MERGING_RATIO,
+            default=0.0,
+        ),
+        quality_mode: str = Input(
+            description="\"draft\" denoises at half the width and height, then refines the upscaled image at full size in a few steps. Faster, for previews and thumbnails",
+            choices=QUALITY_MODES,
+            default="full",
+        ),
+        profile: bool = Input(
+            description="Internal: capture a torch.profiler trace and operator table of this prediction",
+            default=False,
+        ),
+        bypass_result_cache: bool = Input(
+            description="Always run the model. By default, a request with a seed that matches an earlier one returns the stored images",
+            default=False,
+        ),
+    ) -> AsyncIterator[Path]:
+        """Run a single prediction on the model, yielding each image as soon as it is ready.
+
+        generate() runs on worker threads, so that with cog's concurrency.max above 1
+        several predictions are in the process at once and wait for the GPU in the
+        AdmissionController. A prediction cancelled by cog stops at the next step.
+        """
+        inputs = {name: value for name, value in locals().items() if name != "self"}
+        token = CancellationToken()
+        outputs = self.generate(token=token, **inputs)
+        done = object()
+        # the generator cannot be closed while a worker thread runs it
+        running = False
+        try:
+            while True:
+                running = True
+                path = await asyncio.to_thread(next, outputs, done)
+                running = False
+                if path is done:
+                    return
+                yield path
+        except asyncio.CancelledError:
+            token.cancel("cancelled")
+            raise
+        finally:
+            if not running:
+                outputs.close()
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        prompt,
+        negative_prompt,
+        batched_prompt,
+        image,
+        mask,
+        controlnet_image,
+        width,
+        height,
+        num_outputs,
+        scheduler,
+        num_inference_steps,
+        guidance_scale,
+        prompt_strength,
+        seed,
+        apply_watermark,
+        lora_scale,
+        condition_scale,
+        replicate_weights,
+        lora_weights,
+        disable_safety_checker,
+        output_format,
+        output_quality,
+        output_batch_size,
+        preview_steps,
+        supersede_key,
+        deadline,
+        feature_cache_interval,
+        token_merging_ratio,
+        quality_mode,
+        profile,
+        bypass_result_cache,
+        token: Optional[CancellationToken] = None,
+    ) -> Iterator[Path]:
+        """The body of predict(), with every input given. Iterating it runs the prediction.
+
+        :param token: Cancels the prediction, a new one by default.
+        """
+        predict_start = time.time()
+        deterministic = seed is not None
         if seed is None:
             seed = int.from_bytes(os.urandom(2), "big")
         print(f"Using seed: {seed}")
 
-        if lora_weights:
-            if controlnet_image:
-                self.load_trained_weights(lora_weights, self.controlnet_pipe)
+        token = self.start_cancellation(supersede_key, token)
+        output_dir = self.output_encoder.request_dir()
+        span_attrs = {"phase": "predict", "request": os.path.basename(output_dir)}
+        predict_span = self.spans.start("predict", **span_attrs)
+        cancel_reason = None
+        ticket = None
+        profiling = contextlib.ExitStack()
+        if self.profiler.should_profile(profile):
+            profiling.enter_context(self.profiler.capture(span_attrs["request"]))
+        try:
+            mode = input_mode(image, mask, controlnet_image)
+            controlnet = mode.startswith("controlnet")
+            weights = lora_weights or replicate_weights
+            cache_key = None
+            if deterministic and not bypass_result_cache and self.result_cache.enabled:
+                # everything that changes the output images, previews and deadline aside;
+                # results degraded to meet a deadline are not stored
+                with self.spans.span("result_cache", **span_attrs):
+                    cache_key = self.result_cache.key(
+                        {
+                            "model": SDXL_URL,
+                            "weights": str(weights) if weights else None,
+                            "prompt": prompt,
+                            "negative_prompt": negative_prompt,
+                            "batched_prompt": batched_prompt,
+                            "width": width,
+                            "height": height,
+                            "num_outputs": num_outputs,
+                            "scheduler": scheduler,
+                            "num_inference_steps": num_inference_steps,
+                            "guidance_scale": guidance_scale,
+                            "prompt_strength": prompt_strength,
+                            "seed": seed,
+                            "apply_watermark": apply_watermark,
+                            "lora_scale": lora_scale,
+                            "condition_scale": condition_scale,
+                            "disable_safety_checker": disable_safety_checker,
+                            "output_format": output_format,
+                            "output_quality": output_quality,
+                            "output_batch_size": output_batch_size,
+                            "vae_tile_size": self.vae_tiling.tile_size_for(width, height),
+                            "diffusion_tile_size": self.tiled_diffusion.tile_size_for(width, height),
+                            "quality_mode": quality_mode,
+                            "feature_cache_interval": feature_cache_interval,
+                            "token_merging_ratio": token_merging_ratio,
+                        },
+                        {"image": image, "mask": mask, "controlnet_image": controlnet_image},
+                    )
+                    cached = self.result_cache.get(cache_key, output_dir)
+                if cached is not None:
+                    print(f"Result cache hit: {self.result_cache.cache_info()}")
+                    for path in cached:
+                        yield Path(path)
+                    self.spans.finish(predict_span)
+                    return
+
+            lora_load = bool(weights) and str(weights) != self.tuned_weights
+            num_images = num_outputs
+            if batched_prompt:
+                num_images *= len(prompt.strip().splitlines())
+            cost_args = (
+                width,
+                height,
+                num_images,
+                num_inference_steps,
+                prompt_strength if image else 1.0,
+            )
+            if deadline is not None:
+                cost = self.cost_model.plan_for_deadline(
+                    deadline, *cost_args, controlnet=controlnet
+                ).estimate
             else:
-                self.load_trained_weights(lora_weights, self.txt2img_pipe)
-        elif replicate_weights:
+                cost = self.cost_model.estimate(*cost_args, controlnet=controlnet)
+            if lora_load:
+                cost += self.cost_model.lora_load_seconds
+            with self.spans.span("queue", **span_attrs):
+                ticket = self.admission.acquire(cost, deadline, token)
+            print(f"Admitted after {time.time() - predict_start:.2f}s, estimated cost {cost:.2f}s")
+
+            lora_start = time.time()
+            if weights:
+                # every mode shares the UNet and text encoders the weights go into
+                self.load_trained_weights(weights, self.controlnet_pipe)
+            lora_seconds = time.time() - lora_start if lora_load else None
+
+            token.raise_if_cancelled()
+            sdxl_kwargs = {}
+            if self.tuned_model:
+                # consistency with fine-tuning API
+                for k, v in self.token_map.items():
+                    prompt = prompt.replace(k, v)
+            print(f"Prompt: {prompt}")
             if controlnet_image:
-                self.load_trained_weights(replicate_weights, self.controlnet_pipe)
+                with self.spans.span("input_decode", **span_attrs):
+                    control_input = self.load_image(controlnet_image)
+                with self.spans.span("pose_detection", **span_attrs):
+                    openpose_image = self.resources.get("openpose")(control_input)
+                openpose_image = openpose_image.resize((width, height))
+
+            input_image = mask_image = control_image = None
+            if image:
+                with self.spans.span("input_decode", **span_attrs):
+                    input_image = self.load_image(image)
+                    mask_image = self.load_image(mask) if mask else None
+            if controlnet:
+                control_image = openpose_image
+            pipe_mode, image_kwargs = self.pipeline_inputs(
+                mode,
+                (width, height),
+                input_image,
+                mask_image,
+                control_image,
+                prompt_strength if image else 1.0,
+                condition_scale,
+            )
+            print(f"{mode} mode, using the {pipe_mode} pipeline")
+            pipe = self.get_pipeline(pipe_mode)
+            sdxl_kwargs.update(image_kwargs)
+            generate_size = (width, height)
+            pipe.scheduler = SCHEDULERS[scheduler].from_config(pipe.scheduler.config)
+            if preview_steps:
+                track_denoised(pipe.scheduler)
+            generator = torch.Generator(self.device).manual_seed(seed)
+
+            if batched_prompt:
+                prompts = prompt.strip().splitlines() * num_outputs
+                negative_prompts = negative_prompt.strip().splitlines() * num_outputs
             else:
-                self.load_trained_weights(replicate_weights, self.txt2img_pipe)
-
-        sdxl_kwargs = {}
-        if self.tuned_model:
-            # consistency with fine-tuning API
-            for k, v in self.token_map.items():
-                prompt = prompt.replace(k, v)
-        print(f"Prompt: {prompt}")
-        if controlnet_image:
-            openpose_image = self.openpose(self.load_image(controlnet_image))
-            openpose_image.resize((width, height))
-            openpose_image.save('openpose.jpg')
-        
-        if image and mask and controlnet_image:
-            print("controlnet inpaint mode!")
-            
-            sdxl_kwargs["image"] = self.load_image(image)
-            sdxl_kwargs["mask_image"] = self.load_image(mask)
-            sdxl_kwargs["strength"] = prompt_strength
-            sdxl_kwargs["control_image"] = openpose_image
-            sdxl_kwargs["controlnet_conditioning_scale"] = condition_scale
-            sdxl_kwargs["width"] = width
-            sdxl_kwargs["height"] = height
-            pipe = self.controlnet_pipe
+                prompts = [prompt] * num_outputs
+                negative_prompts = [negative_prompt] * num_outputs
+
+            strength = sdxl_kwargs.get("strength", 1.0)
+            degraded = False
+            if deadline is not None:
+                plan = self.cost_model.plan_for_deadline(
+                    deadline - (time.time() - predict_start),
+                    width,
+                    height,
+                    len(prompts),
+                    num_inference_steps,
+                    strength,
+                    controlnet=controlnet,
+                )
+                print(f"Deadline plan: {json.dumps(plan._asdict())}")
+                degraded = plan.degraded(num_inference_steps, width, height)
+                if degraded:
+                    num_inference_steps = plan.num_inference_steps
+                    generate_size = (plan.width, plan.height)
+                    set_pipeline_size(pipe_mode, sdxl_kwargs, generate_size)
+
+            output_size = generate_size
+            draft = quality_mode == "draft"
+            if draft:
+                generate_size = draft_size(output_size)
+                set_pipeline_size(pipe_mode, sdxl_kwargs, generate_size)
+                # at least one step of the refine pass has to run
+                refine_steps = max(num_inference_steps, math.ceil(1 / DRAFT_REFINE_STRENGTH))
+                print(f"Drafting at {generate_size}, refining at {output_size}")
+
+            common_args = {
+                "guidance_scale": guidance_scale,
+                "generator": generator,
+                "num_inference_steps": num_inference_steps,
+            }
+
+            if self.is_lora:
+                sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
 
-        else:
-            print('ERROR!')
-        
-        if not apply_watermark:
             # toggles watermark for this prediction
-            watermark_cache = pipe.watermark
-            pipe.watermark = None
+            watermark = pipe.watermark if apply_watermark else None
+            batch_size = output_batch_size or len(prompts)
+            if preview_steps:
+                preview_dir = os.path.join(output_dir, "previews")
+                print(f"Writing previews to {preview_dir}")
 
-        pipe.scheduler = SCHEDULERS[scheduler].from_config(pipe.scheduler.config)
-        generator = torch.Generator("cuda").manual_seed(seed)
+            # each image is decoded, checked and handed to the encoder on its own;
+            # it is yielded once the next one of its micro-batch is decoded, so
+            # encoding overlaps decoding but never waits for the next denoise
+            pending = None
+            output_paths = []
+            denoise_seconds = 0.0
+            decode_seconds = 0.0
+            for start in range(0, len(prompts), batch_size):
+                token.raise_if_cancelled()
+                with self.spans.span("text_encode", **span_attrs):
+                    prompt_kwargs = self.encode_prompts(
+                        pipe,
+                        prompts[start : start + batch_size],
+                        negative_prompts[start : start + batch_size],
+                        guidance_scale,
+                        lora_scale if self.is_lora else None,
+                    )
 
-        common_args = {
-            "guidance_scale": guidance_scale,
-            "generator": generator,
-            "num_inference_steps": num_inference_steps,
-        }
+                callbacks = StepCallbacks([token])
+                if preview_steps:
+                    callbacks.append(
+                        LatentPreviewer(preview_steps, preview_dir, offset=start)
+                    )
+                step_timer = StepTimer(self.spans, **span_attrs) if STEP_SPANS else None
+                if step_timer is not None:
+                    callbacks.append(step_timer)
+                sdxl_kwargs["callback_on_step_end"] = callbacks
 
-        if batched_prompt:
-            sdxl_kwargs["prompt"] = prompt.strip().splitlines() * num_outputs
-            sdxl_kwargs["negative_prompt"] = negative_prompt.strip().splitlines() * num_outputs
-        else:
-            sdxl_kwargs["prompt"] =  [prompt] * num_outputs
-            sdxl_kwargs["negative_prompt"] = [negative_prompt] * num_outputs
+                # the image to start from is encoded inside the pipeline
+                with (
+                    self.spans.span("denoise", **span_attrs) as span,
+                    self.vae_tiling.apply(pipe.vae, *generate_size, batch_size),
+                    FeatureCache(feature_cache_interval).apply(pipe),
+                    TokenMerging(token_merging_ratio).apply(pipe),
+                    self.tiled_diffusion.apply(pipe, *generate_size),
+                ):
+                    latents = pipe(
+                        **common_args,
+                        **sdxl_kwargs,
+                        **prompt_kwargs,
+                        output_type="latent",
+                    ).images
+                denoise_seconds += span.seconds
 
-        if self.is_lora:
-            sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
+                if draft:
+                    token.raise_if_cancelled()
+                    with self.spans.span("draft_upscale", **span_attrs):
+                        drafts = [
+                            self.decode_latents(pipe, latent.unsqueeze(0))[0].resize(
+                                output_size, Image.LANCZOS
+                            )
+                            for latent in latents
+                        ]
+                    refine_mode, refine_kwargs = self.pipeline_inputs(
+                        REFINE_MODES.get(mode, mode),
+                        output_size,
+                        drafts,
+                        mask_image,
+                        control_image,
+                        DRAFT_REFINE_STRENGTH,
+                        condition_scale,
+                    )
+                    refine_pipe = self.get_pipeline(refine_mode)
+                    refine_pipe.scheduler = SCHEDULERS[scheduler].from_config(
+                        refine_pipe.scheduler.config
+                    )
+                    if preview_steps:
+                        track_denoised(refine_pipe.scheduler)
+                    for name in ("cross_attention_kwargs", "callback_on_step_end"):
+                        if name in sdxl_kwargs:
+                            refine_kwargs[name] = sdxl_kwargs[name]
+                    with (
+                        self.spans.span("denoise", **span_attrs) as span,
+                        self.vae_tiling.apply(refine_pipe.vae, *output_size, batch_size),
+                        FeatureCache(feature_cache_interval).apply(refine_pipe),
+                        TokenMerging(token_merging_ratio).apply(refine_pipe),
+                        self.tiled_diffusion.apply(refine_pipe, *output_size),
+                    ):
+                        if step_timer is not None:
+                            # not from the last draft step, through the draft decode
+                            step_timer.restart()
+                        latents = refine_pipe(
+                            **dict(common_args, num_inference_steps=refine_steps),
+                            **refine_kwargs,
+                            **prompt_kwargs,
+                            output_type="latent",
+                        ).images
+                    denoise_seconds += span.seconds
 
-        output = pipe(**common_args, **sdxl_kwargs)
+                for i, latent in enumerate(latents, start=start):
+                    token.raise_if_cancelled()
+                    with (
+                        self.spans.span("vae_decode", **span_attrs) as span,
+                        self.vae_tiling.apply(pipe.vae, *output_size),
+                    ):
+                        image = self.decode_latents(pipe, latent.unsqueeze(0), watermark)[0]
+                    decode_seconds += span.seconds
+                    if image.size != (width, height):
+                        # generated at a lower resolution to meet the deadline
+                        image = image.resize((width, height), Image.LANCZOS)
 
+                    token.raise_if_cancelled()
+                    if not disable_safety_checker:
+                        with self.spans.span("safety_check", **span_attrs):
+                            _, has_nsfw_content = self.run_safety_checker([image])
+                        if has_nsfw_content[0]:
+                            print(f"NSFW content detected in image {i}")
+                            continue
 
-        if not apply_watermark:
-            pipe.watermark = watermark_cache
+                    future = self.output_encoder.submit(
+                        image, output_dir, i, output_format, output_quality
+                    )
+                    if pending is not None:
+                        output_paths.append(pending.result())
+                        yield Path(output_paths[-1])
+                    pending = future
 
-        if not disable_safety_checker:
-            _, has_nsfw_content = self.run_safety_checker(output.images)
+                if pending is not None:
+                    output_paths.append(pending.result())
+                    yield Path(output_paths[-1])
+                    pending = None
 
-        output_paths = []
-        for i, image in enumerate(output.images):
-            if not disable_safety_checker:
-                if has_nsfw_content[i]:
-                    print(f"NSFW content detected in image {i}")
-                    continue
-            output_path = f"/tmp/out-{i}.png"
-            image.save(output_path)
-            output_paths.append(Path(output_path))
+            if not draft and feature_cache_interval == 1 and token_merging_ratio == 0:
+                # the two passes of a draft, reused features and merged tokens do
+                # not fit the per-step costs of the model
+                self.cost_model.observe(
+                    *generate_size,
+                    len(prompts),
+                    denoising_steps(num_inference_steps, strength),
+                    denoise_seconds,
+                    decode_seconds,
+                    time.time() - ticket.started,
+                    controlnet=controlnet,
+                    lora_seconds=lora_seconds,
+                )
+            self.spans.finish(predict_span)
+            print(f"Memory: {json.dumps(predict_span.memory)}")
 
-        if len(output_paths) == 0:
-            raise Exception(
-                f"NSFW content detected. Try running it again, or try a different prompt."
-            )
+            if cache_key is not None and output_paths and not degraded:
+                self.result_cache.put(cache_key, output_paths)
+
+            if not output_paths:
+                raise Exception(
+                    f"NSFW content detected. Try running it again, or try a different prompt."
+                )
+        except PredictionCancelled as e:
+            cancel_reason = str(e)
+        finally:
+            if ticket is not None:
+                self.admission.release(ticket)
+            self.finish_cancellation(supersede_key, token)
+            self.output_encoder.release_dir(output_dir)
+            profiling.close()
+            self.spans.flush()
 
-        return output_paths
+        if cancel_reason is not None:
+            # the aborted pipeline frames are released by now, hand their memory back
+            gc.collect()
+            torch.cuda.empty_cache()
+            print(f"Prediction cancelled: {cancel_reason}")
+            raise PredictionCancelled(cancel_reason)
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+# Linear approximation of the SDXL VAE decoder, mapping the 4 latent channels
+# to RGB in [-1, 1]. Good enough to see composition and colors.
+SDXL_LATENT_RGB_FACTORS = [
+    #   R        G        B
+    [0.3920, 0.4054, 0.4549],
+    [-0.2634, -0.0196, 0.0653],
+    [0.0568, 0.1687, -0.0755],
+    [-0.3112, -0.2359, -0.2076],
+]
+
+
+def latents_to_rgb(latents: torch.Tensor) -> np.ndarray:
+    """
+    Approximate decode of a batch of SDXL latents without running the VAE.
+
+    :param latents: Latents of shape (batch, 4, h, w), as seen inside the denoising loop.
+    :return: uint8 array of shape (batch, h, w, 3).
+    """
+    factors = torch.tensor(
+        SDXL_LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device
+    )
+    rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors)
+    rgb = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8)
+    return rgb.cpu().numpy()
+
+
+def track_denoised(scheduler) -> None:
+    """
+    Keep the estimate of the final latents each step of `scheduler` returns
+    (`denoised` or `pred_original_sample`) as `scheduler.preview_x0`. Schedulers
+    that return none, e.g. DPMSolverMultistep, leave it None.
+    """
+    step = scheduler.step
+    scheduler.preview_x0 = None
+
+    def tracked(*args, return_dict: bool = True, **kwargs):
+        output = step(*args, return_dict=True, **kwargs)
+        x0 = getattr(output, "denoised", None)
+        if x0 is None:
+            x0 = getattr(output, "pred_original_sample", None)
+        scheduler.preview_x0 = x0
+        # the pipelines only read the first item, prev_sample
+        return output if return_dict else output.to_tuple()
+
+    scheduler.step = tracked
+
+
+class LatentPreviewer:
+    def __init__(self, every: int, dest_dir: str, offset: int = 0):
+        """
+        LatentPreviewer is a `callback_on_step_end` for diffusers pipelines that
+        writes a small preview of every image in the batch each `every` steps.
+
+        Previews show the scheduler's estimate of the final image when it was
+        set up with track_denoised(), and the noisy latents otherwise, which
+        show little but noise in early steps.
+
+        Previews are written to `preview-{index}.jpg` in `dest_dir` and replaced
+        atomically, so a client polling the files never reads a partial image.
+
+        :param every: Write previews every this many steps.
+        :param dest_dir: Directory to write the previews to.
+        :param offset: Index of the first image of the batch within the request.
+        """
+        self.every = every
+        self.dest_dir = dest_dir
+        self.offset = offset
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+
+    def __call__(self, pipe, step: int, timestep: int, callback_kwargs: dict) -> dict:
+        if (step + 1) % self.every == 0:
+            latents = callback_kwargs["latents"]
+            x0 = getattr(pipe.scheduler, "preview_x0", None)
+            self.write(x0 if x0 is not None and x0.shape == latents.shape else latents)
+        return callback_kwargs
+
+    def write(self, latents: torch.Tensor) -> None:
+        for i, preview in enumerate(latents_to_rgb(latents), start=self.offset):
+            path = os.path.join(self.dest_dir, f"preview-{i}.jpg")
+            Image.fromarray(preview).save(path + ".tmp", "JPEG", quality=80)
+            os.replace(path + ".tmp", path)
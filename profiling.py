@@ -0,0 +1,67 @@
+import contextlib
+import os
+import random
+
+import torch
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+
+class RequestProfiler:
+    def __init__(
+        self,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        base_dir: str = PROFILE_DIR,
+        row_limit: int = 30,
+    ):
+        """
+        RequestProfiler wraps single predictions in torch.profiler.
+
+        A prediction is profiled when it asks for it, or at random with
+        probability `sample_rate` so a small share of production traffic can be
+        captured. Each capture writes `trace.json` (chrome://tracing / Perfetto)
+        and `top_ops.txt`, a table of the most expensive operators, to its own
+        directory under `base_dir`.
+
+        :param sample_rate: Probability of profiling a prediction that did not ask for it.
+        :param base_dir: Directory under which per-request artifact directories are created.
+        :param row_limit: Number of operators in top_ops.txt.
+        """
+        self.sample_rate = sample_rate
+        self.base_dir = base_dir
+        self.row_limit = row_limit
+
+    def should_profile(self, requested: bool = False) -> bool:
+        return requested or random.random() < self.sample_rate
+
+    @contextlib.contextmanager
+    def capture(self, request: str):
+        """
+        Profile the body of a with-statement.
+
+        :param request: Name of the artifact directory.
+        :return: Path to the artifact directory, as the with-statement target.
+        """
+        dest = os.path.join(self.base_dir, request)
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+
+        cuda = torch.cuda.is_available()
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        print(f"Profiling to {dest}")
+        with torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True
+        ) as prof:
+            yield dest
+
+        prof.export_chrome_trace(os.path.join(dest, "trace.json"))
+        table = prof.key_averages().table(
+            sort_by="self_cuda_time_total" if cuda else "self_cpu_time_total",
+            row_limit=self.row_limit,
+        )
+        with open(os.path.join(dest, "top_ops.txt"), "w") as f:
+            f.write(table)
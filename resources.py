@@ -0,0 +1,139 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import torch
+
+# Device memory the lazily loaded components may use together, unlimited when unset
+LAZY_DEVICE_BUDGET = os.environ.get("LAZY_DEVICE_BUDGET")
+
+OFFLOAD_TARGETS = ["cpu", "disk", "none"]
+
+
+def tensor_bytes(value: Any, depth: int = 3) -> int:
+    """
+    Size of the parameters and buffers held by a module, or by the modules
+    found in the attributes of a plain object (e.g. OpenposeDetector).
+    """
+    if isinstance(value, torch.nn.Module):
+        return sum(
+            t.numel() * t.element_size()
+            for t in list(value.parameters()) + list(value.buffers())
+        )
+    if depth == 0 or not hasattr(value, "__dict__"):
+        return 0
+    return sum(tensor_bytes(v, depth - 1) for v in vars(value).values())
+
+
+class LazyResource:
+    def __init__(self, name: str, loader: Callable[[], Any], offload: str = "cpu"):
+        """
+        :param name: Name of the resource, also used for its load span.
+        :param loader: Builds the resource, on CPU or on the target device.
+        :param offload: Where the resource goes when evicted from the device:
+            "cpu" keeps it in host memory, "disk" drops it so it is loaded again
+            on next use, "none" never evicts it.
+        """
+        if offload not in OFFLOAD_TARGETS:
+            raise ValueError(
+                f"Unknown offload target {offload}, expected one of {OFFLOAD_TARGETS}"
+            )
+        self.name = name
+        self.loader = loader
+        self.offload = offload
+        self.value = None
+        self.on_device = False
+        self.nbytes = 0
+
+
+class ResourceManager:
+    def __init__(
+        self,
+        device: str = "cuda",
+        budget_bytes: Optional[int] = int(LAZY_DEVICE_BUDGET) if LAZY_DEVICE_BUDGET else None,
+        spans=None,
+    ):
+        """
+        ResourceManager holds optional components that are only built, and only
+        moved to the device, the first time a prediction needs them.
+
+        When a component is moved to the device and the components on the device
+        would then exceed `budget_bytes`, the least recently used ones are evicted
+        according to their offload target. A component larger than the budget
+        on its own is still loaded.
+
+        :param device: Device the components run on.
+        :param budget_bytes: Device memory the components may use together, None for no limit.
+        :param spans: Optional SpanRecorder, records a `load_{name}` span per load.
+        """
+        self.device = device
+        self.budget_bytes = budget_bytes
+        self.spans = spans
+        self.resources: "OrderedDict[str, LazyResource]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(self, name: str, loader: Callable[[], Any], offload: str = "cpu") -> None:
+        """
+        Register a component without loading it. See LazyResource.
+        """
+        with self._lock:
+            self.resources[name] = LazyResource(name, loader, offload)
+
+    def loaded(self, name: str) -> bool:
+        return self.resources[name].value is not None
+
+    def device_bytes(self) -> int:
+        """
+        Bytes used on the device by the components currently there.
+        """
+        with self._lock:
+            return sum(r.nbytes for r in self.resources.values() if r.on_device)
+
+    def get(self, name: str) -> Any:
+        """
+        Return a component on the device, loading it or bringing it back from
+        host memory first when needed.
+        """
+        with self._lock:
+            resource = self.resources[name]
+            self.resources.move_to_end(name)
+            if resource.value is None:
+                print(f"Loading {name}...")
+                start = time.time()
+                resource.value = resource.loader()
+                if self.spans is not None:
+                    self.spans.record(f"load_{name}", time.time() - start, phase="predict")
+                resource.nbytes = tensor_bytes(resource.value)
+            if not resource.on_device:
+                self._make_room(resource)
+                if hasattr(resource.value, "to"):
+                    resource.value = resource.value.to(self.device) or resource.value
+                resource.on_device = True
+            return resource.value
+
+    def evict(self, name: str) -> None:
+        """
+        Move a component off the device according to its offload target.
+        """
+        with self._lock:
+            resource = self.resources[name]
+            if not resource.on_device or resource.offload == "none":
+                return
+            print(f"Offloading {name} to {resource.offload}")
+            if resource.offload == "cpu" and hasattr(resource.value, "to"):
+                resource.value = resource.value.to("cpu") or resource.value
+            else:
+                resource.value = None
+            resource.on_device = False
+
+    def _make_room(self, incoming: LazyResource) -> None:
+        if self.budget_bytes is None:
+            return
+        # least recently used first, the incoming resource was just moved last
+        for resource in list(self.resources.values()):
+            if self.device_bytes() + incoming.nbytes <= self.budget_bytes:
+                return
+            if resource is not incoming:
+                self.evict(resource.name)
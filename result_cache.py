@@ -0,0 +1,165 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/src/result-cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 2 * (2**30)))
+
+# part of every key, bump it when a code change alters the images for the same inputs
+KEY_VERSION = 1
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _output_index(name: str) -> int:
+    # out-{index}.{format}
+    return int(name.split(".")[0].split("-")[1])
+
+
+class ResultCache:
+    def __init__(
+        self, base_dir: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES
+    ):
+        """
+        ResultCache stores the output images of deterministic predictions on disk,
+        keyed by a hash of everything that determines them, so that resubmitting
+        a request returns the stored images without running the model.
+
+        Entries are directories named after their key. The least recently used
+        ones are removed once the cache grows beyond `max_bytes`. The index is
+        rebuilt from disk on startup, ordered by last use.
+
+        :param base_dir: Directory to store results in.
+        :param max_bytes: Maximum total size of the stored images, 0 disables the cache.
+        """
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        if not self.enabled:
+            return
+
+        if not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+        found = []
+        for name in os.listdir(base_dir):
+            path = os.path.join(base_dir, name)
+            if name.startswith(".tmp-"):
+                # left over by an interrupted put()
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.isdir(path):
+                size = sum(
+                    os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                )
+                found.append((os.path.getmtime(path), name, size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        self._evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def cache_info(self) -> str:
+        """
+        Get cache information.
+
+        :return: Cache information.
+        """
+        return f"CacheInfo(hits={self._hits}, misses={self._misses}, base_dir='{self.base_dir}', currsize={len(self.entries)}, bytes={self.size})"
+
+    def key(self, inputs: Dict[str, object], files: Dict[str, Optional[str]]) -> str:
+        """
+        Hash the inputs of a prediction.
+
+        :param inputs: JSON serializable inputs, including the seed and the
+            identity of the loaded weights.
+        :param files: Input files by name, hashed by content. None for absent inputs.
+        :return: Hex digest identifying the result.
+        """
+        document = {
+            "version": KEY_VERSION,
+            "inputs": inputs,
+            "files": {
+                name: _file_digest(str(path)) if path is not None else None
+                for name, path in files.items()
+            },
+        }
+        return hashlib.sha256(
+            json.dumps(document, sort_keys=True).encode()
+        ).hexdigest()
+
+    def get(self, key: str, dest_dir: str) -> Optional[List[str]]:
+        """
+        Copy a stored result into `dest_dir` and mark it as recently used.
+
+        :return: Paths of the copied images in output order, None on a miss.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self.entries:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self.entries.move_to_end(key)
+            path = os.path.join(self.base_dir, key)
+            os.utime(path)
+            paths = []
+            for name in sorted(os.listdir(path), key=_output_index):
+                dest = os.path.join(dest_dir, name)
+                try:
+                    os.link(os.path.join(path, name), dest)
+                except OSError:
+                    # e.g. across file systems
+                    shutil.copyfile(os.path.join(path, name), dest)
+                paths.append(dest)
+        return paths
+
+    def put(self, key: str, paths: List[str]) -> None:
+        """
+        Store the images of a result, evicting the least recently used results
+        to stay under max_bytes. Results larger than the whole cache are not stored.
+        """
+        size = sum(os.path.getsize(p) for p in paths)
+        if not self.enabled or size > self.max_bytes:
+            return
+
+        # copy outside the lock into a temporary directory, then rename into place
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.base_dir)
+        for p in paths:
+            shutil.copyfile(p, os.path.join(tmp, os.path.basename(p)))
+        with self._lock:
+            dest = os.path.join(self.base_dir, key)
+            if key in self.entries:
+                shutil.rmtree(tmp, ignore_errors=True)
+                self.entries.move_to_end(key)
+                return
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            os.replace(tmp, dest)
+            self.entries[key] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.entries and self.size > self.max_bytes:
+            oldest, size = self.entries.popitem(last=False)
+            self.size -= size
+            shutil.rmtree(os.path.join(self.base_dir, oldest), ignore_errors=True)
@@ -0,0 +1,342 @@
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import json
+import os
+import struct
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+
+import torch
+
+from no_init import materialize, no_init_or_tensor
+
+LOAD_THREADS = int(os.environ.get("LOAD_THREADS", min(8, os.cpu_count() or 1)))
+
+# consecutive tensors are read together in runs of about this many bytes
+CHUNK_BYTES = 64 * (2**20)
+
+# buffers per preadv call, the POSIX minimum for IOV_MAX
+IOV_MAX = 1024
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+# file names of diffusers and transformers checkpoints, without extension
+WEIGHTS_NAMES = ["diffusion_pytorch_model", "model"]
+
+
+class TensorInfo(NamedTuple):
+    name: str
+    dtype: torch.dtype
+    shape: tuple
+    # offsets in the file
+    start: int
+    end: int
+
+
+def read_header(path: str) -> List[TensorInfo]:
+    """
+    Read the tensor table of a safetensors file.
+
+    :return: The tensors, in file order.
+    """
+    with open(path, "rb") as f:
+        (size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size))
+    header.pop("__metadata__", None)
+    data_start = 8 + size
+    infos = [
+        TensorInfo(
+            name,
+            DTYPES[info["dtype"]],
+            tuple(info["shape"]),
+            data_start + info["data_offsets"][0],
+            data_start + info["data_offsets"][1],
+        )
+        for name, info in header.items()
+    ]
+    return sorted(infos, key=lambda info: info.start)
+
+
+def _chunks(infos: List[TensorInfo], chunk_bytes: int) -> List[List[TensorInfo]]:
+    chunks = []
+    for info in infos:
+        if (
+            chunks
+            and chunks[-1][-1].end == info.start
+            and info.end - chunks[-1][0].start <= chunk_bytes
+        ):
+            chunks[-1].append(info)
+        else:
+            chunks.append([info])
+    return chunks
+
+
+def _buffer(tensor: torch.Tensor) -> memoryview:
+    # the memory of a contiguous CPU tensor, to read into without a copy
+    nbytes = tensor.numel() * tensor.element_size()
+    return memoryview((ctypes.c_char * nbytes).from_address(tensor.data_ptr())).cast("B")
+
+
+def _read_into(fd: int, buffers: List[memoryview], offset: int) -> None:
+    # fill the buffers with consecutive bytes of the file, in as few reads as possible
+    buffers = [b for b in buffers if len(b)]
+    while buffers:
+        if hasattr(os, "preadv"):
+            n = os.preadv(fd, buffers[:IOV_MAX], offset)
+        else:
+            data = os.pread(fd, len(buffers[0]), offset)
+            n = len(data)
+            buffers[0][:n] = data
+        if n == 0:
+            raise EOFError(f"Unexpected end of file at offset {offset}")
+        offset += n
+        while buffers and n >= len(buffers[0]):
+            n -= len(buffers[0])
+            buffers.pop(0)
+        if n:
+            buffers[0] = buffers[0][n:]
+
+
+def _load_chunk(
+    path: str,
+    chunk: List[TensorInfo],
+    device: Optional[Union[str, torch.device]],
+    dtype: Optional[torch.dtype],
+    targets: Optional[Dict[str, torch.Tensor]],
+) -> Dict[str, torch.Tensor]:
+    dests = []
+    for info in chunk:
+        target = targets.get(info.name) if targets is not None else None
+        if (
+            target is not None
+            and target.device.type == "cpu"
+            and target.dtype == info.dtype
+            and tuple(target.shape) == info.shape
+            and target.is_contiguous()
+        ):
+            # straight into the parameter
+            dests.append(target.data)
+        else:
+            dests.append(torch.empty(info.shape, dtype=info.dtype))
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _read_into(fd, [_buffer(dest) for dest in dests], chunk[0].start)
+    finally:
+        os.close(fd)
+
+    tensors = {}
+    for info, dest in zip(chunk, dests):
+        if targets is not None:
+            target = targets[info.name]
+            if dest is not target.data:
+                # converts the dtype and copies to the device in one go
+                target.data.copy_(dest)
+            continue
+        tensors[info.name] = dest.to(
+            device=device,
+            dtype=dtype if dtype is not None and dest.is_floating_point() else None,
+        )
+    return tensors
+
+
+def _load(
+    paths: Union[str, Sequence[str]],
+    device,
+    dtype,
+    threads: int,
+    keys: Optional[Iterable[str]],
+    targets: Optional[Dict[str, torch.Tensor]],
+) -> Dict[str, torch.Tensor]:
+    paths = [paths] if isinstance(paths, (str, os.PathLike)) else paths
+    keys = set(keys) if keys is not None else None
+    jobs = []
+    for path in paths:
+        infos = [
+            info for info in read_header(str(path)) if keys is None or info.name in keys
+        ]
+        jobs.extend((str(path), chunk) for chunk in _chunks(infos, CHUNK_BYTES))
+
+    tensors = {}
+    # while one thread converts the tensors of its chunk, the others keep reading
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(threads, len(jobs))), thread_name_prefix="load"
+    ) as executor:
+        futures = [
+            executor.submit(_load_chunk, path, chunk, device, dtype, targets)
+            for path, chunk in jobs
+        ]
+        for future in futures:
+            tensors.update(future.result())
+    return tensors
+
+
+def load_file(
+    paths: Union[str, Sequence[str]],
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: Optional[torch.dtype] = None,
+    threads: int = LOAD_THREADS,
+    keys: Optional[Iterable[str]] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Load a safetensors file, or the shards of one checkpoint, with a pool of
+    threads. Consecutive tensors are read together with one large sequential
+    read, directly into their own memory.
+
+    :param paths: File or list of shard files.
+    :param device: Device for the tensors, CPU when None.
+    :param dtype: Dtype for the floating point tensors, the file's when None.
+    :param threads: Number of reading threads.
+    :param keys: Names of the tensors to load, all when None.
+    :return: Tensors by name.
+    """
+    return _load(paths, device, dtype, threads, keys, targets=None)
+
+
+def load_into(
+    module: torch.nn.Module,
+    paths: Union[str, Sequence[str]],
+    threads: int = LOAD_THREADS,
+    strict: bool = True,
+) -> List[str]:
+    """
+    Load a safetensors checkpoint into the existing parameters and buffers of
+    a module, like `load_state_dict`. CPU tensors of the same dtype are read
+    into directly, the others are copied over with a dtype conversion.
+
+    :param module: Module to load into.
+    :param paths: File or list of shard files.
+    :param threads: Number of reading threads.
+    :param strict: Whether to raise when the module has tensors the checkpoint lacks.
+    :return: Names of the module's tensors missing from the checkpoint.
+    """
+    paths = [paths] if isinstance(paths, (str, os.PathLike)) else paths
+    targets = module.state_dict(keep_vars=True)
+    names = {info.name for path in paths for info in read_header(str(path))}
+    missing = [name for name in targets if name not in names]
+    if strict and missing:
+        raise RuntimeError(
+            f"Error loading {type(module).__name__}: missing keys {missing}"
+        )
+    with torch.no_grad():
+        _load(paths, None, None, threads, keys=names & targets.keys(), targets=targets)
+    return missing
+
+
+def _add_variant(filename: str, variant: Optional[str]) -> str:
+    if not variant:
+        return filename
+    parts = filename.split(".")
+    return ".".join(parts[:-1] + [variant] + parts[-1:])
+
+
+def checkpoint_files(model_dir: str, variant: Optional[str] = None) -> List[str]:
+    """
+    Find the safetensors files of a diffusers or transformers model directory.
+
+    :return: The single file or the shards, empty when there are none.
+    """
+    for name in WEIGHTS_NAMES:
+        path = os.path.join(model_dir, _add_variant(f"{name}.safetensors", variant))
+        if os.path.exists(path):
+            return [path]
+        index = os.path.join(
+            model_dir, _add_variant(f"{name}.safetensors.index.json", variant)
+        )
+        if os.path.exists(index):
+            with open(index) as f:
+                shards = sorted(set(json.load(f)["weight_map"].values()))
+            return [os.path.join(model_dir, shard) for shard in shards]
+    return []
+
+
+def load_model(
+    model_class,
+    path: str,
+    subfolder: Optional[str] = None,
+    device: Union[str, torch.device] = "cpu",
+    dtype: Optional[torch.dtype] = None,
+    variant: Optional[str] = None,
+    threads: int = LOAD_THREADS,
+    **kwargs,
+):
+    """
+    Build a diffusers or transformers model on the meta device and load its
+    safetensors checkpoint with load_file, in `dtype` on `device`. Other
+    checkpoints, e.g. .bin files or hub repos, go through from_pretrained.
+
+    :param model_class: E.g. UNet2DConditionModel or CLIPTextModel.
+    :param path: Model directory, or the pipeline directory with `subfolder`.
+    :param kwargs: Passed to from_pretrained when falling back to it.
+    """
+    model_dir = os.path.join(path, subfolder) if subfolder else path
+    files = checkpoint_files(model_dir, variant) if os.path.isdir(model_dir) else []
+    if not files:
+        print(f"No safetensors checkpoint in {model_dir}, using from_pretrained")
+        return model_class.from_pretrained(
+            path,
+            subfolder=subfolder,
+            torch_dtype=dtype,
+            variant=variant,
+            low_cpu_mem_usage=True,
+            device_map={"": device},
+            **kwargs,
+        )
+
+    model = empty_model(model_class, model_dir)
+    expected = model.state_dict(keep_vars=True).keys()
+    materialize(
+        model,
+        load_file(files, device=device, dtype=dtype, threads=threads, keys=expected),
+        strict=False,
+    )
+    return finish_model(model, model_dir)
+
+
+def empty_model(model_class, config: Union[str, dict]):
+    """
+    Build a diffusers or transformers model on the meta device.
+
+    :param model_class: E.g. UNet2DConditionModel or CLIPTextModel.
+    :param config: Model directory, or the config as a dict.
+    """
+    config_class = getattr(model_class, "config_class", None)
+    with no_init_or_tensor():
+        if config_class is not None:
+            # transformers
+            if isinstance(config, dict):
+                return model_class(config_class.from_dict(config))
+            return model_class(config_class.from_pretrained(config))
+        if not isinstance(config, dict):
+            config = model_class.load_config(config)
+        return model_class.from_config(config)
+
+
+def finish_model(model, source: str):
+    """
+    Tie the weights of a model built by empty_model() once its tensors are
+    materialized, check that none is left on the meta device and switch it to
+    eval mode.
+
+    :param source: Where the tensors came from, for the error message.
+    """
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    missing = [
+        name for name, tensor in model.state_dict(keep_vars=True).items() if tensor.is_meta
+    ]
+    if missing:
+        raise RuntimeError(
+            f"Error loading {type(model).__name__} from {source}: missing keys {missing}"
+        )
+    return model.eval()
@@ -0,0 +1,22 @@
+# Run this after download_weights.py, before you deploy. It saves the UNet with
+# the LCM LoRA already fused, so that setup memory-maps it instead of
+# downloading and fusing the LoRA on every boot. Setup falls back to fusing
+# when the snapshot was built from other inputs.
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from predict import SNAPSHOT_INPUTS, Predictor
+from snapshot import FusedSnapshot, snapshot_fingerprint
+
+fingerprint = snapshot_fingerprint(SNAPSHOT_INPUTS)
+snapshot = FusedSnapshot()
+if snapshot.matches(fingerprint):
+    print("Fused snapshot is up to date:", snapshot.base_dir)
+else:
+    predictor = Predictor()
+    predictor.setup()
+    snapshot.save(predictor.controlnet_pipe, fingerprint)
+    print("Saved fused snapshot to", snapshot.base_dir)
@@ -0,0 +1,164 @@
+import atexit
+import fcntl
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, List
+
+import torch
+from safetensors.torch import save_file
+
+from no_init import materialize
+from safetensors_loader import empty_model, finish_model, read_header
+
+# e.g. /dev/shm/sdxl-weights, sharing is off when unset
+SHARED_WEIGHTS_DIR = os.environ.get("SHARED_WEIGHTS_DIR")
+
+
+def _model_config(module) -> dict:
+    # transformers configs are objects, diffusers configs are dicts
+    config = module.config
+    return config.to_dict() if hasattr(config, "to_dict") else dict(config)
+
+
+class SharedWeights:
+    def __init__(self, base_dir: str, key: str):
+        """
+        SharedWeights lets predictor processes on one host share the frozen
+        weights of their models instead of each loading its own copy.
+
+        The first process publishes a module: its tensors are written as
+        safetensors under `base_dir` (on /dev/shm, that is shared memory) and
+        the module is switched over to them. The other processes attach: they
+        build the module on the meta device and map the same file. Mappings are
+        copy-on-write, so a process that modifies a weight, e.g. to load a
+        fine-tune, gets a private copy of those pages and the others do not
+        see the change.
+
+        Every process holds a shared lock on the store while it is open. The
+        kernel drops it when a process dies, so the last process to close the
+        store, or the next one after a crash, removes it.
+
+        :param base_dir: Directory for the stores, e.g. /dev/shm/sdxl-weights.
+        :param key: Identity of the weights, stores of other keys are left alone.
+        """
+        self.path = os.path.join(base_dir, key)
+        self._maps: List[mmap.mmap] = []
+        self._lock_fd = None
+        self._open()
+        atexit.register(self.close)
+
+    def _open(self) -> None:
+        lock_path = os.path.join(self.path, "refs.lock")
+        while True:
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            except FileNotFoundError:
+                # removed by the last user in between
+                continue
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                    self._lock_fd = fd
+                    return
+            except FileNotFoundError:
+                pass
+            # the store was removed while waiting for the lock
+            os.close(fd)
+
+    def _files(self, name: str):
+        return (
+            os.path.join(self.path, f"{name}.safetensors"),
+            os.path.join(self.path, f"{name}.json"),
+        )
+
+    def has(self, name: str) -> bool:
+        return all(os.path.exists(path) for path in self._files(name))
+
+    def publish(self, name: str, module: torch.nn.Module) -> None:
+        """
+        Write the tensors of a CPU module, unless another process already did,
+        and switch the module over to the shared ones.
+        """
+        tensors_path, config_path = self._files(name)
+        with open(os.path.join(self.path, "publish.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.has(name):
+                print(f"Publishing {name} to {self.path}")
+                state = {
+                    key: value.detach().contiguous()
+                    for key, value in module.state_dict().items()
+                }
+                tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+                try:
+                    save_file(state, os.path.join(tmp, "tensors"))
+                    with open(os.path.join(tmp, "config"), "w") as f:
+                        json.dump({"config": _model_config(module)}, f)
+                    # the tensors last, has() checks for them
+                    os.replace(os.path.join(tmp, "config"), config_path)
+                    os.replace(os.path.join(tmp, "tensors"), tensors_path)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+        with torch.no_grad():
+            materialize(module, self._map(tensors_path))
+
+    def attach(self, name: str, model_class):
+        """
+        Build a published module on the meta device and give it the shared tensors.
+        """
+        tensors_path, config_path = self._files(name)
+        print(f"Attaching {name} from {self.path}")
+        with open(config_path) as f:
+            config = json.load(f)["config"]
+        model = empty_model(model_class, config)
+        materialize(model, self._map(tensors_path), strict=False)
+        return finish_model(model, tensors_path)
+
+    def attach_or_publish(self, name: str, model_class, loader: Callable[[], torch.nn.Module]):
+        """
+        Attach a module when it was published, otherwise load it with `loader` and publish it.
+        """
+        if self.has(name):
+            return self.attach(name, model_class)
+        module = loader()
+        self.publish(name, module)
+        return module
+
+    def _map(self, path: str) -> Dict[str, torch.Tensor]:
+        with open(path, "rb") as f:
+            # copy-on-write: pages stay shared until written to
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        # tensors point into the mapping, which is never closed
+        self._maps.append(mapped)
+        tensors = {}
+        for info in read_header(path):
+            itemsize = torch.empty((), dtype=info.dtype).element_size()
+            count = (info.end - info.start) // itemsize
+            if count == 0:
+                tensors[info.name] = torch.empty(info.shape, dtype=info.dtype)
+                continue
+            tensors[info.name] = torch.frombuffer(
+                mapped, dtype=info.dtype, count=count, offset=info.start
+            ).view(info.shape)
+        return tensors
+
+    def close(self) -> None:
+        """
+        Drop this process's reference, removing the store when it was the last.
+        Mapped tensors stay valid.
+        """
+        if self._lock_fd is None:
+            return
+        fd, self._lock_fd = self._lock_fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # still in use by another process
+            os.close(fd)
+            return
+        print(f"Removing shared weights {self.path}")
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.close(fd)
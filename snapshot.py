@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, Optional, Sequence
+
+import diffusers
+import torch
+
+from safetensors_loader import load_model
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "./fused-cache")
+
+# modules the LCM LoRA is fused into, the other ones are loaded from the base weights
+SNAPSHOT_MODULES = ("unet",)
+
+# part of every fingerprint, bump it when a code change alters how the snapshot is built
+SNAPSHOT_VERSION = 1
+
+FINGERPRINT_FILE = "fingerprint.json"
+
+
+def snapshot_fingerprint(inputs: Dict[str, object]) -> str:
+    """
+    Hash the inputs the snapshotted weights were computed from.
+
+    :param inputs: JSON serializable identity of the base weights, the fused
+        adapters and the dtype. The library versions are added here.
+    :return: Hex digest.
+    """
+    document = {
+        "version": SNAPSHOT_VERSION,
+        "diffusers": diffusers.__version__,
+        "torch": torch.__version__,
+        "inputs": inputs,
+    }
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()
+
+
+class FusedSnapshot:
+    def __init__(self, base_dir: str = SNAPSHOT_DIR):
+        """
+        FusedSnapshot stores pipeline modules after adapters were fused into
+        them, so that setup loads the result instead of redoing the arithmetic.
+
+        Each module is saved with save_pretrained as safetensors, which
+        load_model reads straight into the model. The fingerprint of the
+        inputs is written last, so an interrupted save never matches.
+
+        :param base_dir: Directory holding the snapshot.
+        """
+        self.base_dir = base_dir
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        """
+        Fingerprint of the stored snapshot, None when there is none.
+        """
+        try:
+            with open(os.path.join(self.base_dir, FINGERPRINT_FILE)) as f:
+                return json.load(f)["fingerprint"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def matches(self, fingerprint: str) -> bool:
+        return self.fingerprint == fingerprint
+
+    def save(
+        self, pipe, fingerprint: str, modules: Sequence[str] = SNAPSHOT_MODULES
+    ) -> None:
+        """
+        Replace the snapshot with the modules of `pipe`.
+
+        :param pipe: Pipeline with the adapters already fused.
+        :param fingerprint: Fingerprint of the inputs, see snapshot_fingerprint.
+        :param modules: Names of the pipeline modules to store.
+        """
+        parent = os.path.dirname(os.path.abspath(self.base_dir))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-snapshot-", dir=parent)
+        try:
+            for name in modules:
+                getattr(pipe, name).save_pretrained(
+                    os.path.join(tmp, name), safe_serialization=True
+                )
+            with open(os.path.join(tmp, FINGERPRINT_FILE), "w") as f:
+                json.dump({"fingerprint": fingerprint, "modules": list(modules)}, f)
+            if os.path.exists(self.base_dir):
+                shutil.rmtree(self.base_dir)
+            os.replace(tmp, self.base_dir)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def load(self, name: str, model_class, **kwargs):
+        """
+        Load a stored module.
+
+        :param name: Name of the pipeline module, e.g. "unet".
+        :param model_class: Class of the module, e.g. UNet2DConditionModel.
+        :param kwargs: Passed to load_model, e.g. dtype.
+        """
+        return load_model(model_class, self.base_dir, subfolder=name, **kwargs)
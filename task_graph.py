@@ -0,0 +1,87 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import time
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+
+class Task:
+    def __init__(self, name: str, fn: Callable[[], Any], deps: Sequence[str]):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.start = None
+        self.end = None
+
+
+class TaskGraph:
+    def __init__(self, spans=None, **span_attrs):
+        """
+        TaskGraph runs loading steps on a thread pool, each one as soon as the
+        steps it depends on are done. Model loading is mostly file I/O and
+        deserialization that releases the GIL, so independent steps overlap.
+
+        :param spans: Optional SpanRecorder, records a span per task.
+        :param span_attrs: Extra fields for the spans, e.g. phase.
+        """
+        self.spans = spans
+        self.span_attrs = span_attrs
+        self.tasks: Dict[str, Task] = {}
+        self.results: Dict[str, Any] = {}
+
+    def add(self, name: str, fn: Callable[[], Any], deps: Sequence[str] = ()) -> None:
+        """
+        Add a task. Dependencies must be added first, which also rules out cycles.
+        Results of finished tasks are available in `results` by name.
+        """
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks[name] = Task(name, fn, deps)
+
+    def _run_task(self, task: Task, futures: Dict[str, Future]) -> Any:
+        for dep in task.deps:
+            # re-raises the failure of a dependency
+            futures[dep].result()
+        task.start = time.time()
+        if self.spans is not None:
+            with self.spans.span(task.name, **self.span_attrs):
+                result = task.fn()
+        else:
+            result = task.fn()
+        task.end = time.time()
+        self.results[task.name] = result
+        return result
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run all tasks and wait for them, raising the first failure.
+
+        :return: Results by task name.
+        """
+        futures: Dict[str, Future] = {}
+        # one thread per task, so that tasks waiting on dependencies never starve runnable ones
+        with ThreadPoolExecutor(
+            max_workers=max(1, len(self.tasks)), thread_name_prefix="setup"
+        ) as executor:
+            for task in self.tasks.values():
+                futures[task.name] = executor.submit(self._run_task, task, futures)
+            for future in futures.values():
+                future.result()
+        return self.results
+
+    def critical_path(self) -> List[Tuple[str, float]]:
+        """
+        The chain of tasks that determined the total time: starting from the
+        last task to finish, follow the dependency that finished last.
+
+        :return: (task name, seconds) from first to last.
+        """
+        done = [t for t in self.tasks.values() if t.end is not None]
+        if not done:
+            return []
+        task = max(done, key=lambda t: t.end)
+        path = []
+        while task is not None:
+            path.append((task.name, task.end - task.start))
+            deps = [self.tasks[d] for d in task.deps]
+            task = max(deps, key=lambda t: t.end) if deps else None
+        return path[::-1]
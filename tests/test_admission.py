@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+from cancellation import CancellationToken, PredictionCancelled
+
+
+def wait_until(condition, timeout: float = 10.0):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.001)
+
+
+def admission_order(controller, requests):
+    """
+    Queue `requests` of (cost, deadline) behind a running one and return the
+    indices of the requests in the order they were admitted.
+    """
+    running = controller.acquire(1.0)
+    order = []
+
+    def run(index, cost, deadline):
+        ticket = controller.acquire(cost, deadline)
+        order.append(index)
+        controller.release(ticket)
+
+    threads = []
+    for i, (cost, deadline) in enumerate(requests):
+        threads.append(threading.Thread(target=run, args=(i, cost, deadline)))
+        threads[-1].start()
+        # queued one after another, so that arrival order is well defined
+        wait_until(lambda: len(controller.queued) == i + 1)
+    controller.release(running)
+    for thread in threads:
+        thread.join(timeout=10)
+    return order
+
+
+@pytest.mark.parametrize(
+    "policy, expected",
+    [("sjf", [2, 0, 1]), ("edf", [1, 2, 0]), ("fifo", [0, 1, 2])],
+)
+def test_admission_order(policy, expected):
+    controller = AdmissionController(policy=policy, aging=0.0)
+    requests = [(5.0, None), (10.0, 100.0), (1.0, 200.0)]
+    assert admission_order(controller, requests) == expected
+    assert not controller.queued and not controller.running
+
+
+def test_rejects_requests_that_would_wait_too_long():
+    controller = AdmissionController(max_queue_seconds=5.0)
+    running = controller.acquire(10.0)
+    # 10s of queue + 1s of work miss a 5s deadline
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(1.0, deadline=5.0)
+    # 10s of queue exceed max_queue_seconds
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(1.0, deadline=60.0)
+    assert not controller.queued
+    controller.release(running)
+
+    # an idle worker admits requests that cannot meet their deadline anyway
+    controller.release(controller.acquire(10.0, deadline=1.0))
+
+
+def test_cancelled_while_queued():
+    controller = AdmissionController()
+    running = controller.acquire(1.0)
+    token = CancellationToken()
+    errors = []
+
+    def wait():
+        try:
+            controller.acquire(1.0, token=token)
+        except PredictionCancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    wait_until(lambda: len(controller.queued) == 1)
+    token.cancel("superseded by a newer request")
+    thread.join(timeout=10)
+
+    assert len(errors) == 1
+    assert not controller.queued
+    assert controller.running == [running]
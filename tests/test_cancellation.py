@@ -0,0 +1,38 @@
+import pytest
+
+from predict import Predictor
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    predictor = Predictor()
+    predictor.setup_runtime(
+        device="cpu",
+        weights_cache_dir=str(tmp_path / "weights-cache"),
+        metrics_dir=str(tmp_path / "metrics"),
+        result_cache_dir=str(tmp_path / "result-cache"),
+    )
+    return predictor
+
+
+def test_requests_without_key_do_not_supersede(predictor):
+    first = predictor.start_cancellation(None)
+    second = predictor.start_cancellation(None)
+    assert not first.cancelled and not second.cancelled
+
+    predictor.finish_cancellation(None, first)
+    predictor.cancel()
+    assert second.cancelled and not first.cancelled
+
+
+def test_newer_request_supersedes_same_key(predictor):
+    first = predictor.start_cancellation("user-1")
+    other = predictor.start_cancellation("user-2")
+    second = predictor.start_cancellation("user-1")
+    assert first.cancelled and first.reason == "superseded by a newer request"
+    assert not other.cancelled and not second.cancelled
+
+    # the superseded prediction finishing leaves its successor registered
+    predictor.finish_cancellation("user-1", first)
+    predictor.cancel("user-1", reason="stop")
+    assert second.reason == "stop" and not other.cancelled
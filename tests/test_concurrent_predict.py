@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.run import BenchmarkEnv, quiet
+from cancellation import PredictionCancelled
+
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+    with BenchmarkEnv(str(tmp_path_factory.mktemp("concurrent"))) as env:
+        yield env
+
+
+@pytest.fixture
+def slow_steps(env):
+    # long enough denoising for the requests to overlap
+    hook = env.predictor.controlnet_pipe.unet.register_forward_pre_hook(
+        lambda *args: time.sleep(0.05)
+    )
+    yield
+    hook.remove()
+
+
+async def collect(predictor, args):
+    return [path async for path in predictor.predict(**args)]
+
+
+async def wait_until(condition, timeout: float = 30.0):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def run(main):
+    with quiet():
+        return asyncio.run(main())
+
+
+def test_newer_prediction_supersedes_running_one(env, slow_steps):
+    args = env.predict_args(64, num_inference_steps=8)
+    args["supersede_key"] = "session-1"
+    predictor = env.predictor
+
+    async def main():
+        first = asyncio.create_task(collect(predictor, args))
+        await wait_until(lambda: predictor.admission.running)
+        second = asyncio.create_task(collect(predictor, args))
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    first, second = run(main)
+    assert isinstance(first, PredictionCancelled)
+    assert str(first) == "superseded by a newer request"
+    assert len(second) == 1
+    assert not predictor.inflight
+
+
+def test_cancelled_by_cog_stops_the_prediction(env, slow_steps):
+    args = env.predict_args(64, num_inference_steps=8)
+    predictor = env.predictor
+    steps = []
+    hook = predictor.controlnet_pipe.unet.register_forward_pre_hook(
+        lambda *args: steps.append(1)
+    )
+
+    async def main():
+        task = asyncio.create_task(collect(predictor, args))
+        await wait_until(lambda: steps)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        # asyncio.run waits for the worker thread to stop
+        run(main)
+    finally:
+        hook.remove()
+    assert len(steps) < 8
+    assert not predictor.admission.running and not predictor.unkeyed_inflight
+
+
+def test_queued_predictions_run_shortest_first(env, slow_steps):
+    predictor = env.predictor
+    running = env.predict_args(64, num_inference_steps=4)
+    large = env.predict_args(128, num_outputs=2, num_inference_steps=4)
+    small = env.predict_args(64, num_inference_steps=4)
+    finished = []
+
+    async def request(name, args):
+        await collect(predictor, args)
+        finished.append(name)
+
+    async def main():
+        tasks = [asyncio.create_task(request("running", running))]
+        await wait_until(lambda: predictor.admission.running)
+        tasks.append(asyncio.create_task(request("large", large)))
+        await wait_until(lambda: len(predictor.admission.queued) == 1)
+        tasks.append(asyncio.create_task(request("small", small)))
+        await wait_until(lambda: len(predictor.admission.queued) == 2)
+        await asyncio.gather(*tasks)
+
+    run(main)
+    assert finished == ["running", "small", "large"]
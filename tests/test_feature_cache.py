@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from benchmarks.tiny_sdxl import build_pipeline
+from feature_cache import FeatureCache
+from tiled_diffusion import TiledDiffusion
+
+DEEP_BLOCKS = {
+    "unet": ["down_blocks.1", "mid_block", "up_blocks.0"],
+    "controlnet": ["down_blocks.1", "mid_block"],
+}
+
+
+@pytest.fixture(scope="module")
+def pipe(tmp_path_factory):
+    pipe = build_pipeline(str(tmp_path_factory.mktemp("cache")), in_channels=4)
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def noise_image(size: int, seed: int = 0) -> Image.Image:
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size, 3), np.uint8)
+    return Image.fromarray(pixels)
+
+
+def generate(pipe, steps: int = 4, size: int = 64) -> torch.Tensor:
+    return pipe(
+        prompt="a poster",
+        image=noise_image(size),
+        mask_image=Image.new("L", (size, size), 255),
+        control_image=noise_image(size, seed=2),
+        width=size,
+        height=size,
+        strength=1.0,
+        num_inference_steps=steps,
+        generator=torch.Generator().manual_seed(0),
+        output_type="latent",
+    ).images
+
+
+def test_cached_steps_reuse_deep_features(pipe):
+    # reference: the full UNet, with the deep block outputs of step 0 swapped in at step 1
+    state = {"step": 0}
+    kept = {}
+
+    def keep_or_reuse(key):
+        def hook(module, args, output):
+            if state["step"] == 0:
+                kept[key] = output
+            elif state["step"] == 1:
+                return kept[key]
+
+        return hook
+
+    hooks = [pipe.unet.register_forward_hook(lambda *args: state.update(step=state["step"] + 1))]
+    for name, blocks in DEEP_BLOCKS.items():
+        for block in blocks:
+            module = getattr(pipe, name).get_submodule(block)
+            hooks.append(module.register_forward_hook(keep_or_reuse((name, block))))
+    try:
+        expected = generate(pipe, steps=2)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    cache = FeatureCache(interval=2)
+    with cache.apply(pipe):
+        cached = generate(pipe, steps=2)
+    assert (cache.steps, cache.full_steps) == (2, 1)
+    torch.testing.assert_close(cached, expected, rtol=1e-5, atol=1e-5)
+    assert not torch.allclose(cached, generate(pipe, steps=2))
+
+
+def count_runs(pipe, modules):
+    # the first resnet of a block only runs when the block does
+    runs = {module: 0 for module in modules}
+    hooks = [
+        getattr(pipe, module.split(".")[0])
+        .get_submodule(module.split(".", 1)[1])
+        .resnets[0]
+        .register_forward_pre_hook(
+            lambda *args, module=module: runs.update({module: runs[module] + 1})
+        )
+        for module in modules
+    ]
+    return runs, hooks
+
+
+@pytest.mark.parametrize("tiled", [False, True])
+def test_deep_blocks_run_on_full_steps(pipe, tiled):
+    modules = ["unet.mid_block", "unet.up_blocks.1", "controlnet.mid_block"]
+    runs, hooks = count_runs(pipe, modules)
+    tiling = TiledDiffusion(max_pixels=0 if tiled else 2**30, tile_size=64, overlap=32)
+    try:
+        with FeatureCache(interval=3).apply(pipe), tiling.apply(pipe, 128, 128):
+            latents = generate(pipe, steps=4, size=128)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    assert torch.isfinite(latents).all()
+    calls = 9 if tiled else 1
+    # full steps 0 and 3 of 4
+    assert runs["unet.mid_block"] == runs["controlnet.mid_block"] == 2 * calls
+    assert runs["unet.up_blocks.1"] == 4 * calls
+    for name in ("unet", "controlnet"):
+        for module in getattr(pipe, name).modules():
+            assert "forward" not in module.__dict__
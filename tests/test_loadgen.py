@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from benchmarks.fake_server import FakePredictionServer
+from benchmarks.loadgen import LoadGenerator, report, request_class, synthetic_mix
+
+
+@pytest.fixture(scope="module")
+def fake_server():
+    server = FakePredictionServer(("127.0.0.1", 0), time_scale=0.001)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_request_class():
+    mix = synthetic_mix(lora_weights="https://example.com/weights.tar", sizes=(768,))
+    classes = {request_class(inputs) for inputs in mix}
+    assert classes == {
+        f"{mode}/{weights}/768x768"
+        for mode in ("txt2img", "img2img", "inpaint", "controlnet", "controlnet_inpaint")
+        for weights in ("base", "lora")
+    }
+    mix = synthetic_mix(modes=("img2img",), sizes=(768, 1024))
+    assert {request_class(inputs) for inputs in mix} == {
+        "img2img/base/768x768",
+        "img2img/base/1024x1024",
+    }
+    assert all("mask" not in inputs and "controlnet_image" not in inputs for inputs in mix)
+    assert request_class({"prompt": "a cat"}) == "txt2img/base/1024x1024"
+
+
+def test_synthetic_mix_bypasses_result_cache():
+    assert all(inputs["bypass_result_cache"] for inputs in synthetic_mix())
+
+
+def test_closed_loop(fake_server):
+    mix = synthetic_mix(lora_weights="https://example.com/weights.tar")
+    results = LoadGenerator(fake_server.url, mix).run_closed(
+        concurrency=3, num_requests=12, duration=None
+    )
+    assert len(results) == 12
+    assert all(r.ok for r in results)
+
+    summary = report(results)
+    assert summary["all"]["requests"] == 12
+    assert sum(e["requests"] for name, e in summary.items() if name != "all") == 12
+    assert summary["all"]["p50"] <= summary["all"]["p95"] <= summary["all"]["p99"]
+    assert summary["all"]["throughput"] > 0
+
+
+def test_open_loop(fake_server):
+    results = LoadGenerator(fake_server.url, synthetic_mix()).run_open(
+        rate=200, num_requests=10, duration=None
+    )
+    assert len(results) == 10
+    assert all(r.ok for r in results)
+    # latencies are measured from the scheduled arrivals
+    assert sorted(r.start for r in results) == [r.start for r in results]
+
+
+def test_errors_are_reported():
+    # nothing listens on port 9 (discard)
+    results = LoadGenerator("http://127.0.0.1:9", [{"prompt": "a cat"}], timeout=1).run_closed(
+        concurrency=1, num_requests=2, duration=None
+    )
+    summary = report(results)
+    assert summary["all"]["errors"] == 2
+    assert "p50" not in summary["all"]
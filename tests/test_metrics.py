@@ -0,0 +1,63 @@
+import json
+import os
+import re
+
+from metrics import SpanRecorder, quantile
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_spans_rotated_beyond_max_bytes(tmp_path):
+    spans = SpanRecorder(str(tmp_path), track_memory=False, max_bytes=1000)
+    for i in range(100):
+        spans.record("denoise_step", 0.1, step=i)
+
+    current = tmp_path / "spans.jsonl"
+    rotated = tmp_path / "spans.jsonl.1"
+    assert os.path.getsize(current) <= 1000
+    assert os.path.getsize(rotated) <= 1000
+    # the newest spans are kept, in order, across the two files
+    steps = [span["step"] for span in read_spans(rotated) + read_spans(current)]
+    assert steps == list(range(100 - len(steps), 100))
+
+    # a new recorder appends to the current file and keeps its size in mind
+    before = os.path.getsize(current)
+    spans = SpanRecorder(str(tmp_path), track_memory=False, max_bytes=before + 1)
+    spans.record("denoise_step", 0.1, step=100)
+    assert [span["step"] for span in read_spans(current)] == [100]
+    assert read_spans(rotated)[-1]["step"] == 99
+
+
+def test_prometheus_quantiles(tmp_path):
+    spans = SpanRecorder(str(tmp_path), window=100, track_memory=False)
+    for i in range(1, 201):
+        spans.record("predict", i / 100)
+    spans.record("setup", 3.0)
+    spans.flush()
+
+    samples = {}
+    with open(tmp_path / "metrics.prom") as f:
+        for line in f:
+            match = re.fullmatch(r"(predictor_stage_seconds\w*)\{(.*)\} (\S+)\n", line)
+            if match:
+                samples[match.group(1), match.group(2)] = float(match.group(3))
+
+    # quantiles are over the last 100 spans, 1.01 to 2.00 seconds
+    assert samples["predictor_stage_seconds", 'stage="predict",quantile="0.5"'] == 1.5
+    assert samples["predictor_stage_seconds", 'stage="predict",quantile="0.95"'] == 1.95
+    assert samples["predictor_stage_seconds", 'stage="predict",quantile="0.99"'] == 1.99
+    # sum and count cover every span
+    assert samples["predictor_stage_seconds_sum", 'stage="predict"'] == 201.0
+    assert samples["predictor_stage_seconds_count", 'stage="predict"'] == 200
+    assert samples["predictor_stage_seconds", 'stage="setup",quantile="0.99"'] == 3.0
+    assert samples["predictor_stage_seconds_count", 'stage="setup"'] == 1
+
+
+def test_quantile_nearest_rank():
+    assert quantile([3, 1, 2], 0.5) == 2
+    assert quantile([1, 2, 3, 4], 0.5) == 2
+    assert quantile([1, 2, 3, 4], 0.99) == 4
+    assert quantile([5], 0.01) == 5
@@ -0,0 +1,43 @@
+import pytest
+import torch
+from diffusers.models.attention_processor import LoRAAttnProcessor2_0
+
+from no_init import materialize, no_init_or_tensor
+
+
+def test_modules_are_built_on_meta():
+    with no_init_or_tensor():
+        module = LoRAAttnProcessor2_0(hidden_size=32, cross_attention_dim=16, rank=4)
+    assert all(p.is_meta for p in module.parameters())
+
+    # outside the context everything is allocated as usual
+    assert not torch.empty(2).is_meta
+    assert not any(p.is_meta for p in torch.nn.Linear(4, 4).parameters())
+
+
+def test_materialize():
+    reference = LoRAAttnProcessor2_0(hidden_size=32, cross_attention_dim=16, rank=4)
+    state_dict = {k: v.half() for k, v in reference.state_dict().items()}
+    with no_init_or_tensor():
+        module = LoRAAttnProcessor2_0(hidden_size=32, cross_attention_dim=16, rank=4)
+
+    materialize(module, state_dict, device="cpu", dtype=torch.float32)
+    assert module.state_dict().keys() == state_dict.keys()
+    for name, value in module.state_dict().items():
+        assert value.dtype == torch.float32
+        assert torch.equal(value, state_dict[name].float())
+    assert all(p.requires_grad for p in module.parameters())
+
+
+def test_materialize_checks_keys_and_shapes():
+    with no_init_or_tensor():
+        module = torch.nn.Linear(4, 2)
+
+    with pytest.raises(RuntimeError, match="missing keys"):
+        materialize(module, {"weight": torch.zeros(2, 4)})
+    with pytest.raises(RuntimeError, match="shape"):
+        materialize(module, {"weight": torch.zeros(4, 2), "bias": torch.zeros(2)})
+
+    materialize(module, {"weight": torch.ones(2, 4)}, strict=False)
+    assert not module.weight.is_meta
+    assert module.bias.is_meta
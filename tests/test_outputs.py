@@ -0,0 +1,21 @@
+import os
+
+from outputs import OutputEncoder
+
+
+def test_request_dirs_removed_only_once_released(tmp_path):
+    encoder = OutputEncoder(base_dir=str(tmp_path), keep_last=2)
+    # more requests waiting than keep_last, none may lose its directory
+    waiting = [encoder.request_dir() for _ in range(4)]
+    assert all(os.path.isdir(path) for path in waiting)
+
+    for path in waiting[:3]:
+        encoder.release_dir(path)
+    assert not os.path.exists(waiting[0])
+    assert all(os.path.isdir(path) for path in waiting[1:])
+
+    later = encoder.request_dir()
+    encoder.release_dir(later)
+    assert not os.path.exists(waiting[1])
+    # still running
+    assert os.path.isdir(waiting[3])
@@ -0,0 +1,198 @@
+"""
+Performance regression gate for the predict, LoRA load, weights cache and
+preprocessing paths, on CPU with the tiny components from benchmarks/.
+
+Record a baseline on the machine that runs the gate, e.g. on the main branch:
+    python -m pytest tests/test_performance.py --perf-update-baseline
+and commit benchmarks/baseline.json. Every run then compares against it:
+    python -m pytest tests/test_performance.py --perf-tolerance 0.25
+Stages without a baseline, or with one recorded on a different machine or
+torch version, are reported as skipped with the reason, never as passed.
+Skip the whole gate with --perf-skip or PERF_SKIP=1.
+
+A stage fails when its median time grows by more than the tolerance and the
+slowdown is significant under a Mann-Whitney U test over the repeated runs,
+or when its Python allocations grow by more than the allocation tolerance.
+A slowdown of the first runs is confirmed by as many fresh runs, the test is
+then redone over the first and the fresh runs pooled together, so that a
+stall of a shared machine is diluted rather than retried away.
+"""
+
+import gc
+import itertools
+import json
+import os
+import platform
+import statistics
+import tracemalloc
+
+import pytest
+import torch
+
+from benchmarks.compare import is_regression, mann_whitney_p
+from benchmarks.run import BenchmarkEnv, measure, quiet
+from dataset_and_utils import prepare_image
+from weights import WeightsDownloadCache
+
+STAGES = [
+    "predict",
+    "lora_swap",
+    "weights_cache_hit",
+    "weights_cache_miss",
+    "load_image",
+    "image_processor",
+    "prepare_image",
+]
+
+# absolute slack on top of the allocation tolerance, for stages allocating little
+ALLOC_SLACK = {"alloc_peak_bytes": 64 * 1024, "alloc_retained_blocks": 64}
+
+
+def machine_fingerprint() -> dict:
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def load_baseline(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_stage_baseline(path: str, stage: str, entry: dict) -> None:
+    baseline = load_baseline(path)
+    if baseline is None or baseline["machine"] != machine_fingerprint():
+        baseline = {"machine": machine_fingerprint(), "stages": {}}
+    baseline["stages"][stage] = entry
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "w") as f:
+        json.dump(baseline, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def measure_allocations(fn, runs: int = 3) -> dict:
+    """
+    Peak bytes allocated by Python code during `fn`, and the number of those
+    allocations still alive afterwards. The minimum over `runs` is kept, as
+    allocation noise (caches, pools) only adds.
+    """
+    peaks, retained = [], []
+    with quiet():
+        for _ in range(runs):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                fn()
+                _, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            peaks.append(peak)
+            retained.append(len(snapshot.traces))
+    return {"alloc_peak_bytes": min(peaks), "alloc_retained_blocks": min(retained)}
+
+
+def stage_fn(env: BenchmarkEnv, stage: str):
+    if stage == "predict":
+        args = env.predict_args(64, num_outputs=1, num_inference_steps=2)
+        return lambda: list(env.predictor.generate(**args))
+    if stage == "lora_swap":
+        with quiet():
+            for _ in env.lora_urls:
+                env.swap_lora()
+        return env.swap_lora
+    if stage.startswith("weights_cache"):
+        url = env.lora_urls[0]
+        cache = WeightsDownloadCache(
+            min_disk_free=0, base_dir=os.path.join(env.work_dir, f"cache-{stage}")
+        )
+        if stage == "weights_cache_hit":
+            with quiet():
+                cache.ensure(url)
+            return lambda: cache.ensure(url)
+        unique = (f"{url}?v={i}" for i in itertools.count())
+        return lambda: cache.ensure(next(unique))
+
+    image_path = env.image("image", 1024)
+    if stage == "load_image":
+        return lambda: env.predictor.load_image(image_path)
+    image = env.predictor.load_image(image_path)
+    if stage == "image_processor":
+        pipe = env.predictor.controlnet_pipe
+        return lambda: pipe.image_processor.preprocess(image, height=1024, width=1024)
+    if stage == "prepare_image":
+        return lambda: prepare_image(image, 1024, 1024)
+    raise ValueError(f"Unknown stage {stage}")
+
+
+@pytest.fixture(scope="module")
+def perf_env(tmp_path_factory):
+    with BenchmarkEnv(str(tmp_path_factory.mktemp("perf"))) as env:
+        yield env
+
+
+@pytest.mark.parametrize("stage", STAGES)
+def test_stage_performance(stage, request):
+    options = request.config.option
+    if options.perf_skip and not options.perf_update_baseline:
+        pytest.skip("Performance gate skipped with --perf-skip")
+    baseline = load_baseline(options.perf_baseline)
+    if not options.perf_update_baseline:
+        # an unchecked stage is reported as skipped, not as a passing one
+        if baseline is None or stage not in baseline["stages"]:
+            pytest.skip(
+                f"No baseline for {stage} in {options.perf_baseline}, record one with"
+                " --perf-update-baseline"
+            )
+        if baseline["machine"] != machine_fingerprint():
+            pytest.skip(
+                f"Baseline was recorded on {baseline['machine']}, not on"
+                f" {machine_fingerprint()}, re-record it with --perf-update-baseline"
+            )
+
+    env = request.getfixturevalue("perf_env")
+    try:
+        fn = stage_fn(env, stage)
+        seconds = measure(fn, options.perf_repeats)
+        confirmed = False
+        if not options.perf_update_baseline and is_regression(
+            baseline["stages"][stage]["seconds"], seconds, options.perf_tolerance
+        ):
+            # the first runs stay in the comparison, the fresh ones only add evidence
+            seconds += measure(fn, options.perf_repeats, warmup=0)
+            confirmed = True
+        allocations = measure_allocations(fn)
+    finally:
+        env.unload_lora()
+
+    if options.perf_update_baseline:
+        save_stage_baseline(
+            options.perf_baseline, stage, {"seconds": seconds, **allocations}
+        )
+        return
+
+    entry = baseline["stages"][stage]
+    failures = []
+    if is_regression(entry["seconds"], seconds, options.perf_tolerance):
+        runs = f"{len(seconds)} runs"
+        if confirmed:
+            runs += " pooled, the first ones and as many confirmation runs"
+        failures.append(
+            f"{stage} median {statistics.median(seconds) * 1000:.2f}ms vs baseline"
+            f" {statistics.median(entry['seconds']) * 1000:.2f}ms"
+            f" (p={mann_whitney_p(entry['seconds'], seconds):.4f} over {runs},"
+            f" tolerance {options.perf_tolerance:.0%})"
+        )
+    for key, value in allocations.items():
+        limit = entry[key] * (1 + options.perf_alloc_tolerance) + ALLOC_SLACK[key]
+        if value > limit:
+            failures.append(f"{stage} {key} {value} vs baseline {entry[key]}")
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,196 @@
+import os
+import time
+
+import pytest
+import torch
+from PIL import Image
+
+from benchmarks.run import BenchmarkEnv, quiet
+from benchmarks.tiny_sdxl import build_pipeline
+from metrics import SpanRecorder
+from predict import PIPELINE_CLASSES, draft_size, input_mode, shared_pipeline
+
+
+def test_input_mode():
+    assert input_mode() == "txt2img"
+    assert input_mode(image="a") == "img2img"
+    assert input_mode(image="a", mask="b") == "inpaint"
+    assert input_mode(controlnet_image="c") == "controlnet"
+    assert input_mode(image="a", controlnet_image="c") == "controlnet_img2img"
+    assert input_mode(image="a", mask="b", controlnet_image="c") == "controlnet_inpaint"
+    with pytest.raises(ValueError):
+        input_mode(mask="b")
+
+
+def test_shared_pipeline(tmp_path):
+    base = build_pipeline(str(tmp_path))
+    for mode, pipeline_class in PIPELINE_CLASSES.items():
+        pipe = shared_pipeline(base, pipeline_class)
+        assert isinstance(pipe, pipeline_class)
+        for name, module in pipe.components.items():
+            if module is not None:
+                assert module is base.components[name], (mode, name)
+
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+    with BenchmarkEnv(str(tmp_path_factory.mktemp("modes"))) as env:
+        yield env
+
+
+@pytest.mark.parametrize("in_channels", [9, 4])
+@pytest.mark.parametrize(
+    "inputs", [(), ("image",), ("image", "mask"), ("controlnet_image",), ("image", "controlnet_image")]
+)
+def test_predict_modes(env, tmp_path, in_channels, inputs):
+    env.predictor.controlnet_pipe = build_pipeline(str(tmp_path), in_channels=in_channels)
+    env.predictor.controlnet_pipe.set_progress_bar_config(disable=True)
+    controlnet_calls = []
+    env.predictor.controlnet_pipe.controlnet.register_forward_hook(
+        lambda *args: controlnet_calls.append(1)
+    )
+
+    args = env.predict_args(64)
+    for name in ("image", "mask", "controlnet_image"):
+        if name not in inputs:
+            args[name] = None
+    with quiet():
+        outputs = list(env.predictor.generate(**args))
+
+    assert len(outputs) == 1
+    assert Image.open(outputs[0]).size == (64, 64)
+    assert bool(controlnet_calls) == ("controlnet_image" in inputs)
+
+
+def test_draft_size():
+    assert draft_size((1024, 768)) == (512, 384)
+    assert draft_size((1000, 24)) == (496, 8)
+
+
+@pytest.mark.parametrize("inputs", [(), ("image", "mask", "controlnet_image")])
+def test_predict_draft(env, tmp_path, inputs):
+    env.predictor.controlnet_pipe = build_pipeline(str(tmp_path), in_channels=4)
+    env.predictor.controlnet_pipe.set_progress_bar_config(disable=True)
+    sizes = []
+    env.predictor.controlnet_pipe.unet.conv_in.register_forward_pre_hook(
+        lambda module, args: sizes.append(args[0].shape[-1])
+    )
+
+    args = env.predict_args(64, num_outputs=2)
+    args["quality_mode"] = "draft"
+    for name in ("image", "mask", "controlnet_image"):
+        if name not in inputs:
+            args[name] = None
+    with quiet():
+        outputs = list(env.predictor.generate(**args))
+
+    assert [Image.open(output).size for output in outputs] == [(64, 64)] * 2
+    # half the side in the draft pass, then the full size; the tiny VAE downsamples by 2
+    assert sizes[0] == 16 and sizes[-1] == 32
+
+
+def test_refine_steps_exclude_draft_upscale(env, tmp_path, monkeypatch):
+    monkeypatch.setattr(env.predictor, "spans", SpanRecorder(str(tmp_path), track_memory=False))
+    decode_latents = env.predictor.decode_latents
+
+    def slow_decode_latents(*args, **kwargs):
+        time.sleep(0.5)
+        return decode_latents(*args, **kwargs)
+
+    monkeypatch.setattr(env.predictor, "decode_latents", slow_decode_latents)
+    args = env.predict_args(64)
+    args["quality_mode"] = "draft"
+    with quiet():
+        list(env.predictor.generate(**args))
+
+    # the draft and the refine steps, none of them timed across the draft decode
+    steps = env.predictor.spans.recent["denoise_step"]
+    assert len(steps) >= 2
+    assert max(steps) < 0.5
+
+
+def test_predict_feature_cache(env, tmp_path):
+    env.predictor.controlnet_pipe = build_pipeline(str(tmp_path), in_channels=4)
+    env.predictor.controlnet_pipe.set_progress_bar_config(disable=True)
+    runs = []
+    env.predictor.controlnet_pipe.unet.mid_block.resnets[0].register_forward_pre_hook(
+        lambda *args: runs.append(1)
+    )
+
+    args = env.predict_args(64, num_inference_steps=4)
+    args["feature_cache_interval"] = 2
+    with quiet():
+        outputs = list(env.predictor.generate(**args))
+
+    assert Image.open(outputs[0]).size == (64, 64)
+    # full steps 0 and 2 of 4
+    assert len(runs) == 2
+
+
+def test_predict_token_merging(env, tmp_path):
+    env.predictor.controlnet_pipe = build_pipeline(str(tmp_path), in_channels=4)
+    env.predictor.controlnet_pipe.set_progress_bar_config(disable=True)
+    tokens = set()
+    for name, module in env.predictor.controlnet_pipe.unet.named_modules():
+        if name.endswith("attn1"):
+            module.to_q.register_forward_pre_hook(
+                lambda module, args: tokens.add(args[0].shape[1])
+            )
+
+    args = env.predict_args(64)
+    args["token_merging_ratio"] = 0.5
+    with quiet():
+        outputs = list(env.predictor.generate(**args))
+
+    assert Image.open(outputs[0]).size == (64, 64)
+    # half of the 16x16 tokens of the tiny UNet's attention
+    assert tokens == {128}
+
+
+def test_decode_latents_upcasts_float16_vae(env, tmp_path):
+    base = build_pipeline(str(tmp_path), in_channels=4)
+    pipe = shared_pipeline(base, PIPELINE_CLASSES["txt2img"])
+    pipe.vae.to(dtype=torch.float16)
+    assert pipe.vae.config.force_upcast
+    dtypes = []
+    # upcast_vae keeps the first decoder layers in float16, the rest upcasts
+    pipe.vae.decoder.conv_out.register_forward_pre_hook(
+        lambda module, args: dtypes.append(args[0].dtype)
+    )
+
+    with torch.inference_mode():
+        images = env.predictor.decode_latents(pipe, torch.randn(1, 4, 16, 16))
+    assert images[0].size == (32, 32)
+    assert dtypes == [torch.float32]
+    assert pipe.vae.dtype == torch.float16
+
+
+def test_micro_batches_stream_out(env, tmp_path, monkeypatch):
+    pipe = build_pipeline(str(tmp_path), in_channels=4)
+    pipe.set_progress_bar_config(disable=True)
+    env.predictor.controlnet_pipe = pipe
+    calls = []
+    call = type(pipe).__call__
+
+    def counted(self, *args, **kwargs):
+        calls.append(1)
+        return call(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(pipe), "__call__", counted)
+
+    args = env.predict_args(64, num_outputs=3)
+    args["output_batch_size"] = 1
+    calls_before_yield = []
+    with quiet():
+        for _ in env.predictor.generate(**args):
+            calls_before_yield.append(len(calls))
+
+    # every image is out before the next micro-batch is denoised
+    assert calls_before_yield == [1, 2, 3]
+
+
+def test_benchmark_env_restores_path(tmp_path):
+    path = os.environ["PATH"]
+    with BenchmarkEnv(str(tmp_path)) as env:
+        assert os.environ["PATH"].split(os.pathsep)[0] == env.bin_dir
+    assert os.environ["PATH"] == path
@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from diffusers import DPMSolverMultistepScheduler, EulerDiscreteScheduler, LCMScheduler
+
+from previews import LatentPreviewer, track_denoised
+
+
+@pytest.mark.parametrize(
+    "scheduler_class, has_x0",
+    [(LCMScheduler, True), (EulerDiscreteScheduler, True), (DPMSolverMultistepScheduler, False)],
+)
+def test_previews_show_the_denoised_estimate(tmp_path, scheduler_class, has_x0):
+    scheduler = scheduler_class()
+    scheduler.set_timesteps(4)
+    track_denoised(scheduler)
+    latents = torch.randn(2, 4, 8, 8)
+    noise_pred = torch.randn(2, 4, 8, 8)
+    t = scheduler.timesteps[0]
+
+    prev_sample = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+    assert (scheduler.preview_x0 is not None) == has_x0
+
+    written = []
+    previewer = LatentPreviewer(1, str(tmp_path))
+    previewer.write = written.append
+    previewer(SimpleNamespace(scheduler=scheduler), 0, t, {"latents": prev_sample})
+    expected = scheduler.preview_x0 if has_x0 else prev_sample
+    assert written[0] is expected
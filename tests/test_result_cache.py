@@ -0,0 +1,68 @@
+import os
+
+from result_cache import ResultCache
+
+
+def write_outputs(directory, sizes):
+    directory.mkdir(exist_ok=True)
+    paths = []
+    for i, size in enumerate(sizes):
+        path = directory / f"out-{i}.png"
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_get_returns_outputs_in_order(tmp_path):
+    cache = ResultCache(base_dir=str(tmp_path / "cache"), max_bytes=1000)
+    key = cache.key({"prompt": "a cat", "seed": 1}, {"image": None})
+    assert cache.get(key, str(tmp_path)) is None
+
+    # more than 10 outputs, so that out-10 sorts after out-9
+    cache.put(key, write_outputs(tmp_path / "outputs", range(1, 12)))
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    paths = cache.get(key, str(dest))
+    assert [os.path.basename(p) for p in paths] == [f"out-{i}.png" for i in range(11)]
+    assert [os.path.getsize(p) for p in paths] == list(range(1, 12))
+    assert cache.cache_info().startswith("CacheInfo(hits=1, misses=1")
+
+
+def test_least_recently_used_evicted_beyond_max_bytes(tmp_path):
+    cache = ResultCache(base_dir=str(tmp_path / "cache"), max_bytes=250)
+    outputs = write_outputs(tmp_path / "outputs", [100])
+    for key in ("a", "b"):
+        cache.put(key, outputs)
+    # "a" becomes the most recently used
+    (tmp_path / "dest").mkdir()
+    assert cache.get("a", str(tmp_path / "dest")) is not None
+
+    cache.put("c", outputs)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.size == 200
+    assert not os.path.exists(tmp_path / "cache" / "b")
+
+    # larger than the whole cache, not stored
+    cache.put("d", write_outputs(tmp_path / "large", [300]))
+    assert "d" not in cache.entries and cache.size == 200
+
+
+def test_index_rebuilt_on_startup(tmp_path):
+    base_dir = str(tmp_path / "cache")
+    cache = ResultCache(base_dir=base_dir, max_bytes=1000)
+    outputs = write_outputs(tmp_path / "outputs", [100])
+    for i, key in enumerate(("old", "new")):
+        cache.put(key, outputs)
+        os.utime(os.path.join(base_dir, key), (1000 + i, 1000 + i))
+    # left over by an interrupted put()
+    os.makedirs(os.path.join(base_dir, ".tmp-interrupted"))
+
+    cache = ResultCache(base_dir=base_dir, max_bytes=1000)
+    assert list(cache.entries) == ["old", "new"]
+    assert cache.size == 200
+    assert not os.path.exists(os.path.join(base_dir, ".tmp-interrupted"))
+
+    # a smaller limit evicts the least recently used on startup
+    cache = ResultCache(base_dir=base_dir, max_bytes=150)
+    assert list(cache.entries) == ["new"]
+    assert not os.path.exists(os.path.join(base_dir, "old"))
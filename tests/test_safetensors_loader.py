@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+import safetensors.torch
+import torch
+from diffusers import UNet2DConditionModel
+from transformers import CLIPTextModelWithProjection
+
+import safetensors_loader
+from benchmarks.tiny_sdxl import build_pipeline
+from safetensors_loader import checkpoint_files, load_file, load_into, load_model
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # a few tensors per read, so that several runs and threads get exercised
+    monkeypatch.setattr(safetensors_loader, "CHUNK_BYTES", 4096)
+
+
+def random_tensors():
+    generator = torch.Generator().manual_seed(0)
+    tensors = {
+        f"layer{i}.weight": torch.randn(i + 1, 37, generator=generator).half()
+        for i in range(20)
+    }
+    tensors["scale"] = torch.tensor(2.0, dtype=torch.bfloat16)
+    tensors["steps"] = torch.arange(5)
+    tensors["empty"] = torch.zeros(0, 3)
+    return tensors
+
+
+def test_load_file(tmp_path, small_chunks):
+    tensors = random_tensors()
+    path = os.path.join(tmp_path, "model.safetensors")
+    safetensors.torch.save_file(tensors, path)
+
+    loaded = load_file(path, threads=3)
+    assert loaded.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+    converted = load_file(path, dtype=torch.float32, keys=["layer3.weight", "steps"])
+    assert converted.keys() == {"layer3.weight", "steps"}
+    assert converted["layer3.weight"].dtype == torch.float32
+    assert converted["steps"].dtype == torch.int64
+    assert torch.equal(converted["layer3.weight"], tensors["layer3.weight"].float())
+
+
+def test_load_into(tmp_path, small_chunks):
+    source = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.LayerNorm(16))
+    path = os.path.join(tmp_path, "model.safetensors")
+    safetensors.torch.save_file(source.state_dict(), path)
+
+    target = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.LayerNorm(16))
+    weight = target[0].weight
+    assert load_into(target, path, threads=2) == []
+    # read into the existing parameter
+    assert target[0].weight is weight
+    for name, tensor in source.state_dict().items():
+        assert torch.equal(target.state_dict()[name], tensor)
+
+    # a dtype conversion goes through a copy
+    target.half()
+    load_into(target, path)
+    assert torch.equal(target[0].weight, source[0].weight.half())
+
+    with pytest.raises(RuntimeError, match="missing keys"):
+        load_into(torch.nn.Linear(8, 16, bias=True), path)
+
+
+def test_load_model(tmp_path, small_chunks):
+    pipe = build_pipeline(str(tmp_path))
+    pipe.unet.half().save_pretrained(os.path.join(tmp_path, "sdxl", "unet"), variant="fp16")
+    pipe.text_encoder_2.save_pretrained(os.path.join(tmp_path, "sdxl", "text_encoder_2"))
+
+    unet = load_model(
+        UNet2DConditionModel,
+        os.path.join(tmp_path, "sdxl"),
+        subfolder="unet",
+        variant="fp16",
+        dtype=torch.float32,
+    )
+    assert unet.dtype == torch.float32
+    assert not unet.training
+    for name, tensor in pipe.unet.state_dict().items():
+        assert torch.equal(unet.state_dict()[name], tensor.float())
+
+    text_encoder = load_model(
+        CLIPTextModelWithProjection, os.path.join(tmp_path, "sdxl", "text_encoder_2")
+    )
+    for name, tensor in pipe.text_encoder_2.state_dict().items():
+        assert torch.equal(text_encoder.state_dict()[name], tensor)
+
+
+def test_checkpoint_files_shards(tmp_path):
+    shards = ["model.fp16-00001-of-00002.safetensors", "model.fp16-00002-of-00002.safetensors"]
+    with open(os.path.join(tmp_path, "model.safetensors.index.fp16.json"), "w") as f:
+        json.dump({"weight_map": {"a": shards[1], "b": shards[0], "c": shards[1]}}, f)
+    assert checkpoint_files(str(tmp_path), "fp16") == [
+        os.path.join(tmp_path, shard) for shard in shards
+    ]
+    assert checkpoint_files(str(tmp_path)) == []
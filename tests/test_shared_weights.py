@@ -0,0 +1,66 @@
+import os
+
+import torch
+from diffusers import AutoencoderKL
+
+from benchmarks.tiny_sdxl import build_pipeline
+from shared_weights import SharedWeights
+
+
+def test_publish_and_attach(tmp_path):
+    vae = build_pipeline(str(tmp_path)).vae
+    expected = {k: v.clone() for k, v in vae.state_dict().items()}
+    store = SharedWeights(os.path.join(tmp_path, "shm"), "key")
+    assert not store.has("vae")
+
+    store.publish("vae", vae)
+    assert store.has("vae")
+    for name, tensor in vae.state_dict().items():
+        assert torch.equal(tensor, expected[name])
+
+    attached = store.attach("vae", AutoencoderKL)
+    assert not attached.training
+    for name, tensor in attached.state_dict().items():
+        assert torch.equal(tensor, expected[name])
+
+    # writes stay private to the module that made them
+    with torch.no_grad():
+        attached.encoder.conv_in.weight.fill_(0)
+    again = store.attach("vae", AutoencoderKL)
+    assert torch.equal(again.encoder.conv_in.weight, expected["encoder.conv_in.weight"])
+    store.close()
+
+
+def test_attach_or_publish_loads_once(tmp_path):
+    vae = build_pipeline(str(tmp_path)).vae
+    store = SharedWeights(os.path.join(tmp_path, "shm"), "key")
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return vae
+
+    assert store.attach_or_publish("vae", AutoencoderKL, loader) is vae
+    attached = store.attach_or_publish("vae", AutoencoderKL, loader)
+    assert attached is not vae
+    assert len(loads) == 1
+    store.close()
+
+
+def test_last_user_removes_the_store(tmp_path):
+    base_dir = os.path.join(tmp_path, "shm")
+    first = SharedWeights(base_dir, "key")
+    second = SharedWeights(base_dir, "key")
+    other = SharedWeights(base_dir, "other")
+
+    first.close()
+    assert os.path.exists(first.path)
+    second.close()
+    assert not os.path.exists(first.path)
+    assert os.path.exists(other.path)
+    other.close()
+
+    # opening again starts a new store
+    third = SharedWeights(base_dir, "key")
+    assert os.path.exists(third.path)
+    third.close()
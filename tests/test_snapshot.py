@@ -0,0 +1,50 @@
+import os
+
+import torch
+from diffusers import UNet2DConditionModel
+
+from benchmarks.tiny_sdxl import build_pipeline
+from snapshot import FusedSnapshot, snapshot_fingerprint
+
+
+def random_lora(unet, rank=4, seed=0):
+    """A LoRA on the self-attention queries, in the format load_lora_weights reads."""
+    generator = torch.Generator().manual_seed(seed)
+    state = {}
+    for name, module in unet.named_modules():
+        if name.endswith("attn1.to_q"):
+            state[f"unet.{name}.lora.down.weight"] = torch.randn(
+                rank, module.in_features, generator=generator
+            )
+            state[f"unet.{name}.lora.up.weight"] = torch.randn(
+                module.out_features, rank, generator=generator
+            )
+    return state
+
+
+def test_snapshot_round_trip(tmp_path):
+    pipe = build_pipeline(str(tmp_path))
+    pipe.load_lora_weights(random_lora(pipe.unet))
+    pipe.fuse_lora()
+    fused = pipe.unet.state_dict()
+
+    snapshot = FusedSnapshot(os.path.join(tmp_path, "snapshot"))
+    fingerprint = snapshot_fingerprint({"lora": "random", "seed": 0})
+    assert not snapshot.matches(fingerprint)
+    snapshot.save(pipe, fingerprint)
+
+    assert snapshot.matches(fingerprint)
+    assert not snapshot.matches(snapshot_fingerprint({"lora": "random", "seed": 1}))
+    loaded = snapshot.load("unet", UNet2DConditionModel).state_dict()
+    assert loaded.keys() == fused.keys()
+    assert all(torch.equal(loaded[key], fused[key]) for key in fused)
+
+
+def test_interrupted_save_does_not_match(tmp_path):
+    pipe = build_pipeline(str(tmp_path))
+    snapshot = FusedSnapshot(os.path.join(tmp_path, "snapshot"))
+    fingerprint = snapshot_fingerprint({})
+    snapshot.save(pipe, fingerprint)
+    os.remove(os.path.join(snapshot.base_dir, "fingerprint.json"))
+    assert snapshot.fingerprint is None
+    assert not snapshot.matches(fingerprint)
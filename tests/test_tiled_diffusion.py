@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from benchmarks.tiny_sdxl import build_pipeline
+from tiled_diffusion import TiledDiffusion, latent_windows
+
+
+@pytest.fixture(scope="module")
+def pipe(tmp_path_factory):
+    pipe = build_pipeline(str(tmp_path_factory.mktemp("tiled")))
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def noise_image(size: int, mode: str = "RGB", seed: int = 0) -> Image.Image:
+    channels = 3 if mode == "RGB" else 1
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size, channels), np.uint8)
+    return Image.fromarray(pixels.squeeze(), mode)
+
+
+def generate(pipe, size: int) -> torch.Tensor:
+    return pipe(
+        prompt="a poster",
+        image=noise_image(size),
+        mask_image=noise_image(size, "L", seed=1),
+        control_image=noise_image(size, seed=2),
+        width=size,
+        height=size,
+        num_inference_steps=2,
+        generator=torch.Generator().manual_seed(0),
+        output_type="latent",
+    ).images
+
+
+def test_latent_windows():
+    windows = latent_windows(96, 160, tile=64, overlap=16)
+    assert [(w.top, w.left) for w in windows] == [
+        (0, 0), (0, 48), (0, 96), (32, 0), (32, 48), (32, 96)
+    ]
+    assert all((w.height, w.width) == (64, 64) for w in windows)
+
+    covered = torch.zeros(96, 160)
+    for w in windows:
+        covered[w.top : w.top + w.height, w.left : w.left + w.width] += 1
+    assert covered.min() >= 1
+
+    # smaller than a tile along one side
+    assert latent_windows(32, 64, tile=64, overlap=16) == [(0, 0, 32, 64)]
+
+
+def test_single_tile_matches_untiled(pipe):
+    expected = generate(pipe, 64)
+    with TiledDiffusion(max_pixels=0, tile_size=64).apply(pipe, 64, 64):
+        tiled = generate(pipe, 64)
+    torch.testing.assert_close(tiled, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_tiles_bound_the_unet_input(pipe):
+    sizes = []
+    hooks = [
+        module.conv_in.register_forward_pre_hook(
+            lambda module, args: sizes.append(tuple(args[0].shape[-2:]))
+        )
+        for module in (pipe.unet, pipe.controlnet)
+    ]
+    try:
+        # 128 pixels is 64 latents with the tiny VAE, in 3 by 3 tiles of 32
+        tiling = TiledDiffusion(max_pixels=64 * 64, tile_size=64, overlap=32)
+        assert len(tiling.windows(pipe, 128, 128)) == 9
+        with tiling.apply(pipe, 128, 128):
+            latents = generate(pipe, 128)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    assert "forward" not in pipe.unet.__dict__
+    assert "forward" not in pipe.controlnet.__dict__
+
+    assert latents.shape[-2:] == (64, 64)
+    assert torch.isfinite(latents).all()
+    assert set(sizes) == {(32, 32)}
+
+    tiling.tile_batch = 4
+    with tiling.apply(pipe, 128, 128):
+        batched = generate(pipe, 128)
+    torch.testing.assert_close(batched, latents, rtol=1e-4, atol=1e-4)
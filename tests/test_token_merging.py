@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import torch
+from diffusers.models.attention_processor import LoRAAttnProcessor2_0
+from PIL import Image
+
+from benchmarks.tiny_sdxl import build_pipeline
+from token_merging import TokenMerging, bipartite_merge
+
+
+@pytest.fixture(scope="module")
+def pipe(tmp_path_factory):
+    pipe = build_pipeline(str(tmp_path_factory.mktemp("tome")), in_channels=4)
+    pipe.set_progress_bar_config(disable=True)
+    # LoRA processors as load_trained_weights installs them
+    torch.manual_seed(0)
+    procs = {}
+    for name in pipe.unet.attn_processors:
+        attn = pipe.unet.get_submodule(name[: -len(".processor")])
+        procs[name] = LoRAAttnProcessor2_0(
+            hidden_size=attn.to_q.in_features,
+            cross_attention_dim=None if name.endswith("attn1.processor") else attn.to_k.in_features,
+            rank=4,
+        )
+        for param in procs[name].parameters():
+            torch.nn.init.normal_(param, std=0.1)
+    pipe.unet.set_attn_processor(procs)
+    return pipe
+
+
+def noise_image(size: int, seed: int = 0) -> Image.Image:
+    pixels = np.random.default_rng(seed).integers(0, 256, (size, size, 3), np.uint8)
+    return Image.fromarray(pixels)
+
+
+def generate(pipe, size: int = 64) -> torch.Tensor:
+    return pipe(
+        prompt="a poster",
+        image=noise_image(size),
+        mask_image=Image.new("L", (size, size), 255),
+        control_image=noise_image(size, seed=2),
+        width=size,
+        height=size,
+        strength=1.0,
+        num_inference_steps=2,
+        generator=torch.Generator().manual_seed(0),
+        output_type="latent",
+    ).images
+
+
+def test_bipartite_merge():
+    x = torch.randn(2, 8 * 6, 5)
+    merge, unmerge = bipartite_merge(x, 8, 6, 20, generator=torch.Generator().manual_seed(0))
+    merged = merge(x)
+    assert merged.shape == (2, 48 - 20, 5)
+    # the 16 tokens neither merged nor merged into come back as they were
+    assert ((unmerge(merged) == x).all(-1).sum(-1) >= 16).all()
+
+    # regions of 2x2 equal tokens merge into one token each, without loss
+    regions = torch.randn(2, 4, 3, 5).repeat_interleave(2, 1).repeat_interleave(2, 2)
+    x = regions.reshape(2, 48, 5)
+    merge, unmerge = bipartite_merge(x, 8, 6, 36, generator=torch.Generator().manual_seed(0))
+    assert merge(x).shape == (2, 12, 5)
+    torch.testing.assert_close(unmerge(merge(x)), x)
+
+
+@pytest.mark.parametrize("max_downsample", [2, 1])
+def test_lora_self_attention_sees_merged_tokens(pipe, max_downsample):
+    tokens = {"attn1": set(), "attn2": set()}
+    hooks = [
+        module.to_q.register_forward_pre_hook(
+            lambda module, args, name=name: tokens[name.split(".")[-1]].add(args[0].shape[1])
+        )
+        for name, module in pipe.unet.named_modules()
+        if name.endswith(("attn1", "attn2"))
+    ]
+    try:
+        with TokenMerging(0.5, max_downsample=max_downsample).apply(pipe):
+            latents = generate(pipe)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    assert torch.isfinite(latents).all()
+    # 64 pixels are 32 latents, attention runs at 16x16 with the tiny UNet
+    assert tokens["attn2"] == {256}
+    assert tokens["attn1"] == ({128} if max_downsample == 2 else {256})
+    # the LoRA processors hand their layers to the projections on their first call
+    assert all(
+        module.to_q.lora_layer is not None
+        for name, module in pipe.unet.named_modules()
+        if name.endswith(("attn1", "attn2"))
+    )
+    for name in ("unet", "controlnet"):
+        for module in getattr(pipe, name).modules():
+            assert "forward" not in module.__dict__
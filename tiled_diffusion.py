@@ -0,0 +1,272 @@
+import contextlib
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import torch
+from diffusers.models.unet_2d_condition import UNet2DConditionOutput
+
+# canvases with more pixels than this are denoised in tiles
+TILED_DIFFUSION_PIXELS = int(os.environ.get("TILED_DIFFUSION_PIXELS", 1536 * 1024))
+
+# side of a tile in pixels, the size SDXL was trained at
+TILED_DIFFUSION_TILE = int(os.environ.get("TILED_DIFFUSION_TILE", 1024))
+
+# pixels neighbouring tiles share
+TILED_DIFFUSION_OVERLAP = int(os.environ.get("TILED_DIFFUSION_OVERLAP", 256))
+
+# tiles denoised together in one UNet call
+TILED_DIFFUSION_BATCH = int(os.environ.get("TILED_DIFFUSION_BATCH", 1))
+
+
+class Window(NamedTuple):
+    # in latent pixels
+    top: int
+    left: int
+    height: int
+    width: int
+
+
+def _starts(size: int, tile: int, stride: int) -> List[int]:
+    if size <= tile:
+        return [0]
+    # the last window is aligned with the edge, so every window has the full size
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def latent_windows(height: int, width: int, tile: int, overlap: int) -> List[Window]:
+    """
+    Overlapping windows covering a latent canvas, row by row.
+
+    :param tile: Side of a window, windows are smaller only along a smaller canvas.
+    :param overlap: Minimum overlap of neighbouring windows.
+    """
+    stride = max(1, tile - overlap)
+    return [
+        Window(top, left, min(tile, height), min(tile, width))
+        for top in _starts(height, tile, stride)
+        for left in _starts(width, tile, stride)
+    ]
+
+
+def _crop(tensor: torch.Tensor, window: Window, scale: float = 1) -> torch.Tensor:
+    # scale maps latent pixels to the resolution of the tensor
+    return tensor[
+        ...,
+        int(window.top * scale) : int((window.top + window.height) * scale),
+        int(window.left * scale) : int((window.left + window.width) * scale),
+    ]
+
+
+def _repeat(value: Any, n: int, batch_size: int) -> Any:
+    # per-sample tensors are repeated for every window of the batch, the rest is shared
+    if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size:
+        return torch.cat([value] * n)
+    return value
+
+
+class _ControlNetCall(NamedTuple):
+    # a ControlNet call put off until the UNet runs the windows
+    forward: Callable
+    sample: torch.Tensor
+    timestep: Any
+    args: tuple
+    kwargs: Dict[str, Any]
+
+
+class TiledDiffusion:
+    def __init__(
+        self,
+        max_pixels: int = TILED_DIFFUSION_PIXELS,
+        tile_size: int = TILED_DIFFUSION_TILE,
+        overlap: int = TILED_DIFFUSION_OVERLAP,
+        tile_batch: int = TILED_DIFFUSION_BATCH,
+    ):
+        """
+        TiledDiffusion denoises large canvases in overlapping tiles, as in
+        MultiDiffusion: at every step the UNet runs on each tile of the latents
+        on its own and the noise predictions are averaged where tiles overlap,
+        so the whole canvas takes one scheduler step. Memory then depends on the
+        tile size rather than the canvas size.
+
+        The pipeline is left as is, its UNet and ControlNet are swapped for
+        tiled versions while it runs. Everything spatial is cut into the same
+        tiles: the inpaint mask and masked image, which the pipeline adds to the
+        UNet input, and the ControlNet image. Each tile is conditioned as a crop
+        of the canvas through the SDXL crop coordinates.
+
+        :param max_pixels: Tile canvases with more pixels than this.
+        :param tile_size: Side of a tile in pixels.
+        :param overlap: Pixels neighbouring tiles share.
+        :param tile_batch: Number of tiles per UNet call.
+        """
+        self.max_pixels = max_pixels
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_batch = tile_batch
+
+    def tile_size_for(self, width: int, height: int) -> Optional[int]:
+        """
+        Side of the tiles used for a canvas of this size, None when not tiled.
+        """
+        return self.tile_size if width * height > self.max_pixels else None
+
+    @contextlib.contextmanager
+    def apply(self, pipe, width: int, height: int):
+        """
+        Run the UNet and ControlNet of `pipe` in tiles while in the context,
+        when a canvas of this size needs it.
+        """
+        if self.tile_size_for(width, height) is None:
+            yield
+            return
+        scale = pipe.vae_scale_factor
+        print(
+            f"Denoising {width}x{height} in {len(self.windows(pipe, width, height))} tiles"
+        )
+        with contextlib.ExitStack() as stack:
+            controlnet = getattr(pipe, "controlnet", None)
+            if controlnet is not None:
+                stack.enter_context(patch_forward(controlnet, self._defer_controlnet))
+            stack.enter_context(
+                patch_forward(pipe.unet, lambda forward: self._tiled_unet(forward, scale))
+            )
+            yield
+
+    def windows(self, pipe, width: int, height: int) -> List[Window]:
+        scale = pipe.vae_scale_factor
+        return latent_windows(
+            height // scale, width // scale, self.tile_size // scale, self.overlap // scale
+        )
+
+    def _defer_controlnet(self, forward):
+        def deferred(sample, timestep, *args, **kwargs):
+            # the ControlNet runs tile by tile, together with the UNet
+            return [], _ControlNetCall(forward, sample, timestep, args, kwargs)
+
+        return deferred
+
+    def _window_conditions(self, added_cond_kwargs, windows, batch_size, scale):
+        if not added_cond_kwargs:
+            return added_cond_kwargs
+        added = {
+            name: _repeat(value, len(windows), batch_size)
+            for name, value in added_cond_kwargs.items()
+        }
+        time_ids = added_cond_kwargs.get("time_ids")
+        if time_ids is not None:
+            # original size, crop top left, then target size or aesthetic score
+            window_ids = []
+            for window in windows:
+                ids = time_ids.clone()
+                ids[:, 2] = window.top * scale
+                ids[:, 3] = window.left * scale
+                if ids.shape[1] == 6:
+                    ids[:, 4] = window.height * scale
+                    ids[:, 5] = window.width * scale
+                window_ids.append(ids)
+            added["time_ids"] = torch.cat(window_ids)
+        return added
+
+    def _run_controlnet(self, call, windows, batch_size, scale):
+        n = len(windows)
+        kwargs = dict(call.kwargs)
+        # in image pixels
+        controlnet_cond = kwargs.pop("controlnet_cond")
+        added_cond_kwargs = kwargs.pop("added_cond_kwargs", None)
+        kwargs = {name: _repeat(value, n, batch_size) for name, value in kwargs.items()}
+        return call.forward(
+            torch.cat([_crop(call.sample, window) for window in windows]),
+            _repeat(call.timestep, n, batch_size),
+            *[_repeat(arg, n, batch_size) for arg in call.args],
+            controlnet_cond=torch.cat(
+                [_crop(controlnet_cond, window, scale) for window in windows]
+            ),
+            added_cond_kwargs=self._window_conditions(
+                added_cond_kwargs, windows, batch_size, scale
+            ),
+            **dict(kwargs, return_dict=False),
+        )
+
+    def _tiled_unet(self, forward, scale):
+        def tiled(
+            sample,
+            timestep,
+            *args,
+            added_cond_kwargs=None,
+            down_block_additional_residuals=None,
+            mid_block_additional_residual=None,
+            return_dict=True,
+            **kwargs,
+        ):
+            batch_size = sample.shape[0]
+            height, width = sample.shape[-2:]
+            windows = latent_windows(
+                height, width, self.tile_size // scale, self.overlap // scale
+            )
+            noise_pred = None
+            counts = sample.new_zeros((1, 1, height, width))
+            for start in range(0, len(windows), self.tile_batch):
+                batch = windows[start : start + self.tile_batch]
+                n = len(batch)
+                window_kwargs = {
+                    name: _repeat(value, n, batch_size) for name, value in kwargs.items()
+                }
+                window_kwargs["added_cond_kwargs"] = self._window_conditions(
+                    added_cond_kwargs, batch, batch_size, scale
+                )
+                if isinstance(mid_block_additional_residual, _ControlNetCall):
+                    down, mid = self._run_controlnet(
+                        mid_block_additional_residual, batch, batch_size, scale
+                    )
+                    window_kwargs["down_block_additional_residuals"] = down
+                    window_kwargs["mid_block_additional_residual"] = mid
+                elif mid_block_additional_residual is not None:
+                    # computed on the whole canvas, at the resolutions of the UNet blocks
+                    window_kwargs["down_block_additional_residuals"] = [
+                        torch.cat([_crop(r, w, r.shape[-1] / width) for w in batch])
+                        for r in down_block_additional_residuals
+                    ]
+                    window_kwargs["mid_block_additional_residual"] = torch.cat(
+                        [
+                            _crop(mid_block_additional_residual, w, mid_block_additional_residual.shape[-1] / width)
+                            for w in batch
+                        ]
+                    )
+                out = forward(
+                    torch.cat([_crop(sample, window) for window in batch]),
+                    _repeat(timestep, n, batch_size),
+                    *[_repeat(arg, n, batch_size) for arg in args],
+                    return_dict=False,
+                    **window_kwargs,
+                )[0]
+                if noise_pred is None:
+                    noise_pred = sample.new_zeros(
+                        (batch_size, out.shape[1], height, width), dtype=out.dtype
+                    )
+                for i, window in enumerate(batch):
+                    _crop(noise_pred, window).add_(out[i * batch_size : (i + 1) * batch_size])
+                    _crop(counts, window).add_(1)
+            noise_pred = noise_pred / counts.to(noise_pred.dtype)
+            if not return_dict:
+                return (noise_pred,)
+            return UNet2DConditionOutput(sample=noise_pred)
+
+        return tiled
+
+
+@contextlib.contextmanager
+def patch_forward(module: torch.nn.Module, make_forward):
+    """
+    Replace the forward of a module while in the context with
+    `make_forward(forward)`, which gets the current forward to wrap.
+    """
+    # forward set on the instance, e.g. by accelerate hooks, is restored as well
+    saved = module.__dict__.get("forward")
+    module.forward = make_forward(module.forward)
+    try:
+        yield
+    finally:
+        if saved is None:
+            del module.forward
+        else:
+            module.forward = saved
@@ -0,0 +1,184 @@
+import contextlib
+import math
+import os
+from typing import Callable, Optional, Tuple
+
+import torch
+from diffusers.models.attention import BasicTransformerBlock
+
+from tiled_diffusion import patch_forward
+
+# self-attention layers at most this many times below the latent resolution merge
+# tokens, 2 is the first attention level of SDXL, where most of the tokens are
+TOKEN_MERGING_MAX_DOWNSAMPLE = int(os.environ.get("TOKEN_MERGING_MAX_DOWNSAMPLE", 2))
+
+# side of the regions of tokens that each keep one token to merge into
+TOKEN_MERGING_STRIDE = 2
+
+# at most this share of tokens can be merged, all but one of every region
+MAX_TOKEN_MERGING_RATIO = 1 - 1 / TOKEN_MERGING_STRIDE**2
+
+
+def _identity(x: torch.Tensor) -> torch.Tensor:
+    return x
+
+
+def bipartite_merge(
+    metric: torch.Tensor,
+    height: int,
+    width: int,
+    r: int,
+    stride: int = TOKEN_MERGING_STRIDE,
+    generator: Optional[torch.Generator] = None,
+) -> Tuple[Callable, Callable]:
+    """
+    Bipartite soft matching of ToMe for Stable Diffusion. One token of every
+    `stride` x `stride` region, picked at random, is a destination, the `r`
+    other tokens most similar to a destination are averaged into it.
+
+    :param metric: Tokens to compare, of shape (batch, height * width, channels).
+    :param r: Number of tokens to merge away.
+    :param generator: Picks the destination tokens, on the CPU.
+    :return: merge and unmerge functions, unmerge copies each merged token
+        back to all the tokens it was merged from.
+    """
+    batch, n, _ = metric.shape
+    rows, cols = height // stride, width // stride
+    r = min(r, n - rows * cols)
+    if r <= 0:
+        return _identity, _identity
+
+    # -1 marks the destination of each region, sorting puts them first
+    picks = torch.randint(stride * stride, (rows, cols, 1), generator=generator)
+    regions = torch.zeros(rows, cols, stride * stride, dtype=torch.int64)
+    regions.scatter_(2, picks, -1)
+    regions = regions.view(rows, cols, stride, stride).transpose(1, 2)
+    marks = torch.zeros(height, width, dtype=torch.int64)
+    marks[: rows * stride, : cols * stride] = regions.reshape(rows * stride, cols * stride)
+    order = marks.reshape(1, -1, 1).argsort(dim=1).to(metric.device)
+    num_dst = rows * cols
+    src_idx, dst_idx = order[:, num_dst:], order[:, :num_dst]
+
+    def split(x):
+        channels = x.shape[-1]
+        src = x.gather(1, src_idx.expand(batch, n - num_dst, channels))
+        dst = x.gather(1, dst_idx.expand(batch, num_dst, channels))
+        return src, dst
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        best, best_dst = (a @ b.transpose(-1, -2)).max(dim=-1)
+        edges = best.argsort(dim=-1, descending=True)[..., None]
+        kept = edges[:, r:]
+        merged = edges[:, :r]
+        merged_dst = best_dst[..., None].gather(1, merged)
+
+    def merge(x):
+        src, dst = split(x)
+        channels = x.shape[-1]
+        unmerged = src.gather(1, kept.expand(batch, n - num_dst - r, channels))
+        src = src.gather(1, merged.expand(batch, r, channels))
+        dst = dst.scatter_reduce(1, merged_dst.expand(batch, r, channels), src, reduce="mean")
+        return torch.cat([unmerged, dst], dim=1)
+
+    def unmerge(x):
+        channels = x.shape[-1]
+        unmerged, dst = x[:, : n - num_dst - r], x[:, n - num_dst - r :]
+        src = dst.gather(1, merged_dst.expand(batch, r, channels))
+        out = x.new_zeros(batch, n, channels)
+        src_positions = src_idx.expand(batch, n - num_dst, 1)
+        out.scatter_(1, dst_idx.expand(batch, num_dst, channels), dst)
+        out.scatter_(
+            1, src_positions.gather(1, kept).expand(batch, n - num_dst - r, channels), unmerged
+        )
+        out.scatter_(1, src_positions.gather(1, merged).expand(batch, r, channels), src)
+        return out
+
+    return merge, unmerge
+
+
+class TokenMerging:
+    def __init__(
+        self,
+        ratio: float,
+        max_downsample: int = TOKEN_MERGING_MAX_DOWNSAMPLE,
+        stride: int = TOKEN_MERGING_STRIDE,
+        seed: int = 0,
+    ):
+        """
+        TokenMerging merges redundant tokens before self-attention and copies
+        the results back after it, as in ToMe for Stable Diffusion. The cost
+        of self-attention is quadratic in the number of tokens, so merging half
+        of them roughly quarters it at the resolutions where it dominates.
+
+        Only the forward of the self-attention modules is wrapped, the
+        attention processors, e.g. the LoRA ones of load_trained_weights, run
+        unchanged on the merged tokens. Cross-attention and the feed forward
+        layers see every token.
+
+        :param ratio: Share of tokens merged away, up to MAX_TOKEN_MERGING_RATIO.
+        :param max_downsample: Merge in self-attention layers at most this many
+            times below the latent resolution.
+        :param stride: Side of the regions that each keep one token to merge into.
+        :param seed: Seed for picking those tokens, the same for every call.
+        """
+        self.ratio = ratio
+        self.max_downsample = max_downsample
+        self.stride = stride
+        self.seed = seed
+        self._size: Tuple[int, int] = (0, 0)
+
+    @contextlib.contextmanager
+    def apply(self, pipe):
+        """
+        Merge tokens in the UNet and ControlNet of `pipe` while in the context.
+        Enter it before TiledDiffusion.apply, so that tokens are merged within
+        each tile.
+        """
+        if self.ratio <= 0:
+            yield
+            return
+        models = [pipe.unet]
+        if getattr(pipe, "controlnet", None) is not None:
+            models.append(pipe.controlnet)
+        with contextlib.ExitStack() as stack:
+            layers = 0
+            for model in models:
+                stack.enter_context(patch_forward(model, self._track))
+                for module in model.modules():
+                    if isinstance(module, BasicTransformerBlock) and not module.only_cross_attention:
+                        stack.enter_context(patch_forward(module.attn1, self._merged))
+                        layers += 1
+            print(f"Merging {self.ratio:.0%} of tokens in up to {layers} self-attention layers")
+            yield
+
+    def _track(self, forward):
+        def tracked(sample, *args, **kwargs):
+            # the latent size the tokens of every layer are a downsampling of
+            self._size = tuple(sample.shape[-2:])
+            return forward(sample, *args, **kwargs)
+
+        return tracked
+
+    def _merged(self, forward):
+        def merged(hidden_states, *args, **kwargs):
+            if hidden_states.dim() != 3:
+                return forward(hidden_states, *args, **kwargs)
+            n = hidden_states.shape[1]
+            height, width = self._size
+            downsample = round(math.sqrt(height * width / n))
+            height, width = math.ceil(height / downsample), math.ceil(width / downsample)
+            if downsample > self.max_downsample or height * width != n:
+                return forward(hidden_states, *args, **kwargs)
+            merge, unmerge = bipartite_merge(
+                hidden_states,
+                height,
+                width,
+                int(n * self.ratio),
+                self.stride,
+                torch.Generator().manual_seed(self.seed),
+            )
+            return unmerge(forward(merge(hidden_states), *args, **kwargs))
+
+        return merged
@@ -1,9 +1,11 @@
+import json
 import os
 import shutil
 import tarfile
 
 from cog import BaseModel, Input, Path
 
+from metrics import SpanRecorder
 from predict import SDXL_MODEL_CACHE, SDXL_URL, download_weights
 from preprocess import preprocess
 from trainer_pti import main
@@ -120,6 +122,9 @@ def train(
         choices=["zip", "tar", "infer"],
     ),
 ) -> TrainingOutput:
+    spans = SpanRecorder()
+    train_span = spans.start("train", phase="train")
+
     # Hard-code token_map for now. Make it configurable once we support multiple concepts or user-uploaded caption csv.
     token_map = token_string + ":2"
 
@@ -139,24 +144,27 @@ def train(
 
         running_tok_cnt += n_tok
 
-    input_dir = preprocess(
-        input_images_filetype=input_images_filetype,
-        input_zip_path=input_images,
-        caption_text=caption_prefix,
-        mask_target_prompts=mask_target_prompts,
-        target_size=resolution,
-        crop_based_on_salience=crop_based_on_salience,
-        use_face_detection_instead=use_face_detection_instead,
-        temp=clipseg_temperature,
-        substitution_tokens=list(token_dict.keys()),
-    )
+    with spans.span("preprocess", phase="train"):
+        input_dir = preprocess(
+            input_images_filetype=input_images_filetype,
+            input_zip_path=input_images,
+            caption_text=caption_prefix,
+            mask_target_prompts=mask_target_prompts,
+            target_size=resolution,
+            crop_based_on_salience=crop_based_on_salience,
+            use_face_detection_instead=use_face_detection_instead,
+            temp=clipseg_temperature,
+            substitution_tokens=list(token_dict.keys()),
+        )
 
-    if not os.path.exists(SDXL_MODEL_CACHE):
-        download_weights(SDXL_URL, SDXL_MODEL_CACHE)
+    with spans.span("sdxl_download", phase="train"):
+        if not os.path.exists(SDXL_MODEL_CACHE):
+            download_weights(SDXL_URL, SDXL_MODEL_CACHE)
     if os.path.exists(OUTPUT_DIR):
         shutil.rmtree(OUTPUT_DIR)
     os.makedirs(OUTPUT_DIR)
 
+    fit_span = spans.start("fit", phase="train")
     main(
         pretrained_model_name_or_path=SDXL_MODEL_CACHE,
         instance_data_dir=os.path.join(input_dir, "captions.csv"),
@@ -184,14 +192,21 @@ def train(
         lora_rank=lora_rank,
         is_lora=is_lora,
     )
+    spans.finish(fit_span)
 
     directory = Path(OUTPUT_DIR)
     out_path = "trained_model.tar"
 
-    with tarfile.open(out_path, "w") as tar:
-        for file_path in directory.rglob("*"):
-            print(file_path)
-            arcname = file_path.relative_to(directory)
-            tar.add(file_path, arcname=arcname)
+    with spans.span("package", phase="train"):
+        with tarfile.open(out_path, "w") as tar:
+            for file_path in directory.rglob("*"):
+                print(file_path)
+                arcname = file_path.relative_to(directory)
+                tar.add(file_path, arcname=arcname)
+
+    spans.finish(train_span)
+    spans.flush()
+    for name in ["preprocess", "sdxl_download", "fit", "package", "train"]:
+        print(f"{name} memory peaks: {json.dumps(spans.memory_peaks(name))}")
 
     return TrainingOutput(weights=Path(out_path))
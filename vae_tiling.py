@@ -0,0 +1,84 @@
+import contextlib
+import os
+from typing import Optional
+
+# images with more pixels than this are encoded and decoded in tiles
+VAE_TILE_PIXELS = int(os.environ.get("VAE_TILE_PIXELS", 1024 * 1024))
+
+# side of a tile in pixels, so a tile never takes more memory than one image at the threshold
+VAE_TILE_SIZE = int(os.environ.get("VAE_TILE_SIZE", 1024))
+
+# fraction of a tile that overlaps its neighbours and is blended with them
+VAE_TILE_OVERLAP = 0.25
+
+# batches larger than this go through the VAE one image at a time
+VAE_SLICE_BATCH = int(os.environ.get("VAE_SLICE_BATCH", 1))
+
+
+class VaeTiling:
+    def __init__(
+        self,
+        max_pixels: int = VAE_TILE_PIXELS,
+        tile_size: int = VAE_TILE_SIZE,
+        overlap: float = VAE_TILE_OVERLAP,
+        max_batch: int = VAE_SLICE_BATCH,
+    ):
+        """
+        VaeTiling bounds the memory the VAE takes to encode and decode large
+        images or batches, using the tiling and slicing of AutoencoderKL.
+
+        Above `max_pixels` an image is split into overlapping tiles, each
+        tile goes through the VAE on its own and the overlaps are blended
+        linearly to hide the seams. Tiles see less context than the whole
+        image, so the output is close to, not equal to, the untiled one.
+        Above `max_batch` the images of a batch go through one at a time,
+        which leaves them unchanged.
+
+        :param max_pixels: Tile images with more pixels than this.
+        :param tile_size: Side of a tile in pixels.
+        :param overlap: Fraction of a tile blended with each neighbour.
+        :param max_batch: Slice batches larger than this.
+        """
+        self.max_pixels = max_pixels
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_batch = max_batch
+
+    def tile_size_for(self, width: int, height: int) -> Optional[int]:
+        """
+        Side of the tiles used for images of this size, None when not tiled.
+        """
+        return self.tile_size if width * height > self.max_pixels else None
+
+    @contextlib.contextmanager
+    def apply(self, vae, width: int, height: int, batch_size: int = 1):
+        """
+        Switch tiling and slicing of `vae` on as needed for images of this
+        size and batch, restoring the previous settings on exit. The VAE is
+        shared by the pipelines, so this is meant for one prediction at a time.
+        """
+        saved = (
+            vae.use_tiling,
+            vae.use_slicing,
+            vae.tile_sample_min_size,
+            vae.tile_latent_min_size,
+            vae.tile_overlap_factor,
+        )
+        tile_size = self.tile_size_for(width, height)
+        if tile_size is not None:
+            downscale = 2 ** (len(vae.config.block_out_channels) - 1)
+            vae.tile_sample_min_size = tile_size
+            vae.tile_latent_min_size = tile_size // downscale
+            vae.tile_overlap_factor = self.overlap
+        vae.use_tiling = tile_size is not None
+        vae.use_slicing = batch_size > self.max_batch
+        try:
+            yield
+        finally:
+            (
+                vae.use_tiling,
+                vae.use_slicing,
+                vae.tile_sample_min_size,
+                vae.tile_latent_min_size,
+                vae.tile_overlap_factor,
+            ) = saved